@@ -4,6 +4,81 @@
 #include <stdlib.h>
 #include <string.h>
 #include <math.h>
+#ifdef _OPENMP
+#include <omp.h>
+#endif
+
+//Works out dC/dt at every interior point of prevStep with the forward-difference
+//electromigration/diffusion equation, storing it into rates[1..ndx-2].
+//x gives the node positions of a non-uniform mesh, or is NULL for uniform spacing dx.
+//Returns SIM_UNSTABLE if any concentration has left [0,1]
+static int explicit_rates(const double* Dvector,
+                          const double* Rvector,
+                          int nIV,
+                          const double* prevStep,
+                          int ndx, double dx,
+                          const double* x,
+                          double r,
+                          double* rates)
+{
+    //loop over space
+    for (int k = 1; k < ndx - 1; k++)
+    {
+        //Work out lookup indicies for D and R based on concentration
+        int Ckm1Index = lround(prevStep[k-1] * (nIV - 1));
+        int CkIndex = lround(prevStep[k] * (nIV - 1));
+        int Ckp1Index = lround(prevStep[k+1] * (nIV - 1));
+
+        //This tells us if our previous concentrations were outside [0,1]
+        //and hence if we're about to dereference garbage
+        if (Ckm1Index < 0 || CkIndex < 0 || Ckp1Index < 0 ||
+            Ckm1Index >= nIV || CkIndex >= nIV || Ckp1Index >= nIV)
+            return SIM_UNSTABLE;
+
+        //Indicies for calculating either central, left or right difference derivative of dDdc/dRdc;
+        //Central unless we have C = 0 or C = 1
+        int dLeftIndex = CkIndex == 0 ? CkIndex : CkIndex - 1;
+        int dRightIndex = CkIndex == (nIV - 1) ? CkIndex : CkIndex + 1;
+
+        //Calculate derivatives based on these indicies
+        //Multiply by nIV-1 to turn indicies into units of concentration
+        double dDdc = (Dvector[dRightIndex] - Dvector[dLeftIndex]) /
+                    (dRightIndex - dLeftIndex) * (nIV - 1);
+        double dRdc = (Rvector[dRightIndex] - Rvector[dLeftIndex]) /
+                    (dRightIndex - dLeftIndex) * (nIV - 1);
+
+        //Current values of D and R
+        double Dv = Dvector[CkIndex];
+        double Rv = Rvector[CkIndex];
+
+        //Concentrations and derivatives thereof
+        double C = prevStep[k];
+        double dCdx, d2Cdx2;
+        if (x)
+        {
+            //three point second derivative for unequal spacing; reduces to the one below when hm == hp
+            double hm = x[k] - x[k-1];
+            double hp = x[k+1] - x[k];
+            dCdx = (prevStep[k+1] - prevStep[k]) / hp;
+            d2Cdx2 = 2 * (hm * prevStep[k+1] - (hm + hp) * prevStep[k] + hp * prevStep[k-1]) /
+                     (hm * hp * (hm + hp));
+        }
+        else
+        {
+            dCdx = (prevStep[k+1] - prevStep[k]) / dx;
+            d2Cdx2 = (prevStep[k+1] - 2 * prevStep[k] + prevStep[k-1]) / (dx * dx);
+        }
+
+        //the rate of change
+        rates[k] = Dv*d2Cdx2 + dDdc*dCdx*dCdx - dDdc*dCdx*C*Rv*r - Dv*Rv*dCdx*r
+                   -Dv*dRdc*dCdx*C*r;
+
+        /*rates[k] = Dv*d2Cdx2 + dDdc*dCdx*dCdx - dDdc*C*Rv*r - Dv*Rv*dCdx*r
+                     -Dv*dRdc*dCdx*r;*/
+    }
+
+    return SIM_SUCCESS;
+}
 
 int calc_simulation(const double* Dvector,
                     const double* Rvector,
@@ -30,65 +105,1123 @@ int calc_simulation(const double* Dvector,
         simResults[0] = leftBoundary;
         simResults[ndx-1] = rightBoundary;
 
+        //rates go straight into simResults...
+        if (explicit_rates(Dvector, Rvector, nIV, prevStep, ndx, dx, NULL, r, simResults) != SIM_SUCCESS)
+        {
+            free(prevStep);
+            return SIM_UNSTABLE;
+        }
+
+        //...and then get turned into the next step
+        for (int k = 1; k < ndx - 1; k++)
+        {
+            double simc = dt * simResults[k] + prevStep[k];
+
+            //Smooth out major fuckups in simc; for somereason these are appearing
+            //Probably because dDdC is much bigger with this model
+            /*if (simc > 1.0)
+                simc = 1.0;
+            else if (simc < 0.0)
+                simc = 0.0;*/
+            simResults[k] = simc;
+        }
+
+        //Now swap current step into prev step
+        memcpy(prevStep, simResults, simStorageBytes);
+    }
+
+    //The result is now in memory (simResults); free and return
+    free(prevStep);
+    return SIM_SUCCESS;
+}
+
+
+int calc_simulation_batch(const double* Dvector,
+                          const double* Rvector,
+                          int nIV,
+                          const double* initCond,
+                          int initStride,
+                          int ndt, int ndx,
+                          double dt, double dx,
+                          const double* rValues,
+                          const double* cvFactors,
+                          int nSims,
+                          double* simResults,
+                          int* simStatus)
+{
+    //Profiles are stored structure-of-arrays style: all nSims values for cell k
+    //live next to each other at [k * nSims + j], so the inner loop over j is
+    //unit-stride and the compiler can vectorise it.
+    //initStride is 0 if every simulation starts from the same initCond, or ndx
+    //if initCond holds one starting profile per simulation (e.g. to resume a batch)
+    size_t simStorageBytes = sizeof(double) * ndx * nSims;
+    double* prevStep = (double*)malloc(simStorageBytes);
+    double* nextStep = (double*)malloc(simStorageBytes);
+
+    //dR/dc only depends on the table index, so work it out once for the whole
+    //batch rather than once per cell per timestep. dD/dc has to be done inline
+    //because D is scaled by each simulation's cv factor before differencing
+    double* dRvector = (double*)malloc(sizeof(double) * nIV);
+
+    //flags a simulation whose concentrations left [0,1]
+    int* unstable = (int*)calloc(nSims, sizeof(int));
+
+    if (!prevStep || !nextStep || !dRvector || !unstable)
+    {
+        free(prevStep);
+        free(nextStep);
+        free(dRvector);
+        free(unstable);
+        return SIM_UNSTABLE;
+    }
+
+    for (int i = 0; i < nIV; i++)
+    {
+        //Central difference unless we have C = 0 or C = 1, exactly as calc_simulation does
+        int dLeftIndex = i == 0 ? i : i - 1;
+        int dRightIndex = i == (nIV - 1) ? i : i + 1;
+        int span = dRightIndex - dLeftIndex;
+        dRvector[i] = span == 0 ? 0 : (Rvector[dRightIndex] - Rvector[dLeftIndex]) / span * (nIV - 1);
+    }
+
+    //transpose the initial conditions into the batch layout
+    for (int k = 0; k < ndx; k++)
+        for (int j = 0; j < nSims; j++)
+            prevStep[k * nSims + j] = initCond[(size_t)j * initStride + k];
+
+    //constant composition boundary conditions. They never change, so whether they
+    //round to inside the tables only needs checking once rather than every step
+    for (int j = 0; j < nSims; j++)
+    {
+        nextStep[j] = prevStep[j];
+        nextStep[(ndx - 1) * nSims + j] = prevStep[(ndx - 1) * nSims + j];
+        long leftIndex = lround(prevStep[j] * (nIV - 1));
+        long rightIndex = lround(prevStep[(ndx - 1) * nSims + j] * (nIV - 1));
+        unstable[j] = leftIndex < 0 || leftIndex >= nIV || rightIndex < 0 || rightIndex >= nIV;
+    }
+
+    //loop in time
+    for (int n = 0; n < ndt; n++)
+    {
         //loop over space
         for (int k = 1; k < ndx - 1; k++)
         {
-            //Work out lookup indicies for D and R based on concentration
-            int Ckm1Index = lround(prevStep[k-1] * (nIV - 1));
-            int CkIndex = lround(prevStep[k] * (nIV - 1));
-            int Ckp1Index = lround(prevStep[k+1] * (nIV - 1));
+            const double* Ckm1 = prevStep + (k - 1) * nSims;
+            const double* Ck = prevStep + k * nSims;
+            const double* Ckp1 = prevStep + (k + 1) * nSims;
+            double* out = nextStep + k * nSims;
+
+            //loop over the batch
+            for (int j = 0; j < nSims; j++)
+            {
+                //Rounded with lround() exactly as calc_simulation does, so both kernels pick the same
+                //entries and agree on when a simulation has left the tables. calc_simulation also checks
+                //k-1 and k+1, but every interior point gets checked as its own k and the ends were
+                //checked above. Kept as a long so that a NaN can't wrap round to a valid index
+                long CkIndexRaw = lround(Ck[j] * (nIV - 1));
+
+                //Rather than branching out of the loop, clamp the lookup to the table
+                //and remember that this simulation has gone bad
+                unstable[j] |= CkIndexRaw < 0 || CkIndexRaw >= nIV;
+                int CkIndex = CkIndexRaw < 0 ? 0 : (CkIndexRaw >= nIV ? nIV - 1 : (int)CkIndexRaw);
+
+                double cvf = cvFactors[j];
+                double r = rValues[j];
+
+                //Same central/one-sided difference as calc_simulation, on the scaled D
+                int dLeftIndex = CkIndex == 0 ? CkIndex : CkIndex - 1;
+                int dRightIndex = CkIndex == (nIV - 1) ? CkIndex : CkIndex + 1;
+
+                double Dv = Dvector[CkIndex] * cvf;
+                double Rv = Rvector[CkIndex];
+                double dDdc = (Dvector[dRightIndex] * cvf - Dvector[dLeftIndex] * cvf) /
+                              (dRightIndex - dLeftIndex) * (nIV - 1);
+                double dRdc = dRvector[CkIndex];
+
+                double C = Ck[j];
+                double dCdx = (Ckp1[j] - Ck[j]) / dx;
+                double d2Cdx2 = (Ckp1[j] - 2 * Ck[j] + Ckm1[j]) / (dx * dx);
+
+                out[j] = dt * (Dv*d2Cdx2 + dDdc*dCdx*dCdx - dDdc*dCdx*C*Rv*r - Dv*Rv*dCdx*r
+                               -Dv*dRdc*dCdx*C*r) + C;
+            }
+        }
+
+        //swap buffers rather than copying; the boundary rows are the same in both
+        double* tmp = prevStep;
+        prevStep = nextStep;
+        nextStep = tmp;
+    }
+
+    //transpose back into one contiguous profile per simulation
+    for (int j = 0; j < nSims; j++)
+    {
+        simStatus[j] = unstable[j] ? SIM_UNSTABLE : SIM_SUCCESS;
+        for (int k = 0; k < ndx; k++)
+            simResults[j * ndx + k] = prevStep[k * nSims + j];
+    }
+
+    free(prevStep);
+    free(nextStep);
+    free(dRvector);
+    free(unstable);
+    return SIM_SUCCESS;
+}
+
+//Scratch space for the tridiagonal solve in implicit_step
+typedef struct
+{
+    double* lower;
+    double* diag;
+    double* upper;
+    double* rhs;
+} tridiag_workspace;
+
+static int alloc_tridiag_workspace(tridiag_workspace* ws, int ndx)
+{
+    ws->lower = (double*)malloc(sizeof(double) * ndx);
+    ws->diag = (double*)malloc(sizeof(double) * ndx);
+    ws->upper = (double*)malloc(sizeof(double) * ndx);
+    ws->rhs = (double*)malloc(sizeof(double) * ndx);
+    return ws->lower && ws->diag && ws->upper && ws->rhs;
+}
+
+static void free_tridiag_workspace(tridiag_workspace* ws)
+{
+    free(ws->lower);
+    free(ws->diag);
+    free(ws->upper);
+    free(ws->rhs);
+}
+
+//Advances prevStep by one timestep into nextStep with the theta scheme
+//(theta = 0.5 is Crank-Nicolson, theta = 1 is fully implicit/backward Euler).
+//D(c) and R(c) are linearised about the previous step, so each step is a
+//linear tridiagonal solve:
+//  (I - theta*dt*L) c[n+1] = (I + (1-theta)*dt*L) c[n]
+//with L c = D c'' + a c', a = dD/dc c' - r (dD/dc C R + D R + D dR/dc C),
+//and a taken from the previous step with the forward difference calc_simulation uses.
+//a c' carries c towards -x when a > 0, so it is differenced upwind: forward when
+//a >= 0 (as calc_simulation has it) and backward when a < 0. The backward
+//coefficient is scaled by the ratio of the two differences at the previous step,
+//so L applied to the previous step gives exactly calc_simulation's rates and the
+//two schemes agree as dt goes to 0; only at a local extremum, where the ratio is
+//negative, is it plain upwinding. Either way no off-diagonal of L is negative, so
+//for theta = 1 the matrix is an M-matrix and the new step can't overshoot the old
+//one however large dt is. (A forward difference with a < 0 makes the c[k+1]
+//coefficient negative at a sharp interface, and the solution then overshoots [0,1]
+//once dt is much past the explicit limit.)
+//The first and last entries of prevStep are held fixed. Returns SIM_UNSTABLE if
+//any concentration, or Crank-Nicolson's explicit half step, rounds to outside the
+//tables, exactly as explicit_rates does
+static int implicit_step(const double* Dvector,
+                         const double* Rvector,
+                         int nIV,
+                         const double* prevStep,
+                         double* nextStep,
+                         int ndx,
+                         double dt, double dx,
+                         double r,
+                         double theta,
+                         tridiag_workspace* ws)
+{
+    double* lower = ws->lower;
+    double* diag = ws->diag;
+    double* upper = ws->upper;
+    double* rhs = ws->rhs;
+
+    //boundary rows are just c = boundary value
+    lower[0] = 0;
+    diag[0] = 1;
+    upper[0] = 0;
+    rhs[0] = prevStep[0];
+    lower[ndx-1] = 0;
+    diag[ndx-1] = 1;
+    upper[ndx-1] = 0;
+    rhs[ndx-1] = prevStep[ndx-1];
+
+    //build the system over space
+    for (int k = 1; k < ndx - 1; k++)
+    {
+        long CkIndex = lround(prevStep[k] * (nIV - 1));
+        if (CkIndex < 0 || CkIndex >= nIV)
+            return SIM_UNSTABLE;
+
+        //Indicies for calculating either central, left or right difference derivative of dDdc/dRdc;
+        //Central unless we have C = 0 or C = 1
+        int dLeftIndex = CkIndex == 0 ? CkIndex : CkIndex - 1;
+        int dRightIndex = CkIndex == (nIV - 1) ? CkIndex : CkIndex + 1;
+
+        double dDdc = (Dvector[dRightIndex] - Dvector[dLeftIndex]) /
+                    (dRightIndex - dLeftIndex) * (nIV - 1);
+        double dRdc = (Rvector[dRightIndex] - Rvector[dLeftIndex]) /
+                    (dRightIndex - dLeftIndex) * (nIV - 1);
+        double Dv = Dvector[CkIndex];
+        double Rv = Rvector[CkIndex];
+
+        double C = prevStep[k];
+        double forward = prevStep[k+1] - prevStep[k];
+        double backward = prevStep[k] - prevStep[k-1];
+        double a = dDdc*forward/dx - dDdc*C*Rv*r - Dv*Rv*r - Dv*dRdc*C*r;
+
+        //coefficients of c[k-1] and c[k+1] in the linearised operator; c'' first...
+        double Lm1 = Dv / (dx * dx);
+        double Lp1 = Dv / (dx * dx);
+
+        //...then a c', upwinded
+        if (a >= 0)
+            Lp1 += a / dx;
+        else if (forward * backward > 0)
+            Lm1 -= a / dx * forward / backward;
+        else
+            Lm1 -= a / dx;
+        double L0 = -Lm1 - Lp1;
+
+        lower[k] = -theta * dt * Lm1;
+        diag[k] = 1 - theta * dt * L0;
+        upper[k] = -theta * dt * Lp1;
+        rhs[k] = prevStep[k] + (1 - theta) * dt *
+                 (Lm1 * prevStep[k-1] + L0 * prevStep[k] + Lp1 * prevStep[k+1]);
+
+        //the explicit half of Crank-Nicolson has much the same limit on dt as calc_simulation;
+        //past it this is where the step first goes wrong. !(x >= 0) also catches NaN
+        double u = rhs[k] * (nIV - 1);
+        if (!(u >= -0.5 && u < nIV - 0.5))
+            return SIM_UNSTABLE;
+    }
+
+    //Thomas algorithm: forward sweep...
+    for (int k = 1; k < ndx; k++)
+    {
+        double m = lower[k] / diag[k-1];
+        diag[k] -= m * upper[k-1];
+        rhs[k] -= m * rhs[k-1];
+    }
+
+    //...and back substitution
+    nextStep[ndx-1] = rhs[ndx-1] / diag[ndx-1];
+    for (int k = ndx - 2; k >= 0; k--)
+        nextStep[k] = (rhs[k] - upper[k] * nextStep[k+1]) / diag[k];
+
+    //Anything outside the tables is reported the same way as in the explicit kernels,
+    //rather than being handed back as a result
+    for (int k = 0; k < ndx; k++)
+    {
+        double u = nextStep[k] * (nIV - 1);
+        if (!(u >= -0.5 && u < nIV - 0.5))
+            return SIM_UNSTABLE;
+    }
+
+    return SIM_SUCCESS;
+}
+
+//As explicit_rates, but D, R, dD/dc and dR/dc all come from tables read with linear
+//interpolation rather than rounded to the nearest entry, so the rates are continuous in
+//the concentrations. D and dD/dc are scaled by cvFactor. Returns SIM_UNSTABLE if any
+//concentration is more than half an entry outside the tables, as lround() would have it
+static int interp_rates(const double* Dvector,
+                        const double* Rvector,
+                        const double* dDvector,
+                        const double* dRvector,
+                        int nIV,
+                        const double* prevStep,
+                        int ndx, double dx,
+                        double r,
+                        double cvFactor,
+                        double* rates)
+{
+    double cMax = nIV - 1;
+    int unstable = 0;
+
+    //loop over space
+    for (int k = 1; k < ndx - 1; k++)
+    {
+        //position in the tables; !(u >= -0.5) also catches NaN
+        double u = prevStep[k] * cMax;
+        unstable |= !(u >= -0.5 && u <= cMax + 0.5);
+        u = u < 0 ? 0 : (u > cMax ? cMax : u);
+        int i = (int)u;
+        i = i > nIV - 2 ? nIV - 2 : i;
+        double frac = u - i;
+
+        double Dv = cvFactor * (Dvector[i] + frac * (Dvector[i+1] - Dvector[i]));
+        double Rv = Rvector[i] + frac * (Rvector[i+1] - Rvector[i]);
+        double dDdc = cvFactor * (dDvector[i] + frac * (dDvector[i+1] - dDvector[i]));
+        double dRdc = dRvector[i] + frac * (dRvector[i+1] - dRvector[i]);
+
+        //Concentrations and derivatives thereof
+        double C = prevStep[k];
+        double dCdx = (prevStep[k+1] - prevStep[k]) / dx;
+        double d2Cdx2 = (prevStep[k+1] - 2 * prevStep[k] + prevStep[k-1]) / (dx * dx);
+
+        rates[k] = Dv*d2Cdx2 + dDdc*dCdx*dCdx - dDdc*dCdx*C*Rv*r - Dv*Rv*dCdx*r
+                   -Dv*dRdc*dCdx*C*r;
+    }
+
+    return unstable ? SIM_UNSTABLE : SIM_SUCCESS;
+}
+
+//Advances prevStep by one explicit timestep into nextStep, holding the ends fixed.
+//x is the mesh as for explicit_rates
+static int explicit_step(const double* Dvector,
+                         const double* Rvector,
+                         int nIV,
+                         const double* prevStep,
+                         double* nextStep,
+                         int ndx,
+                         double dt, double dx,
+                         const double* x,
+                         double r)
+{
+    nextStep[0] = prevStep[0];
+    nextStep[ndx-1] = prevStep[ndx-1];
+
+    if (explicit_rates(Dvector, Rvector, nIV, prevStep, ndx, dx, x, r, nextStep) != SIM_SUCCESS)
+        return SIM_UNSTABLE;
+
+    for (int k = 1; k < ndx - 1; k++)
+        nextStep[k] = dt * nextStep[k] + prevStep[k];
+
+    return SIM_SUCCESS;
+}
+
+int calc_simulation_implicit(const double* Dvector,
+                             const double* Rvector,
+                             int nIV,
+                             const double* initCond,
+                             int ndt, int ndx,
+                             double dt, double dx,
+                             double r,
+                             double theta,
+                             double* simResults)
+{
+    int simStorageBytes = sizeof(double) * ndx;
+    double* prevStep = (double*)malloc(simStorageBytes);
+    tridiag_workspace ws;
+
+    if (!alloc_tridiag_workspace(&ws, ndx) || !prevStep)
+    {
+        free(prevStep);
+        free_tridiag_workspace(&ws);
+        return SIM_UNSTABLE;
+    }
+
+    memcpy(prevStep, initCond, simStorageBytes);
+
+    //loop in time
+    for (int n = 0; n < ndt; n++)
+    {
+        if (implicit_step(Dvector, Rvector, nIV, prevStep, simResults,
+                          ndx, dt, dx, r, theta, &ws) != SIM_SUCCESS)
+        {
+            free(prevStep);
+            free_tridiag_workspace(&ws);
+            return SIM_UNSTABLE;
+        }
+
+        //Now swap current step into prev step
+        memcpy(prevStep, simResults, simStorageBytes);
+    }
+
+    free(prevStep);
+    free_tridiag_workspace(&ws);
+    return SIM_SUCCESS;
+}
+
+int calc_simulation_snapshots(const double* Dvector,
+                              const double* Rvector,
+                              int nIV,
+                              const double* initCond,
+                              int ndx,
+                              double dt, double dx,
+                              double r,
+                              double theta,
+                              const int* snapSteps,
+                              int nSnaps,
+                              double* snapResults)
+{
+    //Runs a single simulation, copying the profile into row i of the
+    //(nSnaps, ndx) snapResults buffer once snapSteps[i] steps have been taken.
+    //snapSteps must be in non-decreasing order. theta = 0 uses the explicit
+    //kernel from calc_simulation; anything else uses implicit_step
+    int simStorageBytes = sizeof(double) * ndx;
+    double* prevStep = (double*)malloc(simStorageBytes);
+    double* nextStep = (double*)malloc(simStorageBytes);
+    tridiag_workspace ws;
+    int res = SIM_SUCCESS;
+
+    if (!alloc_tridiag_workspace(&ws, ndx) || !prevStep || !nextStep)
+    {
+        free(prevStep);
+        free(nextStep);
+        free_tridiag_workspace(&ws);
+        return SIM_UNSTABLE;
+    }
+
+    memcpy(prevStep, initCond, simStorageBytes);
+
+    int n = 0;
+    for (int i = 0; i < nSnaps && res == SIM_SUCCESS; i++)
+    {
+        //loop in time up to the next snapshot
+        for (; n < snapSteps[i]; n++)
+        {
+            if (theta == 0)
+                res = explicit_step(Dvector, Rvector, nIV, prevStep, nextStep, ndx, dt, dx, NULL, r);
+            else
+                res = implicit_step(Dvector, Rvector, nIV, prevStep, nextStep, ndx, dt, dx, r, theta, &ws);
+            if (res != SIM_SUCCESS)
+                break;
+
+            //swap pointers rather than copying
+            double* tmp = prevStep;
+            prevStep = nextStep;
+            nextStep = tmp;
+        }
+
+        if (res == SIM_SUCCESS)
+            memcpy(snapResults + (size_t)i * ndx, prevStep, simStorageBytes);
+    }
+
+    free(prevStep);
+    free(nextStep);
+    free_tridiag_workspace(&ws);
+    return res;
+}
+
+int calc_simulation_adaptive(const double* Dvector,
+                             const double* Rvector,
+                             int nIV,
+                             const double* initCond,
+                             int ndx,
+                             double tmax, double dtInit, double dtMin, double dtMax,
+                             double dx,
+                             double r,
+                             double tol,
+                             int maxSteps,
+                             double* simResults,
+                             int* stepsTaken)
+{
+    //Heun/Euler embedded pair: the difference between the Euler and Heun
+    //updates, dt/2 * (k2 - k1), estimates the local error of the Euler step.
+    //Steps with max-norm error above tol are rejected and retried smaller;
+    //dt never grows past dtMax, which the caller sets from the stability bound.
+    //
+    //The rates come from interp_rates, with dD/dc and dR/dc tabulated by the
+    //same differences calc_simulation takes, so they are continuous in C. With
+    //nearest entry lookups they jump wherever a concentration crosses from one
+    //entry to the next, and most of all where D is held flat at the edges of the
+    //data and dD/dc drops to 0. The point at the interface sits on such a jump
+    //for much of an anneal, flipping between two rates of opposite sign, and no
+    //dt is small enough to make the estimate meet tol there.
+    //
+    //Steps are never made smaller than dtMin, and a step of dtMin is taken
+    //whatever its estimated error, as a fixed-step run at dtMin would take it,
+    //so the run always finishes unless the profile leaves the tables. More than
+    //maxSteps attempts is reported as SIM_UNSTABLE, as is leaving the tables
+    //on a step of dtMin
+    int simStorageBytes = sizeof(double) * ndx;
+    double* k1 = (double*)calloc(ndx, sizeof(double));
+    double* k2 = (double*)calloc(ndx, sizeof(double));
+    double* eulerStep = (double*)malloc(simStorageBytes);
+    double* dDvector = (double*)malloc(sizeof(double) * nIV);
+    double* dRvector = (double*)malloc(sizeof(double) * nIV);
+
+    if (!k1 || !k2 || !eulerStep || !dDvector || !dRvector || nIV < 2)
+    {
+        free(k1);
+        free(k2);
+        free(eulerStep);
+        free(dDvector);
+        free(dRvector);
+        return SIM_UNSTABLE;
+    }
+
+    for (int i = 0; i < nIV; i++)
+    {
+        //Central difference unless we have C = 0 or C = 1, exactly as calc_simulation does
+        int dLeftIndex = i == 0 ? i : i - 1;
+        int dRightIndex = i == (nIV - 1) ? i : i + 1;
+        dDvector[i] = (Dvector[dRightIndex] - Dvector[dLeftIndex]) / (dRightIndex - dLeftIndex) * (nIV - 1);
+        dRvector[i] = (Rvector[dRightIndex] - Rvector[dLeftIndex]) / (dRightIndex - dLeftIndex) * (nIV - 1);
+    }
+
+    memcpy(simResults, initCond, simStorageBytes);
+    memcpy(eulerStep, initCond, simStorageBytes);
+
+    double t = 0;
+    if (dtMin > dtMax)
+        dtMin = dtMax;
+    double dt = dtInit < dtMax ? dtInit : dtMax;
+    dt = dt > dtMin ? dt : dtMin;
+    int accepted = 0;
+    int attempted = 0;
+    int res = SIM_SUCCESS;
+
+    while (t < tmax)
+    {
+        if (++attempted > maxSteps)
+        {
+            res = SIM_UNSTABLE;
+            break;
+        }
+
+        int lastStep = t + dt >= tmax;
+        if (lastStep)
+            dt = tmax - t;
+
+        if (interp_rates(Dvector, Rvector, dDvector, dRvector, nIV, simResults, ndx, dx, r, 1.0,
+                         k1) != SIM_SUCCESS)
+        {
+            res = SIM_UNSTABLE;
+            break;
+        }
+
+        for (int k = 1; k < ndx - 1; k++)
+            eulerStep[k] = simResults[k] + dt * k1[k];
+
+        //an Euler step that leaves the tables counts as a rejected step, not a blowup
+        double err;
+        if (interp_rates(Dvector, Rvector, dDvector, dRvector, nIV, eulerStep, ndx, dx, r, 1.0,
+                         k2) != SIM_SUCCESS)
+        {
+            err = INFINITY;
+        }
+        else
+        {
+            err = 0;
+            for (int k = 1; k < ndx - 1; k++)
+            {
+                double localErr = fabs(0.5 * dt * (k2[k] - k1[k]));
+                if (localErr > err)
+                    err = localErr;
+            }
+        }
+
+        int floored = dt <= dtMin;
+        if (err <= tol || (floored && isfinite(err)))
+        {
+            //accept, taking the (second order) Heun update
+            for (int k = 1; k < ndx - 1; k++)
+                simResults[k] += 0.5 * dt * (k1[k] + k2[k]);
+            t = lastStep ? tmax : t + dt;
+            accepted++;
+        }
+        else if (floored)
+        {
+            res = SIM_UNSTABLE;
+            break;
+        }
+
+        //first order error estimate => error goes like dt^2
+        double factor = err > 0 ? 0.9 * sqrt(tol / err) : 5.0;
+        if (factor > 5.0)
+            factor = 5.0;
+        else if (factor < 0.2)
+            factor = 0.2;
+        dt *= factor;
+        dt = dt > dtMax ? dtMax : (dt < dtMin ? dtMin : dt);
+    }
+
+    *stepsTaken = accepted;
+    free(k1);
+    free(k2);
+    free(eulerStep);
+    free(dDvector);
+    free(dRvector);
+    return res;
+}
+
+int calc_simulation_interp(const double* Dvector,
+                           const double* Rvector,
+                           const double* dDvector,
+                           const double* dRvector,
+                           int nIV,
+                           const double* initCond,
+                           int ndt, int ndx,
+                           double dt, double dx,
+                           double r,
+                           double cvFactor,
+                           double* simResults)
+{
+    //Same equation as calc_simulation, but D, R, dD/dc and dR/dc all come from
+    //precomputed tables, read with linear interpolation rather than rounded to
+    //the nearest entry (see interp_rates). That takes the derivative work out of
+    //the inner loop and lets the tables be much smaller for the same accuracy.
+    //cvFactor scales D and dD/dc here rather than in a copy of the tables
+    int simStorageBytes = sizeof(double) * ndx;
+    double* prevStep = (double*)malloc(simStorageBytes);
+    double* nextStep = simResults;
+    if (!prevStep)
+        return SIM_UNSTABLE;
+    memcpy(prevStep, initCond, simStorageBytes);
+
+    //constant composition boundary conditions
+    nextStep[0] = initCond[0];
+    nextStep[ndx-1] = initCond[ndx-1];
+
+    //loop in time
+    for (int n = 0; n < ndt; n++)
+    {
+        //rates go straight into nextStep, and then get turned into the next step
+        if (interp_rates(Dvector, Rvector, dDvector, dRvector, nIV, prevStep, ndx, dx, r, cvFactor,
+                         nextStep) != SIM_SUCCESS)
+        {
+            free(prevStep);
+            return SIM_UNSTABLE;
+        }
+        for (int k = 1; k < ndx - 1; k++)
+            nextStep[k] = dt * nextStep[k] + prevStep[k];
+
+        //Now swap current step into prev step
+        memcpy(prevStep, nextStep, simStorageBytes);
+    }
+
+    free(prevStep);
+    return SIM_SUCCESS;
+}
+
+int calc_simulation_converge(const double* Dvector,
+                             const double* Rvector,
+                             int nIV,
+                             const double* initCond,
+                             int ndt, int ndx,
+                             double dt, double dx,
+                             double r,
+                             double theta,
+                             double tol,
+                             int checkEvery,
+                             double* simResults,
+                             int* stepsTaken)
+{
+    //Runs up to ndt steps like calc_simulation/calc_simulation_implicit
+    //(theta = 0 is explicit), but every checkEvery steps compares the profile
+    //with the one from the previous check and stops as soon as the largest
+    //change is below tol, i.e. once the profile has reached a steady state
+    int simStorageBytes = sizeof(double) * ndx;
+    double* prevStep = (double*)malloc(simStorageBytes);
+    double* nextStep = (double*)malloc(simStorageBytes);
+    double* lastCheck = (double*)malloc(simStorageBytes);
+    tridiag_workspace ws;
+    int res = SIM_SUCCESS;
+
+    if (!alloc_tridiag_workspace(&ws, ndx) || !prevStep || !nextStep || !lastCheck)
+    {
+        free(prevStep);
+        free(nextStep);
+        free(lastCheck);
+        free_tridiag_workspace(&ws);
+        return SIM_UNSTABLE;
+    }
+
+    if (checkEvery < 1)
+        checkEvery = 1;
+
+    memcpy(prevStep, initCond, simStorageBytes);
+    memcpy(lastCheck, initCond, simStorageBytes);
+
+    int n = 0;
+    while (n < ndt)
+    {
+        if (theta == 0)
+            res = explicit_step(Dvector, Rvector, nIV, prevStep, nextStep, ndx, dt, dx, NULL, r);
+        else
+            res = implicit_step(Dvector, Rvector, nIV, prevStep, nextStep, ndx, dt, dx, r, theta, &ws);
+        if (res != SIM_SUCCESS)
+            break;
+
+        //swap pointers rather than copying
+        double* tmp = prevStep;
+        prevStep = nextStep;
+        nextStep = tmp;
+        n++;
+
+        if (n % checkEvery == 0)
+        {
+            double change = 0;
+            for (int k = 0; k < ndx; k++)
+            {
+                double diff = fabs(prevStep[k] - lastCheck[k]);
+                if (diff > change)
+                    change = diff;
+            }
+            if (change < tol)
+                break;
+            memcpy(lastCheck, prevStep, simStorageBytes);
+        }
+    }
+
+    memcpy(simResults, prevStep, simStorageBytes);
+    *stepsTaken = n;
+
+    free(prevStep);
+    free(nextStep);
+    free(lastCheck);
+    free_tridiag_workspace(&ws);
+    return res;
+}
+
+int calc_simulation_mesh(const double* Dvector,
+                         const double* Rvector,
+                         int nIV,
+                         const double* initCond,
+                         int ndt, int ndx,
+                         const double* x,
+                         double dt,
+                         double r,
+                         double* simResults)
+{
+    //Explicit scheme as calc_simulation, but on the non-uniform mesh x (ndx node
+    //positions, increasing). dt has to be stable for the smallest cell
+    int simStorageBytes = sizeof(double) * ndx;
+    double* prevStep = (double*)malloc(simStorageBytes);
+    double* nextStep = (double*)malloc(simStorageBytes);
+    int res = SIM_SUCCESS;
+
+    if (!prevStep || !nextStep)
+    {
+        free(prevStep);
+        free(nextStep);
+        return SIM_UNSTABLE;
+    }
+
+    memcpy(prevStep, initCond, simStorageBytes);
+
+    for (int n = 0; n < ndt; n++)
+    {
+        res = explicit_step(Dvector, Rvector, nIV, prevStep, nextStep, ndx, dt, 0, x, r);
+        if (res != SIM_SUCCESS)
+            break;
+
+        double* tmp = prevStep;
+        prevStep = nextStep;
+        nextStep = tmp;
+    }
+
+    memcpy(simResults, prevStep, simStorageBytes);
+    free(prevStep);
+    free(nextStep);
+    return res;
+}
+
+//Runs up to nSteps explicit timesteps on the tile [lo, hi) of a grid of ndx points,
+//starting from prevStep (the whole grid) and writing the tile of the final step into
+//tileOut. The tile is loaded with nSteps extra points either side, which go stale one
+//point per step, so the tile itself stays exact without any communication with its
+//neighbours. local0/local1 need room for hi - lo + 2 * nSteps points
+static int blocked_tile_steps(const double* Dvector,
+                              const double* Rvector,
+                              int nIV,
+                              const double* prevStep,
+                              int ndx, int lo, int hi,
+                              int nSteps,
+                              double dt, double dx,
+                              double r,
+                              double* local0, double* local1,
+                              double* tileOut)
+{
+    int elo = lo - nSteps < 0 ? 0 : lo - nSteps;
+    int ehi = hi + nSteps > ndx ? ndx : hi + nSteps;
+    double* cur = local0;
+    double* nxt = local1;
+
+    //local index i holds global point elo + i; [vlo, vhi) is the part that is still exact
+    memcpy(cur, prevStep + elo, sizeof(double) * (ehi - elo));
+    int vlo = elo;
+    int vhi = ehi;
+
+    for (int s = 0; s < nSteps; s++)
+    {
+        //the ends of the grid are fixed, everywhere else loses a point per step
+        int nlo = vlo == 0 ? 0 : vlo + 1;
+        int nhi = vhi == ndx ? ndx : vhi - 1;
+        int kFrom = nlo < 1 ? 1 : nlo;
+        int kTo = nhi > ndx - 1 ? ndx - 1 : nhi;
+
+        if (nlo == 0)
+            nxt[0 - elo] = cur[0 - elo];
+        if (nhi == ndx)
+            nxt[ndx - 1 - elo] = cur[ndx - 1 - elo];
+
+        //explicit_rates works on k = 1..len-2 of whatever it is given, so hand it [kFrom-1, kTo]
+        int offset = kFrom - 1 - elo;
+        if (explicit_rates(Dvector, Rvector, nIV, cur + offset, kTo - kFrom + 2, dx, NULL, r,
+                           nxt + offset) != SIM_SUCCESS)
+            return SIM_UNSTABLE;
+        for (int k = kFrom - elo; k < kTo - elo; k++)
+            nxt[k] = dt * nxt[k] + cur[k];
+
+        double* tmp = cur;
+        cur = nxt;
+        nxt = tmp;
+        vlo = nlo;
+        vhi = nhi;
+    }
+
+    memcpy(tileOut, cur + (lo - elo), sizeof(double) * (hi - lo));
+    return SIM_SUCCESS;
+}
+
+int calc_simulation_parallel(const double* Dvector,
+                             const double* Rvector,
+                             int nIV,
+                             const double* initCond,
+                             int ndt, int ndx,
+                             double dt, double dx,
+                             double r,
+                             int nThreads,
+                             int blockSteps,
+                             int tileWidth,
+                             double* simResults)
+{
+    //Same result as calc_simulation, for large grids. The grid is cut into tiles of
+    //tileWidth points that are shared out between nThreads threads (0 for the OpenMP
+    //default), and each tile is advanced blockSteps timesteps at a time while it is in
+    //cache (see blocked_tile_steps). Whole grids are only exchanged between blocks,
+    //by swapping pointers
+    if (blockSteps < 1)
+        blockSteps = 1;
+    if (tileWidth < 1)
+        tileWidth = ndx;
+
+    int simStorageBytes = sizeof(double) * ndx;
+    double* prevStep = (double*)malloc(simStorageBytes);
+    double* nextStep = (double*)malloc(simStorageBytes);
+    if (!prevStep || !nextStep)
+    {
+        free(prevStep);
+        free(nextStep);
+        return SIM_UNSTABLE;
+    }
+    memcpy(prevStep, initCond, simStorageBytes);
+
+    int nTiles = (ndx + tileWidth - 1) / tileWidth;
+    int localSize = tileWidth + 2 * blockSteps;
+    int res = SIM_SUCCESS;
+
+#ifdef _OPENMP
+    if (nThreads < 1)
+        nThreads = omp_get_max_threads();
+#else
+    nThreads = 1;
+#endif
+
+    //two tile buffers per thread, allocated once for the whole run
+    double* scratch = (double*)malloc(sizeof(double) * 2 * localSize * nThreads);
+    if (!scratch)
+    {
+        free(prevStep);
+        free(nextStep);
+        return SIM_UNSTABLE;
+    }
+
+    for (int n = 0; n < ndt && res == SIM_SUCCESS; n += blockSteps)
+    {
+        int nSteps = ndt - n < blockSteps ? ndt - n : blockSteps;
+        int unstable = 0;
+
+        #pragma omp parallel for num_threads(nThreads) schedule(static) reduction(|:unstable)
+        for (int t = 0; t < nTiles; t++)
+        {
+#ifdef _OPENMP
+            double* local0 = scratch + 2 * localSize * omp_get_thread_num();
+#else
+            double* local0 = scratch;
+#endif
+            int lo = t * tileWidth;
+            int hi = lo + tileWidth > ndx ? ndx : lo + tileWidth;
+            if (blocked_tile_steps(Dvector, Rvector, nIV, prevStep, ndx, lo, hi, nSteps, dt, dx, r,
+                                   local0, local0 + localSize, nextStep + lo) != SIM_SUCCESS)
+                unstable = 1;
+        }
+
+        if (unstable)
+            res = SIM_UNSTABLE;
+        else
+        {
+            double* tmp = prevStep;
+            prevStep = nextStep;
+            nextStep = tmp;
+        }
+    }
+
+    memcpy(simResults, prevStep, simStorageBytes);
+    free(scratch);
+    free(prevStep);
+    free(nextStep);
+    return res;
+}
+
+int calc_simulation_prepared(const double* Dvector,
+                             const double* Rvector,
+                             int nIV,
+                             const double* initCond,
+                             int ndt, int ndx,
+                             double dt, double dx,
+                             double r,
+                             double cvFactor,
+                             double* scratch,
+                             double* simResults)
+{
+    //calc_simulation for callers that keep their buffers between runs: nothing is
+    //allocated here. Dvector is the unscaled table; the rates are linear in D and
+    //dD/dc, so cvFactor just scales dt. scratch needs room for ndx points and the
+    //two buffers take turns holding the current step
+    int simStorageBytes = sizeof(double) * ndx;
+    double* prevStep = scratch;
+    double* nextStep = simResults;
+    double dtScaled = dt * cvFactor;
+
+    memcpy(prevStep, initCond, simStorageBytes);
+
+    //constant composition boundary conditions; both buffers keep them from here on
+    nextStep[0] = prevStep[0];
+    nextStep[ndx-1] = prevStep[ndx-1];
+
+    for (int n = 0; n < ndt; n++)
+    {
+        if (explicit_rates(Dvector, Rvector, nIV, prevStep, ndx, dx, NULL, r, nextStep) != SIM_SUCCESS)
+            return SIM_UNSTABLE;
+
+        for (int k = 1; k < ndx - 1; k++)
+            nextStep[k] = dtScaled * nextStep[k] + prevStep[k];
+
+        double* tmp = prevStep;
+        prevStep = nextStep;
+        nextStep = tmp;
+    }
+
+    if (prevStep != simResults)
+        memcpy(simResults, prevStep, simStorageBytes);
+    return SIM_SUCCESS;
+}
 
-            //This tells us if our previous concentrations were outside [0,1]
-            //and hence if we're about to dereference garbage
+int calc_simulation_sensitivity(const double* Dvector,
+                                const double* Rvector,
+                                int nIV,
+                                const double* initCond,
+                                int ndt, int ndx,
+                                double dt, double dx,
+                                double r,
+                                double cvFactor,
+                                double* simResults,
+                                double* dCdr,
+                                double* dCdcvf)
+{
+    //calc_simulation_prepared's explicit scheme, integrating the tangent-linear equations for
+    //dC/dr and dC/dcvFactor in the same timestep loop. Dvector is the unscaled table, so each
+    //step is C += dt * cvFactor * g(C, r) and the sensitivities follow
+    //  S_r += dt * cvFactor * (J S_r + dg/dr)
+    //  S_cvf += dt * (cvFactor * J S_cvf + g)
+    //where J is the (tridiagonal) Jacobian of g with respect to C. D and R are differentiated as
+    //smooth functions of C, with second derivatives from the tables, rather than as the nearest
+    //entry lookups the forward scheme uses, which would make them piecewise constant.
+    //
+    //Datastore tables are piecewise linear, and held flat at the edges of the data, so a second
+    //difference over neighbouring entries is 0 almost everywhere and spikes at the corners. At a
+    //sharp interface the spikes make the tangent-linear steps unstable, and the sensitivities
+    //blow up, so the second differences are taken over 5% of the concentration range instead
+    int simStorageBytes = sizeof(double) * ndx;
+    double* prevStep = (double*)malloc(simStorageBytes);
+    double* prevSr = (double*)malloc(simStorageBytes);
+    double* prevScvf = (double*)malloc(simStorageBytes);
+    if (!prevStep || !prevSr || !prevScvf)
+    {
+        free(prevStep);
+        free(prevSr);
+        free(prevScvf);
+        return SIM_UNSTABLE;
+    }
+
+    memcpy(prevStep, initCond, simStorageBytes);
+    memset(prevSr, 0, simStorageBytes);
+    memset(prevScvf, 0, simStorageBytes);
+    double dtScaled = dt * cvFactor;
+    double tableScale = nIV - 1;
+    int curvatureSpan = (nIV - 1) / 20 > 1 ? (nIV - 1) / 20 : 1;
+
+    //the boundaries are fixed, so they don't depend on either parameter
+    simResults[0] = prevStep[0];
+    simResults[ndx-1] = prevStep[ndx-1];
+    dCdr[0] = dCdr[ndx-1] = 0;
+    dCdcvf[0] = dCdcvf[ndx-1] = 0;
+
+    for (int n = 0; n < ndt; n++)
+    {
+        for (int k = 1; k < ndx - 1; k++)
+        {
+            int Ckm1Index = lround(prevStep[k-1] * tableScale);
+            int CkIndex = lround(prevStep[k] * tableScale);
+            int Ckp1Index = lround(prevStep[k+1] * tableScale);
             if (Ckm1Index < 0 || CkIndex < 0 || Ckp1Index < 0 ||
                 Ckm1Index >= nIV || CkIndex >= nIV || Ckp1Index >= nIV)
             {
                 free(prevStep);
+                free(prevSr);
+                free(prevScvf);
                 return SIM_UNSTABLE;
             }
 
-            //Indicies for calculating either central, left or right difference derivative of dDdc/dRdc;
-            //Central unless we have C = 0 or C = 1
+            //first derivatives exactly as explicit_rates has them
             int dLeftIndex = CkIndex == 0 ? CkIndex : CkIndex - 1;
             int dRightIndex = CkIndex == (nIV - 1) ? CkIndex : CkIndex + 1;
-
-            //Calculate derivatives based on these indicies
-            //Multiply by nIV-1 to turn indicies into units of concentration
             double dDdc = (Dvector[dRightIndex] - Dvector[dLeftIndex]) /
-                        (dRightIndex - dLeftIndex) * (nIV - 1);
+                        (dRightIndex - dLeftIndex) * tableScale;
             double dRdc = (Rvector[dRightIndex] - Rvector[dLeftIndex]) /
-                        (dRightIndex - dLeftIndex) * (nIV - 1);
+                        (dRightIndex - dLeftIndex) * tableScale;
+
+            //second derivatives over curvatureSpan entries either side, or as many as there are
+            //before the end of the tables; taken as zero on the ends themselves
+            int span = curvatureSpan;
+            span = CkIndex < span ? CkIndex : span;
+            span = nIV - 1 - CkIndex < span ? nIV - 1 - CkIndex : span;
+            double d2Ddc2 = 0, d2Rdc2 = 0;
+            if (span > 0)
+            {
+                double curvatureScale = tableScale * tableScale / (span * span);
+                d2Ddc2 = (Dvector[CkIndex+span] - 2 * Dvector[CkIndex] + Dvector[CkIndex-span]) * curvatureScale;
+                d2Rdc2 = (Rvector[CkIndex+span] - 2 * Rvector[CkIndex] + Rvector[CkIndex-span]) * curvatureScale;
+            }
 
-            //Current values of D and R
             double Dv = Dvector[CkIndex];
             double Rv = Rvector[CkIndex];
-
-            //Concentrations and derivatives thereof
             double C = prevStep[k];
             double dCdx = (prevStep[k+1] - prevStep[k]) / dx;
             double d2Cdx2 = (prevStep[k+1] - 2 * prevStep[k] + prevStep[k-1]) / (dx * dx);
 
-            //the next step
-            double simc = dt * (Dv*d2Cdx2 + dDdc*dCdx*dCdx - dDdc*dCdx*C*Rv*r - Dv*Rv*dCdx*r
-                                  -Dv*dRdc*dCdx*C*r) + prevStep[k];
-                                  
-            /*double simc = dt * (Dv*d2Cdx2 + dDdc*dCdx*dCdx - dDdc*C*Rv*r - Dv*Rv*dCdx*r
-                                   -Dv*dRdc*dCdx*r) + prevStep[k];*/           
-            //Smooth out major fuckups in simc; for somereason these are appearing
-            //Probably because dDdC is much bigger with this model
-            /*if (simc > 1.0)
-                simc = 1.0;
-            else if (simc < 0.0)
-                simc = 0.0;*/
-            simResults[k] = simc;
+            double g = Dv*d2Cdx2 + dDdc*dCdx*dCdx - dDdc*dCdx*C*Rv*r - Dv*Rv*dCdx*r
+                       -Dv*dRdc*dCdx*C*r;
+
+            //partial derivatives of g with respect to d2C/dx2, dC/dx, C (through the coefficients
+            //as well as directly) and r
+            double dgdq = Dv;
+            double dgdp = 2*dDdc*dCdx - dDdc*C*Rv*r - Dv*Rv*r - Dv*dRdc*C*r;
+            double dgdC = dDdc*d2Cdx2 + d2Ddc2*dCdx*dCdx
+                          - r*dCdx*(d2Ddc2*C*Rv + dDdc*Rv + dDdc*C*dRdc)
+                          - r*dCdx*(dDdc*Rv + Dv*dRdc)
+                          - r*dCdx*(dDdc*dRdc*C + Dv*d2Rdc2*C + Dv*dRdc);
+            double dgdr = -dCdx*(dDdc*C*Rv + Dv*Rv + Dv*dRdc*C);
+
+            //and so the row of the Jacobian
+            double Jm = dgdq / (dx * dx);
+            double Jp = dgdq / (dx * dx) + dgdp / dx;
+            double J0 = -2 * dgdq / (dx * dx) - dgdp / dx + dgdC;
+
+            double JSr = Jm * prevSr[k-1] + J0 * prevSr[k] + Jp * prevSr[k+1];
+            double JScvf = Jm * prevScvf[k-1] + J0 * prevScvf[k] + Jp * prevScvf[k+1];
+
+            simResults[k] = dtScaled * g + prevStep[k];
+            dCdr[k] = dtScaled * (JSr + dgdr) + prevSr[k];
+            dCdcvf[k] = dtScaled * JScvf + dt * g + prevScvf[k];
         }
 
-        //Now swap current step into prev step
         memcpy(prevStep, simResults, simStorageBytes);
+        memcpy(prevSr, dCdr, simStorageBytes);
+        memcpy(prevScvf, dCdcvf, simStorageBytes);
     }
 
-    //The result is now in memory (simResults); free and return
     free(prevStep);
+    free(prevSr);
+    free(prevScvf);
     return SIM_SUCCESS;
 }
-
@@ -1,27 +1,60 @@
-"""Python ctypes wrapper for calcsim.c
+"""Python wrapper for calcsim.c; the kernels themselves come from one of the backends in simbackends
 """
 import logging
 import numpy as np
 import ctypes
+import threading
+import simbackends
+
+
+#Time integration schemes understood by calc_simulation, mapped to the implicitness
+#factor theta handed to the native code (0 means the explicit kernel). Below, the explicit limit is the largest dt
+#calc_simulation is stable at; with the default 100 point grid over 25 micron and 973K data, about 0.1 s, well
+#under optimum_dt because the sharp interface limits it rather than the largest D. RMS differences are against an
+#explicit run at a tenth of the repo's usual dt = 0.05 s, over a 2 hour anneal
+SIM_SCHEMES = {
+    #the reference; unstable (SimulationUnstableError) past the explicit limit
+    'explicit': 0.0,
+    #stable at any dt, and can't overshoot [0,1]. Within 0.005 RMS up to about 5x the explicit limit and 0.01 up to
+    #about 50x; by 500x (dt = 50 s) it is 0.05-0.1 out, so only use steps that large for a rough first look
+    'implicit': 1.0,
+    #within 0.0025 RMS up to about the explicit limit, but no further: its explicit half has much the same limit,
+    #and past about twice the explicit limit it raises SimulationUnstableError
+    'crank-nicolson': 0.5
+}
+
+#Part of the key of every cached simulation result; bump this whenever a change to the kernels changes their results,
+#so that results from the old kernels aren't reused
+KERNEL_VERSION = 3
 
 
 class CalcSimWrapper:
 
-    def __init__(self):
-        try:
-            self.libcalcsim = ctypes.cdll.LoadLibrary('libcalcsim.so')
-        except OSError:
-            self.libcalcsim = ctypes.cdll.LoadLibrary('./libcalcsim.so')
-
-        self.libcalcsim.calc_simulation.argtypes = [
-            ctypes.POINTER(ctypes.c_double), ctypes.POINTER(ctypes.c_double),
-            ctypes.c_int32, ctypes.POINTER(ctypes.c_double),
-            ctypes.c_int32, ctypes.c_int32, ctypes.c_double, ctypes.c_double,
-            ctypes.c_double, ctypes.POINTER(ctypes.c_double)
-        ]
-        self.libcalcsim.fast_pad_shift.argtypes = [
-            ctypes.POINTER(ctypes.c_double), ctypes.POINTER(ctypes.c_double), ctypes.c_int32
-        ]
+    def __init__(self, backend=None, cache=None):
+        """
+        :param backend: name of the simulation backend to use (a key of simbackends.BACKENDS), or None to use the
+            first one that can be loaded on this host
+        :param cache: optional simcache.SimulationCache; calc_simulation then returns a stored result whenever it
+            is called with exactly the same inputs as before, rather than running the simulation again
+        """
+        self.backend = simbackends.load_backend(backend)
+        self.cache = cache
+
+        #the compiled library, for the modes only it provides; None if the backend doesn't have one
+        self.libcalcsim = self.backend.lib
+
+    def native_library(self, mode):
+        """
+        Gets the compiled library for one of the modes that only libcalcsim.so provides. Raises
+        simbackends.BackendUnavailableError if this wrapper's backend doesn't have it
+
+        :param mode: name of the mode, for the error message
+        """
+
+        if self.libcalcsim is None:
+            raise simbackends.BackendUnavailableError(str.format('The {} backend does not support {}; use a backend '
+                                                                 'with libcalcsim.so', self.backend.name, mode))
+        return self.libcalcsim
 
     def emigration_factor(self, z, I_density, T):
         """
@@ -56,14 +89,35 @@ class CalcSimWrapper:
         max_diff = np.max(D_vector) * cv_factor
         return 0.1 * dx ** 2 / max_diff
 
+    def max_stable_dt(self, dx, D_vector, cv_factor):
+        """
+        Computes the largest dt the explicit schemes can take, with a little margin; this is the ceiling for the
+        adaptive timestep control in calc_simulation_adaptive
+
+        :param dx: Size of one timestep, in metres
+        :param D_vector: Vector of diffusivity values in SI units
+        :param cv_factor: multiplicative factor for diffusivity
+        """
+
+        max_diff = np.max(D_vector) * cv_factor
+        return 0.4 * dx ** 2 / max_diff
+
     def calc_simulation(self,
                         D_vector, R_vector, init_cond,
-                        ndt, dt, dx, r, cv_factor):
+                        ndt, dt, dx, r, cv_factor, scheme='explicit', out_times=None, cached=True):
         """
         Wrapper for the calc_simulation function in calcsim.c
         This function will compute the forward-difference diffusion equation involving electromigration and accelerated
         diffusion (i.e. Cv/Cve > 1).
 
+        The implicit schemes linearise D(c) and R(c) about the previous step and solve a tridiagonal system, so they
+        can take timesteps past the explicit limit; they hand off to calc_simulation_implicit. See SIM_SCHEMES for
+        the range of dt each is accurate over. A profile that leaves [0,1] by more than half a table entry raises
+        SimulationUnstableError whichever scheme made it, rather than being returned.
+
+        If out_times is given, the profile is captured as the run passes each of those times (via
+        calc_simulation_snapshots), so a whole time series costs a single simulation.
+
         :param D_vector: identically sized vectors of diffusivity and resistivity as a function of concentration from
             0 to 1. DO NOT MODIFY THESE FROM ANOTHER THREAD
         :param R_vector: identically sized vectors of diffusivity and resistivity as a function of concentration from
@@ -74,12 +128,42 @@ class CalcSimWrapper:
         :param dx: size of one spacestep in metres
         :param r: multiplicative factor involving z*, T and Idensity, as well as diverse other constants
         :param cv_factor: multiplicative factor for diffusivity
+        :param scheme: one of the keys of SIM_SCHEMES; 'explicit' (default), 'implicit' or 'crank-nicolson'
+        :param out_times: optional list of simulated times (in seconds, no later than ndt * dt) at which to capture
+            the profile. If given, a (len(out_times), ndx) array is returned with one profile per row, in the order
+            requested, and the run stops at the last of them
+        :param cached: if False, the cache (if there is one) is left alone: the result is neither looked up in it nor
+            kept in it. For intermediate results that aren't worth keeping
         """
 
         if len(D_vector) != len(R_vector):
             raise ValueError("D and R must be the same length")
         if len(D_vector) < 1:
             raise ValueError("There needs to be at least one element in D and R")
+        if scheme not in SIM_SCHEMES:
+            raise ValueError('Unknown scheme ' + str(scheme))
+        if self.cache is not None and cached:
+            key = self.simulation_key(D_vector, R_vector, init_cond, ndt, dt, dx, r, cv_factor, scheme, out_times)
+            return self.cache.get_or_compute(key, lambda: self._calc_simulation(D_vector, R_vector, init_cond, ndt,
+                                                                                 dt, dx, r, cv_factor, scheme,
+                                                                                 out_times))
+        return self._calc_simulation(D_vector, R_vector, init_cond, ndt, dt, dx, r, cv_factor, scheme, out_times)
+
+    def simulation_key(self, D_vector, R_vector, init_cond, ndt, dt, dx, r, cv_factor, scheme='explicit',
+                       out_times=None):
+        """
+        The key that the result of calc_simulation with these arguments is cached under. It covers every input, the
+        backend and KERNEL_VERSION
+        """
+
+        return self.cache.key('calc_simulation', self.backend.name, str(KERNEL_VERSION), scheme,
+                              D_vector, R_vector, init_cond, ndt, dt, dx, r, cv_factor,
+                              [] if out_times is None else out_times)
+
+    def _calc_simulation(self, D_vector, R_vector, init_cond, ndt, dt, dx, r, cv_factor, scheme, out_times):
+        if out_times is not None:
+            return self.calc_simulation_snapshots(D_vector, R_vector, init_cond, ndt, dt, dx, r, cv_factor,
+                                                  scheme, out_times)
 
         #easy scalars
         nIV = len(D_vector)
@@ -97,6 +181,168 @@ class CalcSimWrapper:
         init_cond_contig = np.ascontiguousarray(init_cond, dtype=np.float64)
         out_contig = np.ascontiguousarray(out_array, dtype=np.float64)
 
+        #and shell out
+        logging.debug(str.format('About to move to native code (r = {}, scheme = {})', r, scheme))
+        theta = SIM_SCHEMES[scheme]
+        if theta == 0:
+            res = self.backend.calc_simulation(D_contig, R_contig, init_cond_contig, ndt, dt, dx, r, out_contig)
+        else:
+            #vars
+            D_ptr = D_contig.ctypes.data_as(ctypes.POINTER(ctypes.c_double))
+            R_ptr = R_contig.ctypes.data_as(ctypes.POINTER(ctypes.c_double))
+            init_cond_ptr = init_cond_contig.ctypes.data_as(ctypes.POINTER(ctypes.c_double))
+            out_ptr = out_contig.ctypes.data_as(ctypes.POINTER(ctypes.c_double))
+            libcalcsim = self.native_library(str.format('the {} scheme', scheme))
+            res = libcalcsim.calc_simulation_implicit(D_ptr, R_ptr, nIV, init_cond_ptr,
+                                                      ndt, ndx, dt, dx, r, theta, out_ptr)
+        if res == 1:
+            raise SimulationUnstableError("Simulation was unstable, aborting...")
+        return out_contig
+
+    def prepare(self, D_vector, R_vector, ndx):
+        """
+        Makes a PreparedSimulation for repeatedly running the explicit simulation on D_vector and R_vector (NOT
+        premultiplied by cv_factor) over a grid of ndx points
+
+        :param D_vector: vector of diffusivity as a function of concentration from 0 to 1
+        :param R_vector: vector of resistivity as a function of concentration from 0 to 1
+        :param ndx: number of points in the profiles that will be simulated
+        """
+
+        return PreparedSimulation(self, D_vector, R_vector, ndx)
+
+    def calc_simulation_tables(self, tables, init_cond, ndt, dt, dx, r, cv_factor):
+        """
+        Wrapper for the calc_simulation_interp function in calcsim.c
+        This runs the explicit simulation from a PropertyTables object: D, R and their derivatives are linearly
+        interpolated from the tables rather than rounded to the nearest entry, and cv_factor is applied in native code,
+        so the same tables can be reused for every cv_factor at a given temperature.
+
+        :param tables: PropertyTables built from the D and R vectors for the temperature of interest
+        :param init_cond: initial concentration profile. DO NOT MODIFY FROM ANOTHER THREAD
+        :param ndt: number of timesteps to run
+        :param dt: size of one timestep in seconds
+        :param dx: size of one spacestep in metres
+        :param r: multiplicative factor involving z*, T and Idensity, as well as diverse other constants
+        :param cv_factor: multiplicative factor for diffusivity
+        """
+
+        assert isinstance(tables, PropertyTables)
+
+        ndx = len(init_cond)
+        init_cond_contig = np.ascontiguousarray(init_cond, dtype=np.float64)
+        out_contig = np.zeros(ndx, dtype=np.float64)
+
+        init_cond_ptr = init_cond_contig.ctypes.data_as(ctypes.POINTER(ctypes.c_double))
+        out_ptr = out_contig.ctypes.data_as(ctypes.POINTER(ctypes.c_double))
+
+        logging.debug(str.format('About to move to native code (r = {}, {} entry tables)', r, tables.size))
+        libcalcsim = self.native_library('property tables')
+        res = libcalcsim.calc_simulation_interp(tables.D_ptr, tables.R_ptr, tables.dD_ptr, tables.dR_ptr,
+                                                tables.size, init_cond_ptr, ndt, ndx, dt, dx, r, cv_factor,
+                                                out_ptr)
+        if res == 1:
+            raise SimulationUnstableError("Simulation was unstable, aborting...")
+        return out_contig
+
+    def calc_simulation_snapshots(self,
+                                  D_vector, R_vector, init_cond,
+                                  ndt, dt, dx, r, cv_factor, scheme, out_times):
+        """
+        Wrapper for the calc_simulation_snapshots function in calcsim.c; see calc_simulation for the parameters.
+        Each time in out_times is rounded up to a whole number of timesteps, as in num_sim_steps.
+        """
+
+        #the native code wants non-decreasing step counts; remember where each one came from
+        snap_steps = np.array([self.num_sim_steps(dt, t) for t in out_times], dtype=np.int32)
+        if len(snap_steps) < 1:
+            raise ValueError("There needs to be at least one output time")
+        if np.any(snap_steps < 0) or np.any(snap_steps > ndt):
+            raise ValueError("Output times must lie between 0 and ndt * dt")
+        order = np.argsort(snap_steps, kind='mergesort')
+
+        #easy scalars
+        nIV = len(D_vector)
+        ndx = len(init_cond)
+        nsnaps = len(snap_steps)
+
+        #multiply diffusivity by the relevant factor
+        D_revised = D_vector * cv_factor
+
+        #need things to be contiguous
+        D_contig = np.ascontiguousarray(D_revised, dtype=np.float64)
+        R_contig = np.ascontiguousarray(R_vector, dtype=np.float64)
+        init_cond_contig = np.ascontiguousarray(init_cond, dtype=np.float64)
+        steps_contig = np.ascontiguousarray(snap_steps[order], dtype=np.int32)
+        out_contig = np.zeros((nsnaps, ndx), dtype=np.float64)
+
+        #vars
+        D_ptr = D_contig.ctypes.data_as(ctypes.POINTER(ctypes.c_double))
+        R_ptr = R_contig.ctypes.data_as(ctypes.POINTER(ctypes.c_double))
+        init_cond_ptr = init_cond_contig.ctypes.data_as(ctypes.POINTER(ctypes.c_double))
+        steps_ptr = steps_contig.ctypes.data_as(ctypes.POINTER(ctypes.c_int32))
+        out_ptr = out_contig.ctypes.data_as(ctypes.POINTER(ctypes.c_double))
+
+        #and shell out
+        logging.debug(str.format('About to move to native code (r = {}, scheme = {}, {} snapshots)',
+                                 r, scheme, nsnaps))
+        libcalcsim = self.native_library('out_times')
+        res = libcalcsim.calc_simulation_snapshots(D_ptr, R_ptr, nIV, init_cond_ptr, ndx,
+                                                   dt, dx, r, SIM_SCHEMES[scheme],
+                                                   steps_ptr, nsnaps, out_ptr)
+        if res == 1:
+            raise SimulationUnstableError("Simulation was unstable, aborting...")
+
+        #put the rows back in the order they were asked for
+        snapshots = np.empty_like(out_contig)
+        snapshots[order, :] = out_contig
+        return snapshots
+
+    def calc_simulation_converge(self,
+                                 D_vector, R_vector, init_cond,
+                                 ndt, dt, dx, r, cv_factor, tol, check_every=1000, scheme='explicit'):
+        """
+        Wrapper for the calc_simulation_converge function in calcsim.c
+        This runs calc_simulation for at most ndt steps, but stops early once the profile has stopped changing: every
+        check_every steps the largest change since the previous check is compared against tol.
+
+        :param D_vector: identically sized vectors of diffusivity and resistivity as a function of concentration from
+            0 to 1. DO NOT MODIFY THESE FROM ANOTHER THREAD
+        :param R_vector: identically sized vectors of diffusivity and resistivity as a function of concentration from
+            0 to 1. DO NOT MODIFY THESE FROM ANOTHER THREAD
+        :param init_cond: initial concentration profile. DO NOT MODIFY FROM ANOTHER THREAD
+        :param ndt: largest number of timesteps to run
+        :param dt: size of one timestep in seconds
+        :param dx: size of one spacestep in metres
+        :param r: multiplicative factor involving z*, T and Idensity, as well as diverse other constants
+        :param cv_factor: multiplicative factor for diffusivity
+        :param tol: the run is converged once no point changes by more than this over check_every steps
+        :param check_every: number of timesteps between convergence checks
+        :param scheme: one of the keys of SIM_SCHEMES
+        :return: (simulated profile, number of timesteps actually run)
+        """
+
+        if len(D_vector) != len(R_vector):
+            raise ValueError("D and R must be the same length")
+        if len(D_vector) < 1:
+            raise ValueError("There needs to be at least one element in D and R")
+        if scheme not in SIM_SCHEMES:
+            raise ValueError('Unknown scheme ' + str(scheme))
+
+        #easy scalars
+        nIV = len(D_vector)
+        ndx = len(init_cond)
+
+        #multiply diffusivity by the relevant factor
+        D_revised = D_vector * cv_factor
+
+        #need things to be contiguous
+        D_contig = np.ascontiguousarray(D_revised, dtype=np.float64)
+        R_contig = np.ascontiguousarray(R_vector, dtype=np.float64)
+        init_cond_contig = np.ascontiguousarray(init_cond, dtype=np.float64)
+        out_contig = np.zeros(ndx, dtype=np.float64)
+        steps_taken = ctypes.c_int32(0)
+
         #vars
         D_ptr = D_contig.ctypes.data_as(ctypes.POINTER(ctypes.c_double))
         R_ptr = R_contig.ctypes.data_as(ctypes.POINTER(ctypes.c_double))
@@ -104,13 +350,320 @@ class CalcSimWrapper:
         out_ptr = out_contig.ctypes.data_as(ctypes.POINTER(ctypes.c_double))
 
         #and shell out
-        logging.debug(str.format('About to move to native code (r = {})', r))
-        res = self.libcalcsim.calc_simulation(D_ptr, R_ptr, nIV, init_cond_ptr,
-                                              ndt, ndx, dt, dx, r, out_ptr)
+        logging.debug(str.format('About to move to native code (r = {}, scheme = {}, tol = {})', r, scheme, tol))
+        libcalcsim = self.native_library('convergence checking')
+        res = libcalcsim.calc_simulation_converge(D_ptr, R_ptr, nIV, init_cond_ptr, ndt, ndx, dt, dx, r,
+                                                  SIM_SCHEMES[scheme], tol, check_every,
+                                                  out_ptr, ctypes.byref(steps_taken))
+        if res == 1:
+            raise SimulationUnstableError("Simulation was unstable, aborting...")
+        logging.debug(str.format('Simulation converged after {} of {} steps', steps_taken.value, ndt))
+        return out_contig, steps_taken.value
+
+    def calc_simulation_adaptive(self,
+                                 D_vector, R_vector, init_cond,
+                                 tmax, dx, r, cv_factor, tol=1e-6, dt_init=None, dt_max=None,
+                                 max_steps=None, dt_min=None):
+        """
+        Wrapper for the calc_simulation_adaptive function in calcsim.c
+        This solves the same equation as calc_simulation up to a simulated time tmax, but chooses dt for itself: each
+        step is sized from a local error estimate, so the run takes small steps while the interface is sharp and
+        much larger ones once the profile has relaxed.
+
+        The rates are worked out with D, R and their derivatives linearly interpolated between table entries rather
+        than taken from the nearest one, which makes them continuous in the concentrations; with nearest entries, the
+        point at the interface flips between two rates for much of a run and no step can meet tol. Where D is held
+        flat at the edges of the data, dD/dc still drops to 0 within one table entry, and the point at the interface
+        sits on that edge for most of an anneal, so on datastore tables few steps meet tol however small they are.
+        There the run falls back to (second order) steps of dt_min: on the 973K tables, a 2 hour anneal takes about
+        88000 of them, against 144000 for calc_simulation at the usual dt = 0.05 s, and ends up no further from a
+        run at a tenth of that dt. Each step works out the rates twice. The tables are used as given: they would have
+        to be smoothed over about 20 entries before the steps grew past that, which moves the profile nearly as far
+        as calc_simulation's own error does.
+
+        :param D_vector: identically sized vectors of diffusivity and resistivity as a function of concentration from
+            0 to 1. DO NOT MODIFY THESE FROM ANOTHER THREAD
+        :param R_vector: identically sized vectors of diffusivity and resistivity as a function of concentration from
+            0 to 1. DO NOT MODIFY THESE FROM ANOTHER THREAD
+        :param init_cond: initial concentration profile. DO NOT MODIFY FROM ANOTHER THREAD
+        :param tmax: simulated time to run for, in seconds
+        :param dx: size of one spacestep in metres
+        :param r: multiplicative factor involving z*, T and Idensity, as well as diverse other constants
+        :param cv_factor: multiplicative factor for diffusivity
+        :param tol: largest local error in concentration (max-norm) allowed per step
+        :param dt_init: size of the first timestep attempted; defaults to optimum_dt
+        :param dt_max: largest timestep allowed; defaults to max_stable_dt
+        :param max_steps: give up (and raise SimulationUnstableError) after attempting this many steps; defaults to
+            twice as many as a fixed-step run at dt_min would take, plus 10000
+        :param dt_min: smallest timestep; a step this size is taken whatever its estimated error, as a fixed-step run
+            would take it. Defaults to a tenth of optimum_dt for a cv factor of 1 (or dt_max, if that is smaller), so
+            the number of steps doesn't grow with cv_factor, any more than calc_simulation's does at a fixed dt.
+            Smaller values buy accuracy on datastore tables at the cost of steps: optimum_dt / 100 is about 20 times
+            closer to the fine run, and takes about 6 times as many steps as calc_simulation
+        :return: (simulated profile, number of timesteps taken)
+        """
+
+        if len(D_vector) != len(R_vector):
+            raise ValueError("D and R must be the same length")
+        if len(D_vector) < 2:
+            raise ValueError("There need to be at least two elements in D and R")
+
+        if dt_init is None:
+            dt_init = self.optimum_dt(dx, D_vector, cv_factor)
+        if dt_max is None:
+            dt_max = self.max_stable_dt(dx, D_vector, cv_factor)
+        if dt_min is None:
+            dt_min = min(self.optimum_dt(dx, D_vector, 1) / 10, dt_max)
+        if max_steps is None:
+            max_steps = 2 * self.num_sim_steps(dt_min, tmax) + 10000
+
+        #easy scalars
+        nIV = len(D_vector)
+        ndx = len(init_cond)
+
+        #multiply diffusivity by the relevant factor
+        D_revised = D_vector * cv_factor
+
+        #need things to be contiguous
+        D_contig = np.ascontiguousarray(D_revised, dtype=np.float64)
+        R_contig = np.ascontiguousarray(R_vector, dtype=np.float64)
+        init_cond_contig = np.ascontiguousarray(init_cond, dtype=np.float64)
+        out_contig = np.zeros(ndx, dtype=np.float64)
+        steps_taken = ctypes.c_int32(0)
+
+        #vars
+        D_ptr = D_contig.ctypes.data_as(ctypes.POINTER(ctypes.c_double))
+        R_ptr = R_contig.ctypes.data_as(ctypes.POINTER(ctypes.c_double))
+        init_cond_ptr = init_cond_contig.ctypes.data_as(ctypes.POINTER(ctypes.c_double))
+        out_ptr = out_contig.ctypes.data_as(ctypes.POINTER(ctypes.c_double))
+
+        #and shell out
+        logging.debug(str.format('About to move to native code (r = {}, adaptive, tol = {}, dt_min = {})', r, tol,
+                                 dt_min))
+        libcalcsim = self.native_library('adaptive timesteps')
+        res = libcalcsim.calc_simulation_adaptive(D_ptr, R_ptr, nIV, init_cond_ptr, ndx,
+                                                  tmax, dt_init, dt_min, dt_max, dx, r, tol, max_steps,
+                                                  out_ptr, ctypes.byref(steps_taken))
+        if res == 1:
+            raise SimulationUnstableError("Simulation was unstable, aborting...")
+        logging.debug(str.format('Adaptive simulation took {} steps', steps_taken.value))
+        return out_contig, steps_taken.value
+
+    def calc_simulation_parallel(self, D_vector, R_vector, init_cond, ndt, dt, dx, r, cv_factor,
+                                 threads=0, block_steps=16, tile_width=4096):
+        """
+        Wrapper for the calc_simulation_parallel function in calcsim.c
+        Gives the same result as the explicit calc_simulation, but splits the grid into tiles of tile_width points
+        that are advanced on several threads, block_steps timesteps at a time, so each tile stays in cache. Only
+        worth it for large grids (10^4 points or more); for the default 200 point grid, use calc_simulation.
+
+        :param threads: number of threads to use; 0 lets OpenMP decide. Ignored if libcalcsim.so was built without
+            -fopenmp
+        :param block_steps: timesteps run on a tile between exchanges of the whole grid. Each tile recomputes
+            block_steps points either side of itself, so this should be well under tile_width
+        :param tile_width: number of grid points in a tile
+        The remaining parameters are as for calc_simulation
+        """
+
+        if len(D_vector) != len(R_vector):
+            raise ValueError("D and R must be the same length")
+        if len(D_vector) < 1:
+            raise ValueError("There needs to be at least one element in D and R")
+
+        D_contig = np.ascontiguousarray(D_vector * cv_factor, dtype=np.float64)
+        R_contig = np.ascontiguousarray(R_vector, dtype=np.float64)
+        init_cond_contig = np.ascontiguousarray(init_cond, dtype=np.float64)
+        out_contig = np.zeros(len(init_cond_contig), dtype=np.float64)
+
+        D_ptr = D_contig.ctypes.data_as(ctypes.POINTER(ctypes.c_double))
+        R_ptr = R_contig.ctypes.data_as(ctypes.POINTER(ctypes.c_double))
+        init_cond_ptr = init_cond_contig.ctypes.data_as(ctypes.POINTER(ctypes.c_double))
+        out_ptr = out_contig.ctypes.data_as(ctypes.POINTER(ctypes.c_double))
+
+        logging.debug(str.format('About to move to native code (r = {}, {} threads, {} point tiles)',
+                                 r, threads, tile_width))
+        libcalcsim = self.native_library('the parallel kernel')
+        res = libcalcsim.calc_simulation_parallel(D_ptr, R_ptr, len(D_contig), init_cond_ptr, ndt,
+                                                  len(init_cond_contig), dt, dx, r, threads, block_steps, tile_width,
+                                                  out_ptr)
         if res == 1:
             raise SimulationUnstableError("Simulation was unstable, aborting...")
         return out_contig
 
+    def calc_simulation_sensitivity(self, D_vector, R_vector, init_cond, ndt, dt, dx, r, cv_factor):
+        """
+        Wrapper for the calc_simulation_sensitivity function in calcsim.c
+        Runs the explicit simulation and, in the same timestep loop, the tangent-linear equations for how the profile
+        depends on r and cv_factor, so a simulation and its derivatives cost about as much as two simulations rather
+        than three. D and R are differentiated as smooth functions of concentration, so the derivatives are those of
+        the underlying model rather than of the nearest-entry table lookups; on smooth tables they agree with finite
+        differences of calc_simulation to the accuracy of the tables. The second derivatives of D and R are taken
+        over 5% of the concentration range, which keeps the derivatives finite on piecewise linear datastore tables.
+        There, finite differences of calc_simulation change with the step size and aren't much of a check.
+
+        Results are kept in the cache, if there is one, as for calc_simulation.
+
+        The parameters are as for calc_simulation
+        :return: (profile, dC/dr, dC/dcv_factor), each a vector of ndx values
+        """
+
+        if len(D_vector) != len(R_vector):
+            raise ValueError("D and R must be the same length")
+        if len(D_vector) < 1:
+            raise ValueError("There needs to be at least one element in D and R")
+        if self.cache is not None:
+            key = self.cache.key('calc_simulation_sensitivity', self.backend.name, str(KERNEL_VERSION),
+                                 D_vector, R_vector, init_cond, ndt, dt, dx, r, cv_factor)
+            results = self.cache.get_or_compute(key, lambda: np.vstack(self._calc_simulation_sensitivity(
+                D_vector, R_vector, init_cond, ndt, dt, dx, r, cv_factor)))
+            return results[0], results[1], results[2]
+        return self._calc_simulation_sensitivity(D_vector, R_vector, init_cond, ndt, dt, dx, r, cv_factor)
+
+    def _calc_simulation_sensitivity(self, D_vector, R_vector, init_cond, ndt, dt, dx, r, cv_factor):
+        D_contig = np.ascontiguousarray(D_vector, dtype=np.float64)
+        R_contig = np.ascontiguousarray(R_vector, dtype=np.float64)
+        init_cond_contig = np.ascontiguousarray(init_cond, dtype=np.float64)
+        ndx = len(init_cond_contig)
+        out_contig = np.zeros(ndx, dtype=np.float64)
+        dCdr = np.zeros(ndx, dtype=np.float64)
+        dCdcvf = np.zeros(ndx, dtype=np.float64)
+
+        logging.debug(str.format('About to move to native code (r = {}, with sensitivities)', r))
+        libcalcsim = self.native_library('sensitivities')
+        res = libcalcsim.calc_simulation_sensitivity(D_contig.ctypes.data_as(ctypes.POINTER(ctypes.c_double)),
+                                                     R_contig.ctypes.data_as(ctypes.POINTER(ctypes.c_double)),
+                                                     len(D_contig),
+                                                     init_cond_contig.ctypes.data_as(ctypes.POINTER(ctypes.c_double)),
+                                                     ndt, ndx, dt, dx, r, cv_factor,
+                                                     out_contig.ctypes.data_as(ctypes.POINTER(ctypes.c_double)),
+                                                     dCdr.ctypes.data_as(ctypes.POINTER(ctypes.c_double)),
+                                                     dCdcvf.ctypes.data_as(ctypes.POINTER(ctypes.c_double)))
+        if res == 1:
+            raise SimulationUnstableError("Simulation was unstable, aborting...")
+        return out_contig, dCdr, dCdcvf
+
+    def calc_simulation_mesh(self, D_vector, R_vector, init_cond, ndt, dt, x, r, cv_factor):
+        """
+        Wrapper for the calc_simulation_mesh function in calcsim.c
+        Runs the explicit simulation on a non-uniform mesh (see SimulationMesh). The stable dt is set by the smallest
+        cell, so pass SimulationMesh.min_dx to optimum_dt.
+
+        :param init_cond: initial concentration at each node of x. DO NOT MODIFY FROM ANOTHER THREAD
+        :param x: node positions in metres, strictly increasing. The first and last nodes are held fixed
+        The remaining parameters are as for calc_simulation
+        """
+
+        if len(D_vector) != len(R_vector):
+            raise ValueError("D and R must be the same length")
+        if len(x) != len(init_cond):
+            raise ValueError("x and init_cond must be the same length")
+        if np.any(np.diff(x) <= 0):
+            raise ValueError("Mesh nodes must be strictly increasing")
+
+        D_contig = np.ascontiguousarray(D_vector * cv_factor, dtype=np.float64)
+        R_contig = np.ascontiguousarray(R_vector, dtype=np.float64)
+        init_cond_contig = np.ascontiguousarray(init_cond, dtype=np.float64)
+        x_contig = np.ascontiguousarray(x, dtype=np.float64)
+        out_contig = np.zeros(len(x_contig), dtype=np.float64)
+
+        D_ptr = D_contig.ctypes.data_as(ctypes.POINTER(ctypes.c_double))
+        R_ptr = R_contig.ctypes.data_as(ctypes.POINTER(ctypes.c_double))
+        init_cond_ptr = init_cond_contig.ctypes.data_as(ctypes.POINTER(ctypes.c_double))
+        x_ptr = x_contig.ctypes.data_as(ctypes.POINTER(ctypes.c_double))
+        out_ptr = out_contig.ctypes.data_as(ctypes.POINTER(ctypes.c_double))
+
+        logging.debug(str.format('About to move to native code (r = {}, {} node mesh)', r, len(x_contig)))
+        libcalcsim = self.native_library('non-uniform meshes')
+        res = libcalcsim.calc_simulation_mesh(D_ptr, R_ptr, len(D_contig), init_cond_ptr, ndt, len(x_contig),
+                                              x_ptr, dt, r, out_ptr)
+        if res == 1:
+            raise SimulationUnstableError("Simulation was unstable, aborting...")
+        return out_contig
+
+    def calc_simulation_remesh(self, D_vector, R_vector, init_cond, ndt, dt, mesh, r, cv_factor, remesh_every):
+        """
+        Runs calc_simulation_mesh, rebuilding the mesh around the current profile every remesh_every steps so the
+        fine cells follow the steepest part of it as the interface moves and spreads. The profile is carried over to
+        each new mesh by linear interpolation.
+        dt must be stable for mesh.min_dx; every remeshed mesh has the same ndx and max_ratio, so it is no finer.
+
+        :param mesh: SimulationMesh to start from; init_cond gives the concentration at each of its nodes
+        :param remesh_every: number of timesteps between remeshes
+        Returns (x, profile) for the final mesh
+        """
+
+        assert isinstance(mesh, SimulationMesh)
+
+        profile = np.asarray(init_cond, dtype=np.float64)
+        steps_done = 0
+        while steps_done < ndt:
+            nsteps = min(remesh_every, ndt - steps_done)
+            profile = self.calc_simulation_mesh(D_vector, R_vector, profile, nsteps, dt, mesh.x, r, cv_factor)
+            steps_done += nsteps
+            if steps_done < ndt:
+                new_mesh = SimulationMesh.from_profile(mesh.x, profile, mesh.ndx, mesh.max_ratio)
+                profile = new_mesh.resample(mesh.x, profile)
+                mesh = new_mesh
+        return mesh.x, profile
+
+    def calc_simulation_batch(self,
+                              D_vector, R_vector, init_cond,
+                              ndt, dt, dx, r_values, cv_factors):
+        """
+        Wrapper for the calc_simulation_batch function in calcsim.c
+        This runs the same simulation as calc_simulation for N different (r, cv_factor) pairs in a single native
+        call, advancing all of the profiles together.
+
+        Unlike calc_simulation, an unstable simulation does not abort the rest of the batch; instead the row for that
+        simulation is filled with NaN.
+
+        :param D_vector: identically sized vectors of diffusivity and resistivity as a function of concentration from
+            0 to 1, NOT premultiplied by the cv factors. DO NOT MODIFY THESE FROM ANOTHER THREAD
+        :param R_vector: identically sized vectors of diffusivity and resistivity as a function of concentration from
+            0 to 1. DO NOT MODIFY THESE FROM ANOTHER THREAD
+        :param init_cond: initial concentration profile, shared by every simulation in the batch; or an (N, ndx) array
+            with a separate starting profile for each simulation
+        :param ndt: number of timesteps to run
+        :param dt: size of one timestep in seconds
+        :param dx: size of one spacestep in metres
+        :param r_values: vector of N electromigration factors (see emigration_factor)
+        :param cv_factors: vector of N multiplicative factors for diffusivity
+        :return: an (N, ndx) array with one simulated profile per row
+        """
+
+        if len(D_vector) != len(R_vector):
+            raise ValueError("D and R must be the same length")
+        if len(D_vector) < 1:
+            raise ValueError("There needs to be at least one element in D and R")
+
+        r_contig = np.ascontiguousarray(np.atleast_1d(r_values), dtype=np.float64)
+        cvf_contig = np.ascontiguousarray(np.atleast_1d(cv_factors), dtype=np.float64)
+        if len(r_contig) != len(cvf_contig):
+            raise ValueError("r_values and cv_factors must be the same length")
+
+        #easy scalars
+        ndx = np.shape(init_cond)[-1]
+        nsims = len(r_contig)
+        if np.ndim(init_cond) == 2 and len(init_cond) != nsims:
+            raise ValueError("There must be one initial condition per simulation")
+
+        #need things to be contiguous
+        D_contig = np.ascontiguousarray(D_vector, dtype=np.float64)
+        R_contig = np.ascontiguousarray(R_vector, dtype=np.float64)
+        init_cond_contig = np.ascontiguousarray(init_cond, dtype=np.float64)
+        out_contig = np.zeros((nsims, ndx), dtype=np.float64)
+        status_contig = np.zeros(nsims, dtype=np.int32)
+
+        #and shell out
+        logging.debug(str.format('About to move to the {} backend (batch of {})', self.backend.name, nsims))
+        res = self.backend.calc_simulation_batch(D_contig, R_contig, init_cond_contig, ndt, dt, dx,
+                                                 r_contig, cvf_contig, out_contig, status_contig)
+        if res == 1:
+            raise MemoryError("Could not allocate storage for a batch of {} simulations".format(nsims))
+
+        out_contig[status_contig != 0, :] = np.nan
+        return out_contig
+
     def fast_pad_shift(self, y1, y2):
         """
         Wrapper around fast_pad_shift() in fastshift.c
@@ -127,11 +680,412 @@ class CalcSimWrapper:
 
         y1_contig = np.ascontiguousarray(y1, dtype=np.float64)
         y2_contig = np.ascontiguousarray(y2, dtype=np.float64)
-        y1_ptr = y1_contig.ctypes.data_as(ctypes.POINTER(ctypes.c_double))
-        y2_ptr = y2_contig.ctypes.data_as(ctypes.POINTER(ctypes.c_double))
 
-        return self.libcalcsim.fast_pad_shift(y1_ptr, y2_ptr, len(y1))
+        return self.backend.fast_pad_shift(y1_contig, y2_contig)
+
+    def fast_pad_shift_lsq(self, y1, y2):
+        """
+        As fast_pad_shift, but also returns the least squares error between y1 and y2 once shifted, so that it
+        doesn't have to be worked out again
+
+        :param y1: The array that will not be shifted
+        :param y2: The array that will be shifted
+        :return: (shift, least squares error)
+        """
+
+        shifts, lsqs = self.fast_pad_shift_batch(y1, np.reshape(y2, (1, -1)))
+        return int(shifts[0]), lsqs[0]
+
+    def fast_pad_shift_batch(self, y1, models):
+        """
+        Wrapper around fast_pad_shift_batch() in fastshift.c
+
+        Aligns every row of models against y1 as fast_pad_shift does. The error at every shift comes from prefix
+        sums and a cross-correlation, which past DIRECT_XCORR_MAX_LEN (180) points is done by FFT, so this is
+        O(n log n) per row rather than O(n^2). The usual 100 point profiles are short enough that the direct
+        cross-correlation is quicker
+
+        :param y1: The array that will not be shifted
+        :param models: (M, len(y1)) array of profiles to shift
+        :return: (vector of M shifts, vector of M least squares errors)
+        """
+
+        y1_contig = np.ascontiguousarray(y1, dtype=np.float64)
+        models_contig = np.ascontiguousarray(models, dtype=np.float64)
+        if models_contig.ndim != 2 or models_contig.shape[1] != len(y1_contig):
+            raise ValueError("Input sizes must be the same")
+
+        shifts = np.zeros(len(models_contig), dtype=np.int32)
+        lsqs = np.zeros(len(models_contig), dtype=np.float64)
+        res = self.backend.fast_pad_shift_batch(y1_contig, models_contig, shifts, lsqs)
+        if res == 1:
+            raise MemoryError("Could not allocate storage to align {} profiles".format(len(models_contig)))
+        return shifts, lsqs
+
+
+class PreparedSimulation():
+    """
+    A handle for running the explicit calc_simulation many times over with the same D and R, as a parameter search
+    does. D and R are copied once into read-only buffers, cv_factor is applied in native code rather than by
+    scaling a fresh copy of D, and the output and scratch buffers are kept between runs, so a run allocates nothing.
+
+    A handle holds its own scratch buffer, so each thread should have its own.
+    """
+
+    def __init__(self, cs, D_vector, R_vector, ndx):
+        """
+        :param cs: the CalcSimWrapper to run on; its backend must have libcalcsim.so
+        :param D_vector: vector of diffusivity as a function of concentration from 0 to 1, NOT premultiplied by
+            cv_factor
+        :param R_vector: vector of resistivity as a function of concentration from 0 to 1, the same length as D_vector
+        :param ndx: number of points in the profiles that will be simulated
+        """
+
+        assert isinstance(cs, CalcSimWrapper)
+
+        if len(D_vector) != len(R_vector):
+            raise ValueError("D and R must be the same length")
+        if len(D_vector) < 1:
+            raise ValueError("There needs to be at least one element in D and R")
+
+        self.lib = cs.native_library('prepared simulations')
+        self.ndx = ndx
+
+        #private copies, so nobody can change them underneath the native code
+        self.D_vector = np.array(D_vector, dtype=np.float64)
+        self.R_vector = np.array(R_vector, dtype=np.float64)
+        self.D_vector.setflags(write=False)
+        self.R_vector.setflags(write=False)
+        self.out = np.zeros(ndx, dtype=np.float64)
+        self.scratch = np.zeros(ndx, dtype=np.float64)
+
+        self.D_ptr = self.D_vector.ctypes.data_as(ctypes.POINTER(ctypes.c_double))
+        self.R_ptr = self.R_vector.ctypes.data_as(ctypes.POINTER(ctypes.c_double))
+        self.out_ptr = self.out.ctypes.data_as(ctypes.POINTER(ctypes.c_double))
+        self.scratch_ptr = self.scratch.ctypes.data_as(ctypes.POINTER(ctypes.c_double))
+
+    @staticmethod
+    def _checked_ptr(arr, ndx, name):
+        if not isinstance(arr, np.ndarray) or arr.dtype != np.float64 or not arr.flags['C_CONTIGUOUS']:
+            raise ValueError(name + " must be a contiguous float64 array")
+        if arr.shape != (ndx,):
+            raise ValueError(str.format("{} must have {} points", name, ndx))
+        return arr.ctypes.data_as(ctypes.POINTER(ctypes.c_double))
+
+    def run(self, init_cond, ndt, dt, dx, r, cv_factor, out=None):
+        """
+        Runs the explicit simulation from init_cond; see CalcSimWrapper.calc_simulation for the parameters.
+
+        :param init_cond: initial profile; a contiguous float64 array of ndx points, which is not modified
+        :param out: contiguous float64 array of ndx points to write the result into. If None, the handle's own
+            output buffer is used, which the next run will overwrite
+        :return: out, or the handle's output buffer
+        """
+
+        init_cond_ptr = self._checked_ptr(init_cond, self.ndx, 'init_cond')
+        if out is None:
+            out, out_ptr = self.out, self.out_ptr
+        else:
+            out_ptr = self._checked_ptr(out, self.ndx, 'out')
+
+        res = self.lib.calc_simulation_prepared(self.D_ptr, self.R_ptr, len(self.D_vector), init_cond_ptr,
+                                                ndt, self.ndx, dt, dx, r, cv_factor, self.scratch_ptr, out_ptr)
+        if res == 1:
+            raise SimulationUnstableError("Simulation was unstable, aborting...")
+        return out
+
+
+class PropertyTables():
+    """
+    D, R, dD/dc and dR/dc tabulated over a uniform concentration grid from 0 to 1, for calc_simulation_tables.
+    The tables are built once from densely sampled D and R vectors (e.g. InputDatastore.interpolated_diffusivity),
+    and made only as large as they need to be for linear interpolation to reproduce those vectors to within rtol.
+    """
+
+    def __init__(self, D_vector, R_vector, rtol=1e-4):
+        """
+        :param D_vector: identically sized vectors of diffusivity and resistivity as a function of concentration from
+            0 to 1, NOT premultiplied by any cv factor
+        :param R_vector: identically sized vectors of diffusivity and resistivity as a function of concentration from
+            0 to 1
+        :param rtol: largest relative error allowed when interpolating D or R from the tables
+        """
+
+        if len(D_vector) != len(R_vector):
+            raise ValueError("D and R must be the same length")
+        if len(D_vector) < 2:
+            raise ValueError("There need to be at least two elements in D and R")
+
+        D_dense = np.asarray(D_vector, dtype=np.float64)
+        R_dense = np.asarray(R_vector, dtype=np.float64)
+        c_dense = np.linspace(0, 1, len(D_dense))
+
+        #derivatives come from the dense vectors, so they're as good as the input allows
+        dD_dense = np.gradient(D_dense, c_dense)
+        dR_dense = np.gradient(R_dense, c_dense)
+
+        #try 2^k + 1 entries until linear interpolation is good enough; fall back to the dense vectors
+        self.size = len(D_dense)
+        size = 3
+        while size < len(D_dense):
+            c = np.linspace(0, 1, size)
+            if (self._interp_error(c, c_dense, D_dense) <= rtol and
+                    self._interp_error(c, c_dense, R_dense) <= rtol):
+                self.size = size
+                break
+            size = 2 * size - 1
+
+        c = np.linspace(0, 1, self.size)
+        self.D = np.ascontiguousarray(np.interp(c, c_dense, D_dense), dtype=np.float64)
+        self.R = np.ascontiguousarray(np.interp(c, c_dense, R_dense), dtype=np.float64)
+        self.dD = np.ascontiguousarray(np.interp(c, c_dense, dD_dense), dtype=np.float64)
+        self.dR = np.ascontiguousarray(np.interp(c, c_dense, dR_dense), dtype=np.float64)
+        for table in (self.D, self.R, self.dD, self.dR):
+            table.flags.writeable = False
+
+        self.D_ptr = self.D.ctypes.data_as(ctypes.POINTER(ctypes.c_double))
+        self.R_ptr = self.R.ctypes.data_as(ctypes.POINTER(ctypes.c_double))
+        self.dD_ptr = self.dD.ctypes.data_as(ctypes.POINTER(ctypes.c_double))
+        self.dR_ptr = self.dR.ctypes.data_as(ctypes.POINTER(ctypes.c_double))
+
+    @staticmethod
+    def _interp_error(c, c_dense, y_dense):
+        """
+        Worst relative error in reproducing y_dense by linear interpolation from its samples at c
+        """
+        approx = np.interp(c_dense, c, np.interp(c, c_dense, y_dense))
+        scale = np.maximum(np.abs(y_dense), np.finfo(np.float64).tiny)
+        return np.max(np.abs(approx - y_dense) / scale)
+
+
+class SimulationMesh():
+    """
+    A non-uniform mesh from 0 to length with ndx nodes, for calc_simulation_mesh. Nodes are placed so that each cell
+    carries an equal share of a monitor function, which is 1 far from the interface and up to max_ratio where the
+    profile is steepest. Cells there are therefore up to max_ratio times finer than in the bulk, and no cell is ever
+    smaller than length / ((ndx - 1) * max_ratio).
+    """
+
+    #resolution of the grid the monitor function is integrated on
+    monitor_points = 4001
+
+    def __init__(self, length, ndx, monitor_x, monitor, max_ratio):
+        """
+        :param length: length of the domain in metres
+        :param ndx: number of nodes
+        :param monitor_x: increasing positions spanning [0, length] at which monitor is sampled
+        :param monitor: monitor function, between 1 and max_ratio
+        :param max_ratio: ratio of the largest cell to the smallest one the monitor allows
+        """
+
+        if ndx < 3:
+            raise ValueError("A mesh needs at least three nodes")
+        if max_ratio < 1:
+            raise ValueError("max_ratio must be at least 1")
+
+        self.length = length
+        self.ndx = ndx
+        self.max_ratio = max_ratio
+
+        #equidistribute: invert the running integral of the monitor
+        weight = np.concatenate(([0], np.cumsum(0.5 * (monitor[1:] + monitor[:-1]) * np.diff(monitor_x))))
+        targets = np.linspace(0, weight[-1], ndx)
+        self.x = np.interp(targets, weight, monitor_x)
+        self.x[0] = 0
+        self.x[-1] = length
+
+    @property
+    def min_dx(self):
+        return np.min(np.diff(self.x))
+
+    @classmethod
+    def around_interface(cls, length, ndx, centre, width, max_ratio):
+        """
+        Mesh that is finest within about width of centre, e.g. the initial interface between the two compositions
+
+        :param centre: position of the interface in metres
+        :param width: half-width in metres of the refined region
+        """
+
+        monitor_x = np.linspace(0, length, cls.monitor_points)
+        monitor = 1 + (max_ratio - 1) * np.exp(-((monitor_x - centre) / width) ** 2)
+        return cls(length, ndx, monitor_x, monitor, max_ratio)
+
+    @classmethod
+    def from_profile(cls, x, profile, ndx, max_ratio):
+        """
+        Mesh that is finest where |dC/dx| of a profile (on nodes x) is largest
+
+        :param x: node positions of the profile, from 0 to the length of the domain
+        :param profile: concentration at each of x
+        """
+
+        length = x[-1]
+        monitor_x = np.linspace(0, length, cls.monitor_points)
+        gradient = np.abs(np.interp(monitor_x, x, np.gradient(profile, x)))
+
+        #spread it a little so the refined region doesn't end abruptly at the edge of the interface
+        kernel = np.hanning(cls.monitor_points // 50 + 3)
+        gradient = np.convolve(gradient, kernel / np.sum(kernel), mode='same')
+
+        scale = np.max(gradient)
+        if scale > 0:
+            monitor = 1 + (max_ratio - 1) * gradient / scale
+        else:
+            monitor = np.ones(cls.monitor_points)
+        return cls(length, ndx, monitor_x, monitor, max_ratio)
+
+    def resample(self, x, profile):
+        """
+        Interpolates a profile given on nodes x onto the nodes of this mesh
+        """
+        return np.interp(self.x, x, profile)
+
+
+class SimulationRun():
+    """
+    A simulation that is run a chunk of timesteps at a time, so that callers can watch its progress and stop it part
+    of the way through. Iterating over it advances the simulation one chunk per iteration, yielding
+    (steps run so far, current profile). The kernels carry no state between steps besides the profile itself, so each
+    chunk is just a calc_simulation (or calc_simulation_batch) call starting from where the last one finished.
+
+    If r and cv_factor are vectors, the whole batch is advanced together; profile is then an (N, ndx) array, and rows
+    for simulations that go unstable become NaN and are not advanced any further. Members of a batch can also be
+    left where they are with stop(). Once no member is left to advance, the run is finished, however many steps it
+    had to go.
+
+    If cs has a cache, a single run's final profile is kept in it under the same key calc_simulation would use for
+    the whole run, and a run that is already there starts out finished. The chunks in between aren't cached. Batches
+    aren't cached at all.
+    """
+
+    def __init__(self, cs, D_vector, R_vector, init_cond, ndt, dt, dx, r, cv_factor, scheme='explicit',
+                 chunk_steps=1000, cancel_event=None):
+        """
+        :param cs: CalcSimWrapper to run the simulation with
+        :param chunk_steps: number of timesteps to run per chunk
+        :param cancel_event: optional threading.Event; once it is set the run stops at the end of the current chunk.
+            Useful for cancelling many runs at once
+        The remaining parameters are as for CalcSimWrapper.calc_simulation
+        """
+        assert isinstance(cs, CalcSimWrapper)
+
+        self.cs = cs
+        self.D_vector = D_vector
+        self.R_vector = R_vector
+        self.ndt = ndt
+        self.dt = dt
+        self.dx = dx
+        self.r = r
+        self.cv_factor = cv_factor
+        self.scheme = scheme
+        self.chunk_steps = chunk_steps
+        self.cancel_event = cancel_event if cancel_event is not None else threading.Event()
+
+        if scheme not in SIM_SCHEMES:
+            raise ValueError('Unknown scheme ' + str(scheme))
+        self.batch = np.ndim(r) > 0
+        if self.batch:
+            if scheme != 'explicit':
+                raise ValueError('Batches can only be run with the explicit scheme')
+            self.r = np.asarray(r, dtype=np.float64)
+            self.cv_factor = np.asarray(cv_factor, dtype=np.float64)
+            self.profile = np.tile(np.asarray(init_cond, dtype=np.float64), (len(self.r), 1))
+            self.active = np.ones(len(self.r), dtype=bool)
+        else:
+            self.profile = np.array(init_cond, dtype=np.float64)
+        self.steps_done = 0
+
+        self.cache_key = None
+        if cs.cache is not None and not self.batch:
+            self.cache_key = cs.simulation_key(D_vector, R_vector, init_cond, ndt, dt, dx, r, cv_factor, scheme)
+            cached = cs.cache.get(self.cache_key)
+            if cached is not None:
+                self.profile = np.array(cached)
+                self.steps_done = ndt
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    @property
+    def finished(self):
+        return self.steps_done >= self.ndt
+
+    def cancel(self):
+        """
+        Stops the run at the end of the current chunk
+        """
+        self.cancel_event.set()
+
+    def stop(self, members):
+        """
+        Stops advancing some members of a batch; their profiles stay as they are now, and the rest carry on
+
+        :param members: boolean mask or indicies of the members to stop
+        """
+
+        if not self.batch:
+            raise ValueError('Only members of a batch can be stopped')
+        self.active[members] = False
+
+    def advance(self, nsteps=None):
+        """
+        Runs the next chunk of the simulation and returns the profile(s) after it
+
+        :param nsteps: number of timesteps to run; defaults to chunk_steps. Never runs past ndt
+        """
+
+        if nsteps is None:
+            nsteps = self.chunk_steps
+        nsteps = min(nsteps, self.ndt - self.steps_done)
+        if nsteps <= 0:
+            return self.profile
+
+        if self.batch:
+            #only bother with the members that are still alive
+            alive = ~np.isnan(self.profile[:, 0]) & self.active
+            if not np.any(alive):
+                self.steps_done = self.ndt
+                return self.profile
+            self.profile[alive, :] = self.cs.calc_simulation_batch(self.D_vector, self.R_vector,
+                                                                   self.profile[alive, :], nsteps,
+                                                                   self.dt, self.dx, self.r[alive],
+                                                                   self.cv_factor[alive])
+        else:
+            #only the final profile is worth caching
+            self.profile = self.cs.calc_simulation(self.D_vector, self.R_vector, self.profile, nsteps,
+                                                   self.dt, self.dx, self.r, self.cv_factor, self.scheme, cached=False)
+        self.steps_done += nsteps
+        if self.finished and self.cache_key is not None:
+            self.cs.cache.put(self.cache_key, self.profile)
+        return self.profile
+
+    def __iter__(self):
+        while not self.finished and not self.cancelled:
+            self.advance()
+            yield self.steps_done, self.profile
+
+    def run(self, progress_cb=None):
+        """
+        Runs the simulation to the end, chunk by chunk, and returns the final profile(s)
+        Raises SimulationCancelledError if the run was cancelled before it finished
+
+        :param progress_cb: optional function called with the number of steps run so far after each chunk
+        """
+
+        for steps_done, profile in self:
+            if progress_cb is not None:
+                progress_cb(steps_done)
+        if not self.finished:
+            raise SimulationCancelledError(str.format('Simulation cancelled after {} of {} steps',
+                                                      self.steps_done, self.ndt))
+        return self.profile
 
 
 class SimulationUnstableError(Exception):
     pass
+
+
+class SimulationCancelledError(Exception):
+    pass
@@ -1,14 +1,40 @@
 """This file contains a class that simplifies setting up a simulation
 """
-from calcsim import CalcSimWrapper
+from calcsim import CalcSimWrapper, PropertyTables, SimulationMesh
 from datastore import InputDatastore
 import defaults
 import numpy as np
+import threading
 
 
 class CalcSimExecutor():
 
-    def __init__(self, dstore, T, ndt=defaults.simulation_tsteps, dt=defaults.simulation_dt):
+    def __init__(self, dstore, T, ndt=defaults.simulation_tsteps, dt=defaults.simulation_dt, scheme='explicit',
+                 property_rtol=None, converge_tol=None, converge_every=1000,
+                 mesh_points=None, mesh_ratio=4, mesh_width=None, remesh_every=None, threads=None,
+                 cache=None):
+        """
+        If property_rtol is given, D and R are turned into PropertyTables accurate to that relative tolerance and
+        read with linear interpolation (calc_simulation_tables); this is only available for the explicit scheme
+
+        If converge_tol is given, compute() stops a simulation early once it has reached a steady state (see
+        CalcSimWrapper.calc_simulation_converge); the number of steps it actually ran is left in steps_taken
+
+        If mesh_points is given, the simulation runs on a non-uniform mesh of that many nodes, up to mesh_ratio times
+        finer within about mesh_width (metres; an eighth of the domain by default) of the initial interface, and the
+        result is resampled onto the uniform x. If remesh_every is also given, the mesh is rebuilt around the
+        steepest part of the profile every remesh_every steps. dt is reduced if it is not stable for the smallest
+        cell, keeping the simulated time the same. Explicit scheme only
+
+        If threads is given, the plain explicit scheme runs on the multi-threaded, tiled kernel
+        (CalcSimWrapper.calc_simulation_parallel) with that many threads, 0 meaning as many as OpenMP likes. This pays
+        off when ndx is made much larger than the default
+
+        If cache (a simcache.SimulationCache) is given, compute() reuses the results of earlier runs with the same
+        inputs. It shares its entries with CalcSimWrapper.calc_simulation, as every kernel on the uniform grid gives
+        the same result to within rounding; property tables, convergence checking and non-uniform meshes are never
+        cached
+        """
         assert isinstance(dstore, InputDatastore)
 
         self.T = T
@@ -18,6 +44,11 @@ class CalcSimExecutor():
         self.dt = dt
         self.ndx = defaults.simulation_xsteps
         self.ndt = ndt
+        self.scheme = scheme
+        self.converge_tol = converge_tol
+        self.converge_every = converge_every
+        self.steps_taken = None
+        self.threads = threads
 
         #now we can set up the initial conditions
         #x in micron
@@ -25,18 +56,53 @@ class CalcSimExecutor():
         self.init_cond = np.ones(self.ndx)
         self.init_cond[(self.ndx // 2):] = 0
 
-        #D/R vectors
-        self.Dvector = dstore.interpolated_diffusivity(10001, T, precise=False).copy()
-        self.Rvector = dstore.interpolated_resistivity(10001, T).copy()
+        #D/R vectors; these are read-only, so can be shared rather than copied
+        self.Dvector = dstore.interpolated_diffusivity(10001, T, precise=False)
+        self.Rvector = dstore.interpolated_resistivity(10001, T)
+
+        self.tables = None
+        if property_rtol is not None:
+            if scheme != 'explicit':
+                raise ValueError('Property tables are only supported by the explicit scheme')
+            self.tables = PropertyTables(self.Dvector, self.Rvector, rtol=property_rtol)
+        if converge_tol is not None and property_rtol is not None:
+            raise ValueError('Convergence checking is not supported with property tables')
 
-        self.cs = CalcSimWrapper()
+        self.mesh = None
+        self.remesh_every = remesh_every
+        if mesh_points is not None:
+            if scheme != 'explicit' or property_rtol is not None or converge_tol is not None:
+                raise ValueError('Non-uniform meshes are only supported by the plain explicit scheme')
+            length = (self.ndx - 1) * self.dx
+            if mesh_width is None:
+                mesh_width = length / 8
+            #the step in init_cond is between these two nodes
+            centre = ((self.ndx // 2) - 0.5) * self.dx
+            self.mesh = SimulationMesh.around_interface(length, mesh_points, centre, mesh_width, mesh_ratio)
+            self.mesh_init_cond = self.mesh.resample(self.x * 1e-6, self.init_cond)
+
+        if threads is not None and (scheme != 'explicit' or property_rtol is not None or converge_tol is not None or
+                                    mesh_points is not None):
+            raise ValueError('The parallel kernel is only supported by the plain explicit scheme')
+
+        self.cs = CalcSimWrapper(cache=cache)
+
+        #the plain explicit scheme reuses one set of buffers for every compute(), where the library is available.
+        #A PreparedSimulation must not be shared between threads, so each thread that calls compute() gets its own
+        self.use_prepared = (scheme == 'explicit' and self.tables is None and self.mesh is None and
+                             converge_tol is None and threads is None and self.cs.libcalcsim is not None)
+        self.thread_local = threading.local()
         #now we're ready to fire on demand
 
-    def compute(self, z, cvf, I, direction):
+    def compute(self, z, cvf, I, direction, out_times=None):
         """
         Actually runs the simulation that's been set up, with the supplied
         parameters. I is supplied in A/cm^2
         Returns sim results as a 2 column array of x, y
+
+        If out_times (in seconds) is supplied, the profiles at each of those
+        times come from the one run, and the result has a column of x followed
+        by one column of y per time
         """
 
         if direction == 'forward':
@@ -47,6 +113,71 @@ class CalcSimExecutor():
             raise ValueError('Unknown direction ' + str(direction))
 
         r = self.cs.emigration_factor(z, I * 100 * 100, self.T)
-        outy = self.cs.calc_simulation(self.Dvector, self.Rvector, self.init_cond,
-                                       self.ndt, self.dt, self.dx, r, cvf)
-        return np.column_stack((self.x, outy))
\ No newline at end of file
+        if self.mesh is not None:
+            if out_times is not None:
+                raise ValueError('Non-uniform meshes do not support out_times')
+            return np.column_stack((self.x, self._compute_mesh(r, cvf)))
+        if self.tables is not None:
+            if out_times is not None:
+                raise ValueError('Property tables do not support out_times')
+            outy = self.cs.calc_simulation_tables(self.tables, self.init_cond, self.ndt, self.dt, self.dx, r, cvf)
+            return np.column_stack((self.x, outy))
+        if self.converge_tol is not None and out_times is None:
+            outy, self.steps_taken = self.cs.calc_simulation_converge(self.Dvector, self.Rvector, self.init_cond,
+                                                                      self.ndt, self.dt, self.dx, r, cvf,
+                                                                      self.converge_tol, self.converge_every,
+                                                                      scheme=self.scheme)
+            return np.column_stack((self.x, outy))
+        if self.cs.cache is not None:
+            key = self.cs.simulation_key(self.Dvector, self.Rvector, self.init_cond, self.ndt, self.dt, self.dx,
+                                         r, cvf, self.scheme, out_times)
+            outy = self.cs.cache.get_or_compute(key, lambda: self._compute_uniform(r, cvf, out_times))
+        else:
+            outy = self._compute_uniform(r, cvf, out_times)
+        return np.column_stack((self.x, outy.T))
+
+    def _compute_uniform(self, r, cvf, out_times):
+        """
+        Runs the simulation on the uniform grid, with whichever kernel suits the options given
+        """
+
+        if self.threads is not None and out_times is None:
+            return self.cs.calc_simulation_parallel(self.Dvector, self.Rvector, self.init_cond,
+                                                    self.ndt, self.dt, self.dx, r, cvf, threads=self.threads)
+        if self.use_prepared and out_times is None:
+            return self._prepared().run(self.init_cond, self.ndt, self.dt, self.dx, r, cvf)
+        #compute() has already looked in the cache
+        return self.cs.calc_simulation(self.Dvector, self.Rvector, self.init_cond, self.ndt, self.dt, self.dx,
+                                       r, cvf, self.scheme, out_times, cached=False)
+
+    def _prepared(self):
+        """
+        The calling thread's PreparedSimulation, made the first time it is needed
+        """
+
+        prepared = getattr(self.thread_local, 'prepared', None)
+        if prepared is None:
+            prepared = self.thread_local.prepared = self.cs.prepare(self.Dvector, self.Rvector, self.ndx)
+        return prepared
+
+    def _compute_mesh(self, r, cvf):
+        """
+        Runs the simulation on self.mesh and returns it resampled onto the uniform x
+        """
+
+        dt = self.dt
+        ndt = self.ndt
+        if dt > self.cs.max_stable_dt(self.mesh.min_dx, self.Dvector, cvf):
+            dt = self.cs.optimum_dt(self.mesh.min_dx, self.Dvector, cvf)
+            ndt = self.cs.num_sim_steps(dt, self.ndt * self.dt)
+            dt = self.ndt * self.dt / ndt
+        self.steps_taken = ndt
+
+        if self.remesh_every is not None:
+            mesh_x, outy = self.cs.calc_simulation_remesh(self.Dvector, self.Rvector, self.mesh_init_cond, ndt, dt,
+                                                          self.mesh, r, cvf, self.remesh_every)
+        else:
+            mesh_x = self.mesh.x
+            outy = self.cs.calc_simulation_mesh(self.Dvector, self.Rvector, self.mesh_init_cond, ndt, dt,
+                                                mesh_x, r, cvf)
+        return np.interp(self.x * 1e-6, mesh_x, outy)
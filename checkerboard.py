@@ -1,4 +1,6 @@
+from functools import partial
 from calcsimexecutor import CalcSimExecutor
+from modelfit import abs_cvf
 from datastore import InputDatastore
 from pylab import *
 import defaults
@@ -6,7 +8,7 @@ from expercomparison import ComparisonEngine
 
 __author__ = 'kj'
 z = 160
-cvfunc = lambda ID: 0.53e-3 * abs(ID) + 1
+cvfunc = partial(abs_cvf, 0.53e-3)
 dstore = InputDatastore('../InputData', 'NiCu')
 
 figure(figsize=(11, 7.7))
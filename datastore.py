@@ -4,18 +4,29 @@
 import numpy as np
 import os.path
 import scipy.interpolate as interp
-import functools
+
+from inputbundle import InputBundle
+from propertycache import PropertyTableCache
+
+
+#where every InputDatastore keeps its D and R tables unless it's given a cache of its own
+DEFAULT_TABLE_CACHE = PropertyTableCache()
 
 
 class InputDatastore():
 
-    def __init__(self, data_dir, prefix):
+    def __init__(self, data_dir, prefix, *, table_cache=None, bundle_dir=None):
         """
-        Initialiser for this datastore
+        Initialiser for this datastore. Nothing is read here: the csv files are compiled into an InputBundle the
+        first time any of them is needed, and each dataset is loaded from it when it's first used, so making a
+        datastore is cheap and later ones (in this or any other process) don't parse the text again
 
         :param data_dir: Directory where the csv files are found
         :param prefix: Prefix for the filenames
-        :param Tfloat: Temperature in kelvin
+        :param table_cache: PropertyTableCache for the interpolated D and R tables; by default, one shared by every
+            datastore in the process. Give every worker process a cache with the same shared_dir to share the tables
+            between them
+        :param bundle_dir: Directory to keep the compiled bundle in; data_dir by default
         """
 
         #we store 3 kinds of data
@@ -25,37 +36,87 @@ class InputDatastore():
         fw_exper_name = os.path.join(data_dir, str.format('{}_Experimental_{}_{}K.csv', prefix, 'forward', '973'))
         rv_exper_name = os.path.join(data_dir, str.format('{}_Experimental_{}_{}K.csv', prefix, 'reverse', '973'))
 
-        self.precise_diff_raw = np.genfromtxt(precise_diff_name, skip_header=1)
+        sources = {
+            'precise_diff': (precise_diff_name, {'skip_header': 1}),
+            #'resistivity': (resist_name, {'skip_header': 1}),
+            'experimental_fw': (fw_exper_name, {'skip_header': 0, 'delimiter': ','}),
+            'experimental_rv': (rv_exper_name, {'skip_header': 0, 'delimiter': ','}),
+            'diffusivity_arrhenius': (diff_arrhenius_name, {'delimiter': ','})
+        }
+        #the 3 resistivity functions
+        self.resistivity_temperatures = (900, 1000, 1100)
+        for T in self.resistivity_temperatures:
+            fname = os.path.join(data_dir, "{}_Resistivity_{}K.csv".format(prefix, T))
+            sources[str.format('resistivity_{}', T)] = (fname, {'skip_header': 1, 'delimiter': ','})
+
+        bundle_name = os.path.join(bundle_dir if bundle_dir is not None else data_dir, prefix + '_Inputs.bundle')
+        self.bundle = InputBundle(bundle_name, sources)
+        self.loaded = {}
 
-        #self.resistivity_raw = np.genfromtxt(resist_name, skip_header=1)
-        self.experimental_fw_raw = np.genfromtxt(fw_exper_name, skip_header=0, delimiter=',')
-        self.experimental_rv_raw = np.genfromtxt(rv_exper_name, skip_header=0, delimiter=',')
+        #tables are cached under where their data came from, and when it was last changed
+        self.table_cache = table_cache if table_cache is not None else DEFAULT_TABLE_CACHE
+        self.table_source = [os.path.abspath(precise_diff_name), os.path.abspath(diff_arrhenius_name),
+                             os.path.getmtime(precise_diff_name), os.path.getmtime(diff_arrhenius_name)]
 
-        #xaxis assumed to be the same between fw and rv
-        self.experimental_x = self.experimental_rv_raw[1:, 0]
+    def _lazy(self, name, load):
+        #two threads may both load a dataset the first time; they get the same values either way
+        if name not in self.loaded:
+            self.loaded[name] = load()
+        return self.loaded[name]
 
-        self.experimental_fw_dict = {}
-        self.experimental_rv_dict = {}
+    @property
+    def precise_diff_raw(self):
+        return self.bundle.get('precise_diff')
 
-        for raw, edict in ((self.experimental_fw_raw, self.experimental_fw_dict),
-                          (self.experimental_rv_raw, self.experimental_rv_dict)):
-            nSets = np.shape(raw)[1] - 1
-            for col_index in range(1, nSets + 1):
-                current = int(np.round(np.abs(raw[0, col_index])))
-                edict[current] = raw[1:, col_index]
+    @property
+    def experimental_fw_raw(self):
+        return self.bundle.get('experimental_fw')
 
-        #the 3 resistivity functions
-        self.resistivity_raw = {}
-        self.resistivity_splines = {}
-        for T in (900, 1000, 1100):
-            fname = os.path.join(data_dir, "{}_Resistivity_{}K.csv".format(prefix, T))
-            self.resistivity_raw[T] = np.genfromtxt(fname, skip_header=1, delimiter=',')
-            self.resistivity_raw[T][:, 0] = 1 - self.resistivity_raw[T][:, 0]
-            self.resistivity_splines[T] = interp.InterpolatedUnivariateSpline(self.resistivity_raw[T][:, 0],
-                                                                              self.resistivity_raw[T][:, 1])
+    @property
+    def experimental_rv_raw(self):
+        return self.bundle.get('experimental_rv')
 
-        #load up arrhenius constants
-        self.diffusivity_arrhenius_constants = np.genfromtxt(diff_arrhenius_name, delimiter=',')
+    @property
+    def experimental_x(self):
+        #xaxis assumed to be the same between fw and rv
+        return self.experimental_rv_raw[1:, 0]
+
+    @staticmethod
+    def _experiment_columns(raw):
+        edict = {}
+        nSets = np.shape(raw)[1] - 1
+        for col_index in range(1, nSets + 1):
+            current = int(np.round(np.abs(raw[0, col_index])))
+            edict[current] = raw[1:, col_index]
+        return edict
+
+    @property
+    def experimental_fw_dict(self):
+        return self._lazy('experimental_fw_dict', lambda: self._experiment_columns(self.experimental_fw_raw))
+
+    @property
+    def experimental_rv_dict(self):
+        return self._lazy('experimental_rv_dict', lambda: self._experiment_columns(self.experimental_rv_raw))
+
+    @property
+    def resistivity_raw(self):
+        def load():
+            raw = {}
+            for T in self.resistivity_temperatures:
+                raw[T] = np.array(self.bundle.get(str.format('resistivity_{}', T)))
+                raw[T][:, 0] = 1 - raw[T][:, 0]
+            return raw
+        return self._lazy('resistivity_raw', load)
+
+    @property
+    def resistivity_splines(self):
+        return self._lazy('resistivity_splines', lambda: dict(
+            (T, interp.InterpolatedUnivariateSpline(raw[:, 0], raw[:, 1]))
+            for T, raw in self.resistivity_raw.items()))
+
+    @property
+    def diffusivity_arrhenius_constants(self):
+        return self.bundle.get('diffusivity_arrhenius')
 
     def interpolated_vector(self, operative_vec, size):
 
@@ -63,8 +124,19 @@ class InputDatastore():
         x = np.linspace(0, 1, num=size)
         return spline(x)
 
-    @functools.lru_cache(maxsize=512)
     def interpolated_diffusivity(self, size, T, precise=False):
+        """
+        Diffusivity at size evenly spaced concentrations from 0 to 1, at temperature T; precise takes it from the
+        measured 973K data instead of the Arrhenius fit, and ignores T. The result is cached, and read-only
+        """
+
+        if precise:
+            key = self.table_cache.key('precise diffusivity', *(self.table_source + [size]))
+        else:
+            key = self.table_cache.key('diffusivity', *(self.table_source + [size, T]))
+        return self.table_cache.get_or_compute(key, lambda: self._interpolated_diffusivity(size, T, precise))
+
+    def _interpolated_diffusivity(self, size, T, precise):
         if precise:
             return self.interpolated_vector(self.precise_diff_raw, size)
         x = np.linspace(0, 1, size)
@@ -88,8 +160,16 @@ class InputDatastore():
         #return np.ones(len(Dout)) * dmean
         return Dout
 
-    @functools.lru_cache(maxsize=512)
     def interpolated_resistivity(self, size, T):
+        """
+        Resistivity at size evenly spaced concentrations from 0 to 1, at temperature T. The result is cached, and
+        read-only
+        """
+
+        key = self.table_cache.key('resistivity', size, T)
+        return self.table_cache.get_or_compute(key, lambda: self._interpolated_resistivity(size, T))
+
+    def _interpolated_resistivity(self, size, T):
         x = np.linspace(0, 1, size)
         a2 = 0.0461 * T - 144.7
         a1 = -0.0275 * T + 161.1
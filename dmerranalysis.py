@@ -6,6 +6,8 @@ from matplotlib.backends.backend_agg import FigureCanvasAgg
 from calcsim import CalcSimWrapper
 from datastore import InputDatastore
 from expercomparison import ComparisonEngine
+from paramsearch import combine_maps
+from simcache import SimulationCache
 import numpy as np
 import dmplots
 
@@ -19,10 +21,14 @@ aparser.add_argument('--dataprefix', metavar='PREFIX', type=str, default='NiCu',
                      help='Prefix to data files')
 aparser.add_argument('--temperature', type=float, default=973,
                      help='Temperature in K')
+aparser.add_argument('--simcache', metavar='DIR', type=str, default=None,
+                     help='Keep simulation results in DIR and reuse them when the same simulation is run again')
 
 args = aparser.parse_args()
 
-accelcs = CalcSimWrapper()
+simcache = SimulationCache(args.simcache) if args.simcache is not None else None
+
+accelcs = CalcSimWrapper(cache=simcache)
 
 dstore = InputDatastore(args.inputdata, args.dataprefix)
 x = np.linspace(0, 25, num=100)
@@ -109,11 +115,11 @@ cresults = {}
 
 #multiply forward/reverse maps to get current-min maps
 for I in fresults.keys():
-    combined_map = fresults[I] * rresults[I]
+    combined_map = combine_maps(fresults[I], rresults[I])
     cresults[I] = combined_map
     if I == 0:
         continue
-    min_indicies = np.unravel_index(combined_map.argmin(), combined_map.shape)
+    min_indicies = np.unravel_index(np.nanargmin(combined_map), combined_map.shape)
     min_z = zrange[min_indicies[0]]
     print(str.format('Combined z* for I = {}: {}', I, min_z))
     zvalues.append(min_z)
@@ -135,10 +141,10 @@ for I in cresults.keys():
 
     bounds_min = cvfrange[contig_idxs[contig_largest_idx][0]]
     bounds_max = cvfrange[contig_idxs[contig_largest_idx][1] - 1]
-    bounds_best = cvfrange[bounds_column.argmin()]
+    bounds_best = cvfrange[np.nanargmin(bounds_column)]
 
-    assert(bounds_column.argmin() >= contig_idxs[contig_largest_idx][0])
-    assert(bounds_column.argmin() <= contig_idxs[contig_largest_idx][1])
+    assert(np.nanargmin(bounds_column) >= contig_idxs[contig_largest_idx][0])
+    assert(np.nanargmin(bounds_column) <= contig_idxs[contig_largest_idx][1])
 
     print(str.format('I = {}, min, max, best = {}, {}, {}', I, bounds_min, bounds_max, bounds_best))
     cbounds[I] = bounds_best - bounds_min, bounds_best, bounds_max - bounds_best
@@ -182,3 +188,7 @@ for direction in ('forward', 'reverse'):
             c.print_figure(outfile)
 
 
+
+if simcache is not None:
+    print(str.format('Simulation cache: {hits} hits, {misses} misses, {entries} results in {bytes} bytes',
+                     **simcache.stats()))
@@ -1,5 +1,7 @@
 """Plotting utilities for the vacancy search
 """
+import copy
+
 from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
 from matplotlib.figure import Figure
 from matplotlib import cm
@@ -9,7 +11,10 @@ def plot_search_map(datamap, zlim, cvflim, I, direction, fname):
     fig = Figure()
     ax = fig.add_subplot(111)
     extent = cvflim[0], cvflim[1], zlim[0], zlim[1]
-    im = ax.imshow(datamap, cmap=cm.jet, interpolation='nearest', extent=extent, origin='lower')
+    #unstable points (NaN) and pruned ones (paramsearch.PRUNED, infinite) are left out of the colour scale by imshow
+    cmap = copy.copy(cm.jet)
+    cmap.set_bad('lightgrey')
+    im = ax.imshow(datamap, cmap=cmap, interpolation='nearest', extent=extent, origin='lower')
     fig.colorbar(im)
     ax.set_aspect('auto')
     ax.set_xlabel('Vacancy concentration multiplier')
@@ -13,8 +13,11 @@ from progressbar import ProgressBar, Percentage, Bar
 
 from datastore import InputDatastore
 from calcsim import CalcSimWrapper
-from expercomparison import ComparisonEngine
-from paramsearch import ParamSearchEngine
+from expercomparison import compare_batch
+from paramsearch import ParamSearchEngine, combine_maps
+from searchcluster import SearchCoordinator, parse_address
+from searchjournal import SearchJournal
+from simcache import SimulationCache
 
 
 aparser = ArgumentParser(description='Searches for the optimum vacancy concentration multiplier')
@@ -32,11 +35,42 @@ aparser.add_argument('--cvflim', metavar=('CVFMIN', 'CVFMAX', 'CVFSTEP'), nargs=
                      help='Limits of the vacancy concentration multiplier search (up to but not including CVFSTEP)')
 aparser.add_argument('--resume', action='store_true', default=False,
                      help='Resume using .csv files in outputdir')
+aparser.add_argument('--journal', metavar='FILE', type=str, default=None,
+                     help='Record every simulation in this SQLite file as it finishes, and skip any already in it; '
+                          'a killed search then picks up where it left off')
+aparser.add_argument('--distribute', metavar='HOST:PORT', type=str, default=None,
+                     help='Listen on HOST:PORT and hand the search out to workers started with searchcluster.py; '
+                          'give the workers their own --journal and --simcache')
+aparser.add_argument('--authkey', type=str, default='diffsim',
+                     help='Shared secret for --distribute; the workers must be given the same one')
+aparser.add_argument('--adaptive', metavar='COARSE_STEP', type=int, default=None,
+                     help='Start from every COARSE_STEP\'th point of the search and only refine near the minimum, '
+                          'interpolating the rest of the map')
+aparser.add_argument('--simcache', metavar='DIR', type=str, default=None,
+                     help='Keep simulation results in DIR and reuse them when the same simulation is run again')
+aparser.add_argument('--prune', metavar='LSQ', type=float, default=None,
+                     help='Stop simulations part way through once their estimated error is above LSQ; those points '
+                          'are left as inf in the maps and grey in the plots. This is lossy: the estimate is a '
+                          'heuristic, so a point that would have finished under LSQ can be pruned. Pick LSQ well above '
+                          'the errors of interest')
+aparser.add_argument('--fractional-shift', action='store_true', default=False,
+                     help='Align each simulation with experiment to a fraction of a cell rather than a whole one, '
+                          'so coarse grids fit as well as fine ones')
 
 args = aparser.parse_args()
 
+if args.distribute is not None:
+    #the workers run the simulations, so the journal and cache are theirs; shards are fixed lists of points, so they
+    #can't be refined as --adaptive does
+    if args.journal is not None or args.simcache is not None:
+        aparser.error('--journal and --simcache can\'t be used with --distribute; pass them to searchcluster.py')
+    if args.adaptive is not None:
+        aparser.error('--adaptive can\'t be used with --distribute')
+
+simcache = SimulationCache(args.simcache) if args.simcache is not None else None
+
 dstore = InputDatastore(args.inputdata, args.dataprefix)
-accelcs = CalcSimWrapper()
+accelcs = CalcSimWrapper(cache=simcache)
 
 zrange = np.arange(args.zlim[0], args.zlim[1], args.zlim[2])
 cvfrange = np.arange(args.cvflim[0], args.cvflim[1], args.cvflim[2])
@@ -47,6 +81,25 @@ rresults = dict()
 np.savetxt(path.join(args.outputdir, 'zrange.csv'), zrange, delimiter=',')
 np.savetxt(path.join(args.outputdir, 'cvfrange.csv'), cvfrange, delimiter=',')
 
+#currents whose combined map has already been plotted
+plotted_combined = set()
+
+
+def save_search_map(direction, I, search_map):
+    outpath = path.join(args.outputdir, str.format('Searchmap_I{}_{}.png', I, direction))
+    dmplots.plot_search_map(search_map, (zrange[0], zrange[-1]), (cvfrange[0], cvfrange[-1]),
+                            I, direction, outpath)
+    outpath = path.join(args.outputdir, str.format('Searchmap_I{}_{}.csv', I, direction))
+    np.savetxt(outpath, search_map, delimiter=',')
+
+
+def plot_combined_map(I, combined_map):
+    outpath = path.join(args.outputdir, str.format('Searchmap_I{}_combined.png', I))
+    dmplots.plot_search_map(combined_map, (zrange[0], zrange[-1]), (cvfrange[0], cvfrange[-1]), I,
+                            'combined', outpath)
+    plotted_combined.add(I)
+
+
 if args.resume:
     files = [path.join(args.outputdir, f) for f in os.listdir(args.outputdir)
              if path.isfile(path.join(args.outputdir, f))]
@@ -61,24 +114,57 @@ if args.resume:
         print(str.format('Processing {}', f))
         I = -float(re.match(rx, f).groups()[0])
         rresults[I] = np.genfromtxt(f, skip_header=0, delimiter=',')
-else:
+elif args.distribute is not None:
+    coordinator = SearchCoordinator(parse_address(args.distribute), args.authkey.encode('utf-8'))
+    print(str.format('Waiting for search workers on {}', coordinator.address))
+    jobs = [(args.temperature, direction, I) for direction in ('forward', 'reverse')
+            for I in dstore.edict_for_direction(direction).keys()]
+    pbar = ProgressBar(widgets=['Parameter search: ', Percentage(), ' ', Bar()],
+                       maxval=len(zrange) * len(cvfrange) * len(jobs))
+    pbar.start()
+    search_maps = coordinator.search(zrange, cvfrange, jobs, pbar.update,
+                                     settings={'prune_threshold': args.prune,
+                                               'fractional_shift': args.fractional_shift})
+    coordinator.close()
+    print('\n')
+    for (T, direction, I), search_map in sorted(search_maps.items()):
+        save_search_map(direction, I, search_map)
+        (fresults if direction == 'forward' else rresults)[I] = search_map
+elif args.adaptive is not None:
     #do search for forward/back
     for direction, result_stash in [('forward', fresults), ('reverse', rresults)]:
         search_engine = ParamSearchEngine(accelcs, dstore)
+        if args.journal is not None:
+            search_engine.journal = SearchJournal(args.journal)
+        search_engine.prune_threshold = args.prune
+        search_engine.fractional_shift = args.fractional_shift
         edict = dstore.edict_for_direction(direction)
         for I in edict.keys():
             print(str.format('{} bias, I = {}', direction, I))
             pbar = ProgressBar(widgets=['Parameter search: ', Percentage(), ' ', Bar()],
                                maxval=len(zrange) * len(cvfrange))
             pbar.start()
-            search_map = search_engine.search(zrange, cvfrange, I, args.temperature, pbar.update, direction)
+            search_map = search_engine.search_adaptive(zrange, cvfrange, I, args.temperature, pbar.update,
+                                                       direction, coarse_step=args.adaptive)
             print('\n')
+            save_search_map(direction, I, search_map)
             result_stash[I] = search_map
-            outpath = path.join(args.outputdir, str.format('Searchmap_I{}_{}.png', I, direction))
-            dmplots.plot_search_map(search_map, (zrange[0], zrange[-1]), (cvfrange[0], cvfrange[-1]),
-                                    I, direction, outpath)
-            outpath = path.join(args.outputdir, str.format('Searchmap_I{}_{}.csv', I, direction))
-            np.savetxt(outpath, search_map, delimiter=',')
+else:
+    #every current in both directions at once; each map is saved as soon as it is done
+    search_engine = ParamSearchEngine(accelcs, dstore)
+    if args.journal is not None:
+        search_engine.journal = SearchJournal(args.journal)
+    search_engine.prune_threshold = args.prune
+    search_engine.fractional_shift = args.fractional_shift
+    nmaps = len(dstore.edict_for_direction('forward')) + len(dstore.edict_for_direction('reverse'))
+    pbar = ProgressBar(widgets=['Parameter search: ', Percentage(), ' ', Bar()],
+                       maxval=len(zrange) * len(cvfrange) * nmaps)
+    pbar.start()
+    search_results = search_engine.search_all(zrange, cvfrange, args.temperature, pbar.update,
+                                              map_cb=save_search_map, combined_cb=plot_combined_map)
+    print('\n')
+    fresults.update(search_results['forward'])
+    rresults.update(search_results['reverse'])
 
 fzaverage = 0
 ict = 0
@@ -87,14 +173,13 @@ cresults = {}
 
 #multiply forward/reverse maps to get current-min maps
 for I in fresults.keys():
-    combined_map = fresults[I] * rresults[I]
-    outpath = path.join(args.outputdir, str.format('Searchmap_I{}_combined.png', I))
-    dmplots.plot_search_map(combined_map, (zrange[0], zrange[-1]), (cvfrange[0], cvfrange[-1]), I,
-                            'combined', outpath)
+    combined_map = combine_maps(fresults[I], rresults[I])
+    if I not in plotted_combined:
+        plot_combined_map(I, combined_map)
     cresults[I] = combined_map
     if I == 0:
         continue
-    min_indicies = np.unravel_index(combined_map.argmin(), combined_map.shape)
+    min_indicies = np.unravel_index(np.nanargmin(combined_map), combined_map.shape)
     min_z = zrange[min_indicies[0]]
     print(str.format('Combined z* for I = {}: {}', I, min_z))
     zvalues.append(min_z)
@@ -113,7 +198,7 @@ print(str.format('Rounding to {}', zaverage_rounded))
 #now find our optimum positions
 for direction, result_stash in [('forward', fresults), ('reverse', rresults), ('combined', cresults)]:
     for I in result_stash.keys():
-        min_indicies = np.unravel_index(result_stash[I].argmin(), result_stash[I].shape)
+        min_indicies = np.unravel_index(np.nanargmin(result_stash[I]), result_stash[I].shape)
         min_val = (zrange[min_indicies[0]], cvfrange[min_indicies[1]])
         print(str.format('{} bias, I = {}: best (z*, cvf) = ({}, {})', direction, I,
               min_val[0], min_val[1]))
@@ -121,7 +206,7 @@ for direction, result_stash in [('forward', fresults), ('reverse', rresults), ('
     cvf_plotlist = []
     I_plotlist = []
     for I in result_stash.keys():
-        cvf_best = cvfrange[result_stash[I][zaverage_index, :].argmin()]
+        cvf_best = cvfrange[np.nanargmin(result_stash[I][zaverage_index, :])]
         cvf_plotlist.append(cvf_best)
         I_plotlist.append(np.abs(I))
 
@@ -135,7 +220,7 @@ for direction, result_stash in [('forward', fresults), ('reverse', rresults), ('
     #let's plot z* as well
     z_plotlist = []
     for I in I_plotlist:
-        z_best_idx = np.unravel_index(result_stash[I].argmin(), result_stash[I].shape)[1]
+        z_best_idx = np.unravel_index(np.nanargmin(result_stash[I]), result_stash[I].shape)[1]
         z_best = zrange[z_best_idx]
         z_plotlist.append(z_best)
 
@@ -149,8 +234,7 @@ for direction, result_stash in [('forward', fresults), ('reverse', rresults), ('
         x = np.linspace(0, 25, num=100)
         dstore = InputDatastore(args.inputdata, args.dataprefix)
         edict = dstore.edict_for_direction(direction)
-        accelcs = CalcSimWrapper()
-        ce = ComparisonEngine(accelcs)
+        accelcs = CalcSimWrapper(cache=simcache)
         diffusivity = dstore.interpolated_diffusivity(10001, args.temperature, precise=True)
         resistivity = dstore.interpolated_resistivity(10001, args.temperature)
         init_cond = np.ones(100)
@@ -160,7 +244,7 @@ for direction, result_stash in [('forward', fresults), ('reverse', rresults), ('
         ndt = int(2 * 60 * 60 / 0.05)
         dx = 25e-6 / 100
         for I in result_stash.keys():
-            cvf_best = cvfrange[result_stash[I][zaverage_index, :].argmin()]
+            cvf_best = cvfrange[np.nanargmin(result_stash[I][zaverage_index, :])]
             if direction == 'forward':
                 exper_data = dstore.interpolated_experiment_dict(x, edict)[I]
                 r = accelcs.emigration_factor(zaverage_rounded, I * 100 * 100, emigration_T)
@@ -168,8 +252,9 @@ for direction, result_stash in [('forward', fresults), ('reverse', rresults), ('
                 exper_data = dstore.interpolated_experiment_dict(x, edict)[I]
                 r = accelcs.emigration_factor(zaverage_rounded, -I * 100 * 100, emigration_T)
             simd = accelcs.calc_simulation(diffusivity, resistivity, init_cond, ndt, dt, dx, r, cvf_best)
-            lsq, shift = ce.calibrate(simd, exper_data)
-            shifted_simd = ce.shift_data(simd)
+            shifts, lsqs, shifted = compare_batch(accelcs, simd, exper_data, shifted=True,
+                                                  fractional=args.fractional_shift)
+            shifted_simd = shifted[0]
             full_simd = np.column_stack((x, shifted_simd))
             full_exper = np.column_stack((x, exper_data))
             outfname = os.path.join(args.outputdir, str.format('SimExperComp_I{}_{}.png', I, direction))
@@ -177,3 +262,7 @@ for direction, result_stash in [('forward', fresults), ('reverse', rresults), ('
             c = FigureCanvasAgg(f)
             c.print_figure(outfname)
 
+
+if simcache is not None:
+    print(str.format('Simulation cache: {hits} hits, {misses} misses, {entries} results in {bytes} bytes',
+                     **simcache.stats()))
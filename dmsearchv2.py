@@ -6,7 +6,7 @@ from datastore import InputDatastore
 from dmplots import plot_search_map
 import dmplots
 from expercomparison import ComparisonEngine
-from paramsearch import ParamSearchEngine
+from paramsearch import ParamSearchEngine, combine_maps
 from os import path
 
 from pylab import *
@@ -80,13 +80,13 @@ for direct in ('forward', 'reverse'):
 results['combined'] = {}
 zs = []
 for I in results['forward'].keys():
-    results['combined'][I] = results['forward'][I] * results['reverse'][I]
+    results['combined'][I] = combine_maps(results['forward'][I], results['reverse'][I])
     savetxt(get_fname('{}_I{}.csv'.format('combined', I)), results['combined'][I], delimiter=',')
     plot_search_map(results['combined'][I], (zrange[0], zrange[-1]), (cvfrange[0], cvfrange[-1]), I, 'combined',
                     get_fname('{}_I{}.png'.format('combined', I)))
 
     r = results['combined'][I]
-    min_indicies = unravel_index(r.argmin(), r.shape)
+    min_indicies = unravel_index(nanargmin(r), r.shape)
     min_val = (zrange[min_indicies[0]], cvfrange[min_indicies[1]])
     print('I = {}: z* = {}, cvf = {}'.format(I, min_val[0], min_val[1]))
     if I != 0:
@@ -110,10 +110,10 @@ for I in cresults.keys():
 
     bounds_min = cvfrange[contig_idxs[contig_largest_idx][0]]
     bounds_max = cvfrange[contig_idxs[contig_largest_idx][1] - 1]
-    bounds_best = cvfrange[bounds_column.argmin()]
+    bounds_best = cvfrange[nanargmin(bounds_column)]
 
-    assert(bounds_column.argmin() >= contig_idxs[contig_largest_idx][0])
-    assert(bounds_column.argmin() <= contig_idxs[contig_largest_idx][1])
+    assert(nanargmin(bounds_column) >= contig_idxs[contig_largest_idx][0])
+    assert(nanargmin(bounds_column) <= contig_idxs[contig_largest_idx][1])
 
     print(str.format('I = {}, min, max, best = {}, {}, {}', I, bounds_min, bounds_max, bounds_best))
     cbounds[I] = bounds_best - bounds_min, bounds_best, bounds_max - bounds_best
@@ -5,14 +5,153 @@ import numpy as np
 from calcsim import CalcSimWrapper
 
 
+def shift_batch(models, shifts):
+    """
+    Shifts every row of models by the matching entry of shifts, as ComparisonEngine.shift_data does: a positive
+    shift moves the profile right and pads with ones on the left, a negative one moves it left and pads with zeros on
+    the right. Fractional shifts are applied by linear interpolation between the neighbouring cells (padding
+    included); whole ones just move the data
+
+    :param models: (N, ndx) array of profiles
+    :param shifts: vector of N shifts, each between -ndx and ndx
+    :return: (N, ndx) array of shifted profiles
+    """
+
+    models = np.atleast_2d(models)
+    nmodels, ndx = np.shape(models)
+    shifts = np.asarray(shifts, dtype=np.float64).reshape(nmodels, 1)
+
+    padded = np.concatenate((np.ones((nmodels, ndx)), models, np.zeros((nmodels, ndx))), axis=1)
+    rows = np.arange(nmodels)[:, np.newaxis]
+
+    #position of each output point in padded, and the cell to its left
+    pos = ndx + np.arange(ndx) - shifts
+    left = np.floor(pos).astype(np.intp)
+    frac = pos - left
+    right = np.minimum(left + 1, 3 * ndx - 1)
+    shifted = padded[rows, left]
+    if np.any(frac != 0):
+        shifted = shifted * (1 - frac) + padded[rows, right] * frac
+    return shifted
+
+
+def refine_shifts(models, experiment, shifts, lsqs):
+    """
+    Refines whole-cell shifts from fast_pad_shift to a fraction of a cell: a parabola through the LSQ at each shift
+    and its two neighbours gives the sub-cell minimum, and that fractional shift is kept if the profile shifted by
+    it (see shift_batch) really does fit better
+
+    :param models: (N, ndx) array of profiles
+    :param experiment: vector of ndx experimental values
+    :param shifts: vector of N whole-cell shifts
+    :param lsqs: vector of N LSQ values at those shifts
+    :return: (vector of N fractional shifts, vector of N LSQ values)
+    """
+
+    models = np.atleast_2d(models)
+    ndx = np.shape(models)[1]
+    shifts = np.asarray(shifts, dtype=np.float64)
+    lsqs = np.asarray(lsqs, dtype=np.float64)
+
+    #shifts at the ends of the range have only one neighbour, so stay as they are
+    inner = (shifts > -ndx) & (shifts < ndx)
+    lsq_left = np.sum((shift_batch(models, np.where(inner, shifts - 1, shifts)) - experiment) ** 2, axis=1)
+    lsq_right = np.sum((shift_batch(models, np.where(inner, shifts + 1, shifts)) - experiment) ** 2, axis=1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        curvature = lsq_left - 2 * lsqs + lsq_right
+        offset = np.where(inner & (curvature > 0), 0.5 * (lsq_left - lsq_right) / curvature, 0)
+    offset = np.nan_to_num(np.clip(offset, -0.5, 0.5))
+
+    refined = shifts + offset
+    refined_lsqs = np.sum((shift_batch(models, refined) - experiment) ** 2, axis=1)
+    better = refined_lsqs < lsqs
+    return np.where(better, refined, shifts), np.where(better, refined_lsqs, lsqs)
+
+
+def compare_batch(cs, models, experiment, shifted=False, fractional=False):
+    """
+    Aligns each row of models to experiment, as ComparisonEngine.calibrate does, in one vectorized pass. Nothing is
+    stored anywhere, so this is safe to call from any number of threads at once
+
+    Rows containing NaN (i.e. unstable simulations) get a shift of 0 and an LSQ of NaN
+
+    :param cs: the CalcSimWrapper to do the alignment with
+    :param models: (N, ndx) array of model profiles, or a single profile
+    :param experiment: vector of ndx experimental values
+    :param shifted: if True, the shifted profiles are returned as well
+    :param fractional: if True, the shifts are refined to a fraction of a cell (see refine_shifts), so alignment is
+        no longer limited by the grid spacing; the shifts are then floats
+    :return: (shifts, lsqs), or (shifts, lsqs, shifted profiles) if shifted is True
+    """
+
+    assert isinstance(cs, CalcSimWrapper)
+
+    models = np.atleast_2d(models)
+    if np.shape(models)[1] != len(experiment):
+        raise ValueError("Model and experiment must be the same length")
+
+    good = ~np.any(np.isnan(models), axis=1)
+    shifts = np.zeros(len(models), dtype=np.float64 if fractional else np.int32)
+    lsqs = np.full(len(models), np.nan)
+    if np.any(good):
+        good_shifts, good_lsqs = cs.fast_pad_shift_batch(experiment, models[good])
+        if fractional:
+            good_shifts, good_lsqs = refine_shifts(models[good], experiment, good_shifts, good_lsqs)
+        shifts[good], lsqs[good] = good_shifts, good_lsqs
+
+    if shifted:
+        return shifts, lsqs, shift_batch(models, shifts)
+    return shifts, lsqs
+
+
+def interface_width(profiles):
+    """
+    A smooth measure of how spread out the interface in each profile is, in cells: 4 * sum(C * (1 - C)), which for
+    a linear ramp from 1 to 0 is its length, and for a diffusion profile grows as sqrt(D t)
+
+    :param profiles: (N, ndx) array of profiles, or a single profile
+    :return: vector of N widths
+    """
+
+    profiles = np.atleast_2d(profiles)
+    return 4 * np.sum(np.clip(profiles, 0, 1) * (1 - np.clip(profiles, 0, 1)), axis=1)
+
+
+def lsq_prune_estimate(cs, profiles, experiment):
+    """
+    A cheap estimate of the LSQ that partly-run simulations will end up with, for pruning a search. Interfaces mostly
+    broaden as a simulation runs, so once a profile's interface is already wider than the experiment's, running it
+    further is expected to make the fit worse: its best-aligned LSQ now is taken as the estimate. Profiles still
+    narrower than the experiment could yet match it, and get an estimate of 0.
+
+    This is a heuristic, not a lower bound: electromigration can sharpen an interface, and a profile's shape can still
+    change once it is wider than the experiment's, so a simulation can finish with a smaller LSQ than its estimate.
+    Pruning on it is lossy, and pruned points must never be treated as finished results
+
+    :param cs: the CalcSimWrapper to do the alignment with
+    :param profiles: (N, ndx) array of partly-run profiles
+    :param experiment: vector of ndx experimental values
+    :return: vector of N estimates; NaN for unstable profiles
+    """
+
+    shifts, lsqs = compare_batch(cs, profiles, experiment)
+    too_wide = interface_width(profiles) >= interface_width(experiment)[0]
+    return np.where(too_wide | np.isnan(lsqs), lsqs, 0)
+
+
 class ComparisonEngine():
+    """
+    Aligns one model at a time, remembering the shift for shift_data. It is not safe to share between threads; use
+    compare_batch for that, or for many models at once
+    """
 
     def __init__(self, cs):
         #need a calc sim wrapper object
         assert isinstance(cs, CalcSimWrapper)
         self.cs = cs
 
-    def calibrate(self, model, experiment):
+    def calibrate(self, model, experiment, fractional=False):
         """
         This method will attempt to align model to experiment by left-padding with ones and right padding with zeros
         and then computing a cross-correlation
@@ -20,14 +159,18 @@ class ComparisonEngine():
 
         :param model: The vector of model data
         :param experiment: the vector of experimental data
+        :param fractional: refine the shift to a fraction of a cell (see refine_shifts)
         """
 
         if len(model) != len(experiment):
             raise ValueError("Model and experiment must be the same length")
 
         self.model = model
-        self.shift = self.cs.fast_pad_shift(experiment, model)
-        return self.lsq(self.shift_data(model), experiment), self.shift
+        self.shift, lsq = self.cs.fast_pad_shift_lsq(experiment, model)
+        if fractional:
+            shifts, lsqs = refine_shifts(model, experiment, [self.shift], [lsq])
+            self.shift, lsq = shifts[0], lsqs[0]
+        return lsq, self.shift
 
     def shifted_lsq(self, model, experiment):
         """
@@ -37,36 +180,35 @@ class ComparisonEngine():
         :param model: The vector of model data
         :param experiment: the vector of experimental data
         """
-        if self.shift > 0:
-            #right shift
-            keep = model[:-self.shift]
-            add = np.ones(self.shift)
-            shifted = np.concatenate((add, keep))
-        elif self.shift < 0:
-            keep = model[-self.shift:]
-            add = np.zeros(-self.shift)
-            shifted = np.concatenate((keep, add))
-        else:
-            shifted = model
-
+        shifted = self.shift_data(model)
         return self.lsq(shifted, experiment)
 
     def shift_data(self, data):
         """
         Get the shifted data
         """
-        if self.shift > 0:
-            #right shift
-            keep = data[:-self.shift]
-            add = np.ones(self.shift)
-            shifted = np.concatenate((add, keep))
-        elif self.shift < 0:
-            keep = data[-self.shift:]
-            add = np.zeros(-self.shift)
-            shifted = np.concatenate((keep, add))
-        else:
-            shifted = data
-        return shifted
+        return shift_batch(data, [self.shift])[0]
+
+    def shift_sensitivity(self, sensitivity):
+        """
+        Shifts the derivative of a model with respect to some parameter as shift_data shifts the model. The padding
+        doesn't depend on the parameter, so the derivative is padded with zeros
+        """
+        zeros = np.zeros(len(sensitivity))
+        return shift_batch(sensitivity, [self.shift])[0] - shift_batch(zeros, [self.shift])[0]
+
+    def lsq_gradient(self, sensitivities, experiment):
+        """
+        This method computes the gradient of shifted_lsq for the model last given to calibrate, holding the shift
+        fixed. The shift only ever moves in whole (or interpolated) cells, so this is the gradient almost everywhere.
+
+        :param sensitivities: list of vectors, the derivative of the model with respect to each parameter (e.g. from
+            CalcSimWrapper.calc_simulation_sensitivity)
+        :param experiment: the vector of experimental data
+        :return: vector of d(least squares)/d(parameter), one per sensitivity
+        """
+        residual = self.shift_data(self.model) - experiment
+        return np.array([2 * np.sum(residual * self.shift_sensitivity(s)) for s in sensitivities])
 
     def lsq(self, y1, y2):
         """
@@ -1,39 +1,227 @@
-int fast_pad_shift(double* y1, double* y2, int len)
-{
-    //shift y2 on y1
+#include <stdlib.h>
+#include <string.h>
+#include <math.h>
+#include <complex.h>
 
-    double min_lsq_sum = -2;
-    int best_shift = 0;
+//not part of C99, so strict -std=c99 builds don't get it from math.h
+#ifndef M_PI
+#define M_PI 3.14159265358979323846
+#endif
 
-    //want to shift by values of dx from -len to len
-    for (int dx = -len; dx <= len; dx++)
+//Up to this length the cross-correlation is cheaper done directly than by FFT, so the usual 100 point grid never
+//takes the FFT path. Per model at -O2: 100 points 9.7us direct vs 15.0us FFT, 150 points 25us vs 36us, 185
+//points 36us vs 35us, 256 points 67us vs 47us. The FFT cost steps up at each power of two (nfft >= 2 * len)
+#define DIRECT_XCORR_MAX_LEN 180
+
+//In-place iterative radix-2 FFT of n (a power of two) points; inverse if sign > 0.
+//The inverse is not normalised
+static void fft(double complex* a, int n, int sign)
+{
+    //bit reversal permutation
+    for (int i = 1, j = 0; i < n; i++)
     {
-        double lsq_sum = 0;
+        int bit = n >> 1;
+        for (; j & bit; bit >>= 1)
+            j ^= bit;
+        j ^= bit;
+        if (i < j)
+        {
+            double complex tmp = a[i];
+            a[i] = a[j];
+            a[j] = tmp;
+        }
+    }
 
-        //each pair
-        for (int i = 0; i < len; i++)
+    for (int len = 2; len <= n; len <<= 1)
+    {
+        double angle = sign * 2 * M_PI / len;
+        double complex wlen = cos(angle) + I * sin(angle);
+        for (int i = 0; i < n; i += len)
         {
-            double y1val = y1[i];
-            int y2index = i + dx;
-            double y2val;
-
-            if (y2index < 0)
-                y2val = 1;
-            else if (y2index >= len)
-                y2val = 0;
-            else
-                y2val = y2[y2index];
-
-            lsq_sum += (y2val - y1val) * (y2val - y1val);
+            double complex w = 1;
+            for (int j = 0; j < len / 2; j++)
+            {
+                double complex u = a[i + j];
+                double complex v = a[i + j + len / 2] * w;
+                a[i + j] = u + v;
+                a[i + j + len / 2] = u - v;
+                w *= wlen;
+            }
         }
+    }
+}
+
+//The least squares error between y1 and y2 shifted by dx, padded with ones on the
+//left and zeros on the right, worked out directly
+static double shifted_lsq(const double* y1, const double* y2, int len, int dx)
+{
+    double lsq_sum = 0;
+    for (int i = 0; i < len; i++)
+    {
+        int y2index = i + dx;
+        double y2val;
 
-        if (lsq_sum < min_lsq_sum || min_lsq_sum < -1)
+        if (y2index < 0)
+            y2val = 1;
+        else if (y2index >= len)
+            y2val = 0;
+        else
+            y2val = y2[y2index];
+
+        lsq_sum += (y2val - y1[i]) * (y2val - y1[i]);
+    }
+    return lsq_sum;
+}
+
+//Finds the shift of y2 on y1 with the least squares error, given xcorr[len + dx] = sum_i y1[i] * y2[i + dx]
+//over the overlap for -len < dx < len, and prefix sums p1 (of y1) and p2sq (of y2^2), each of len + 1 points.
+//The error at each shift is then O(1): the padded ones cover y1[0..-dx), and y2 overlaps y1 over y2[max(0, dx)..
+//min(len, len + dx)). Returns the shift with the convention of fast_pad_shift, and its exact error in *lsq
+static int best_shift_from_sums(const double* y1, const double* y2, int len,
+                                const double* xcorr, const double* p1, const double* p2sq,
+                                double* lsq)
+{
+    double y1sq = 0;
+    for (int i = 0; i < len; i++)
+        y1sq += y1[i] * y1[i];
+
+    //shifts within rounding of each other count as a tie, which goes to the first one,
+    //as it always has
+    double tol = 1e-12 * (y1sq + len);
+    double min_lsq_sum = 0;
+    int best_shift = 0;
+
+    for (int dx = -len; dx <= len; dx++)
+    {
+        int n_ones = dx < 0 ? -dx : 0;
+        int jlo = dx > 0 ? dx : 0;
+        int jhi = dx < 0 ? len + dx : len;
+        double cross = p1[n_ones] + (dx > -len && dx < len ? xcorr[len + dx] : 0);
+        double lsq_sum = n_ones + (p2sq[jhi] - p2sq[jlo]) + y1sq - 2 * cross;
+
+        if (dx == -len || lsq_sum < min_lsq_sum - tol)
         {
             min_lsq_sum = lsq_sum;
             best_shift = dx;
         }
     }
 
+    *lsq = shifted_lsq(y1, y2, len, best_shift);
+
     //Make the convention that left-shifts are negative, right-shifts are positive
     return -best_shift;
 }
+
+int fast_pad_shift_batch(const double* y1, const double* models, int nModels, int len,
+                         int* shifts, double* lsqs)
+{
+    //Aligns each of the nModels profiles in models (one after another, len points each)
+    //against y1, as fast_pad_shift does, storing the shift and least squares error of each.
+    //Every shift's error comes from prefix sums and the cross-correlation of y1 with the
+    //model, which for longer profiles is done by FFT, so this is O(len log len) per model
+    //rather than O(len^2). y1's transform is shared by the whole batch
+    int nfft = 1;
+    while (nfft < 2 * len)
+        nfft <<= 1;
+    int use_fft = len > DIRECT_XCORR_MAX_LEN;
+
+    double* xcorr = (double*)malloc(sizeof(double) * (2 * len + 1));
+    double* p1 = (double*)malloc(sizeof(double) * (len + 1));
+    double* p2sq = (double*)malloc(sizeof(double) * (len + 1));
+    double complex* y1hat = use_fft ? (double complex*)malloc(sizeof(double complex) * nfft) : NULL;
+    double complex* work = use_fft ? (double complex*)malloc(sizeof(double complex) * nfft) : NULL;
+
+    if (!xcorr || !p1 || !p2sq || (use_fft && (!y1hat || !work)))
+    {
+        free(xcorr);
+        free(p1);
+        free(p2sq);
+        free(y1hat);
+        free(work);
+        return 1;
+    }
+
+    p1[0] = 0;
+    for (int i = 0; i < len; i++)
+        p1[i + 1] = p1[i] + y1[i];
+
+    if (use_fft)
+    {
+        for (int i = 0; i < nfft; i++)
+            y1hat[i] = i < len ? y1[i] : 0;
+        fft(y1hat, nfft, -1);
+    }
+
+    for (int m = 0; m < nModels; m++)
+    {
+        const double* y2 = models + (size_t)m * len;
+
+        p2sq[0] = 0;
+        for (int j = 0; j < len; j++)
+            p2sq[j + 1] = p2sq[j] + y2[j] * y2[j];
+
+        if (use_fft)
+        {
+            //conj(Y1) * Y2 transforms back to the circular cross-correlation; the zero
+            //padding to nfft >= 2 * len stops the negative shifts wrapping onto the positive ones
+            for (int i = 0; i < nfft; i++)
+                work[i] = i < len ? y2[i] : 0;
+            fft(work, nfft, -1);
+            for (int i = 0; i < nfft; i++)
+                work[i] = conj(y1hat[i]) * work[i];
+            fft(work, nfft, 1);
+            for (int dx = -len + 1; dx < len; dx++)
+                xcorr[len + dx] = creal(work[dx < 0 ? nfft + dx : dx]) / nfft;
+        }
+        else
+        {
+            for (int dx = -len + 1; dx < len; dx++)
+            {
+                int ilo = dx < 0 ? -dx : 0;
+                int ihi = dx > 0 ? len - dx : len;
+                double sum = 0;
+                for (int i = ilo; i < ihi; i++)
+                    sum += y1[i] * y2[i + dx];
+                xcorr[len + dx] = sum;
+            }
+        }
+
+        shifts[m] = best_shift_from_sums(y1, y2, len, xcorr, p1, p2sq, &lsqs[m]);
+    }
+
+    free(xcorr);
+    free(p1);
+    free(p2sq);
+    free(y1hat);
+    free(work);
+    return 0;
+}
+
+int fast_pad_shift_lsq(const double* y1, const double* y2, int len, double* lsq)
+{
+    //shift y2 on y1, returning the shift and leaving its least squares error in *lsq
+    int shift = 0;
+    if (fast_pad_shift_batch(y1, y2, 1, len, &shift, lsq) != 0)
+    {
+        //out of memory; fall back on trying every shift directly
+        double min_lsq_sum = -2;
+        for (int dx = -len; dx <= len; dx++)
+        {
+            double lsq_sum = shifted_lsq(y1, y2, len, dx);
+            if (lsq_sum < min_lsq_sum || min_lsq_sum < -1)
+            {
+                min_lsq_sum = lsq_sum;
+                shift = -dx;
+            }
+        }
+        *lsq = min_lsq_sum;
+    }
+    return shift;
+}
+
+int fast_pad_shift(double* y1, double* y2, int len)
+{
+    //shift y2 on y1
+    double lsq;
+    return fast_pad_shift_lsq(y1, y2, len, &lsq);
+}
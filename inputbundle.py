@@ -0,0 +1,180 @@
+"""A compiled copy of a set of CSV input files in one memory-mappable binary file, so that the text only has to be
+parsed once rather than by every process that needs it
+"""
+import hashlib
+import json
+import logging
+import os
+import struct
+import tempfile
+import threading
+
+import numpy as np
+
+
+BUNDLE_MAGIC = b'DSBUNDLE'
+
+#bump whenever the layout changes, or what goes into a bundle does
+BUNDLE_VERSION = 1
+
+#the arrays start on a boundary of this many bytes
+BUNDLE_ALIGN = 64
+
+
+class InputBundle():
+    """
+    Named arrays, each parsed from a CSV file with np.genfromtxt, stored one after another as float64 in a single
+    file. The file starts with a JSON header giving where each array is and the path, size, modification time and
+    SHA-1 of the file it came from.
+
+    Nothing is read until an array is first asked for. The bundle is then memory mapped, so each array only comes off
+    disk when it's used, and processes using the same bundle share its pages. If the bundle is missing, was made by
+    another version of this code, or any source's size or modification time has changed and so has its SHA-1, every
+    source is parsed again and the bundle rewritten (to a temporary name, then renamed into place, so concurrent
+    readers never see half of one). If it can't be written, each array is parsed from its CSV file as it's needed.
+    """
+
+    def __init__(self, filename, sources):
+        """
+        :param filename: path of the bundle
+        :param sources: dict of array name -> (path of the CSV file, dict of keyword arguments for np.genfromtxt)
+        """
+
+        self.filename = filename
+        self.sources = dict((name, (os.path.abspath(path), kwargs)) for name, (path, kwargs) in sources.items())
+
+        #guarded by lock; data stays None if the bundle couldn't be used, and then parsed holds the arrays
+        self.lock = threading.Lock()
+        self.opened = False
+        self.data = None
+        self.index = None
+        self.parsed = {}
+
+    def get(self, name):
+        """
+        :return: the array called name, read-only
+        """
+
+        with self.lock:
+            if not self.opened:
+                self._open()
+                self.opened = True
+            if self.data is not None:
+                offset, shape = self.index[name]
+                return self.data[offset:offset + int(np.prod(shape))].reshape(shape)
+            if name not in self.parsed:
+                self.parsed[name] = self._parse(name)
+            return self.parsed[name]
+
+    def _parse(self, name):
+        path, kwargs = self.sources[name]
+        arr = np.genfromtxt(path, **kwargs)
+        arr.flags.writeable = False
+        return arr
+
+    @staticmethod
+    def _describe(path):
+        st = os.stat(path)
+        return {'path': path, 'size': st.st_size, 'mtime': st.st_mtime_ns}
+
+    @staticmethod
+    def _sha1(path):
+        digest = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def _read_header(self):
+        """
+        :return: (header dict, offset of the data in bytes), or None if there's no usable bundle
+        """
+
+        try:
+            with open(self.filename, 'rb') as f:
+                magic, header_len = struct.unpack('<8sQ', f.read(16))
+                if magic != BUNDLE_MAGIC:
+                    return None
+                header = json.loads(f.read(header_len).decode('utf-8'))
+        except (IOError, OSError, ValueError, struct.error):
+            return None
+        if header.get('version') != BUNDLE_VERSION:
+            return None
+        return header, header['data_offset']
+
+    def _up_to_date(self, header):
+        if set(header['sources']) != set(self.sources):
+            return False
+        for name, (path, kwargs) in self.sources.items():
+            recorded = header['sources'][name]
+            if recorded['path'] != path or recorded['kwargs'] != kwargs:
+                return False
+            try:
+                current = self._describe(path)
+            except OSError:
+                return False
+            #a file that's only been touched or copied still has the same contents
+            if (current['size'], current['mtime']) != (recorded['size'], recorded['mtime']) and \
+                    self._sha1(path) != recorded['sha1']:
+                return False
+        return True
+
+    def _open(self):
+        found = self._read_header()
+        if found is None or not self._up_to_date(found[0]):
+            logging.info(str.format('Compiling input bundle {}', self.filename))
+            try:
+                self._compile()
+            except (IOError, OSError) as e:
+                logging.warning(str.format('Could not write input bundle {} ({}); reading the CSV files instead',
+                                           self.filename, e))
+                return
+            found = self._read_header()
+            if found is None:
+                return
+
+        header, data_offset = found
+        self.index = dict((name, (entry['offset'], tuple(entry['shape'])))
+                          for name, entry in header['arrays'].items())
+        self.data = np.memmap(self.filename, dtype='<f8', mode='r', offset=data_offset)
+
+    def _compile(self):
+        sources = {}
+        arrays = {}
+        chunks = []
+        offset = 0
+        for name in sorted(self.sources):
+            path, kwargs = self.sources[name]
+            #describe before reading, so a file changed while it's read looks out of date next time
+            description = self._describe(path)
+            description['sha1'] = self._sha1(path)
+            description['kwargs'] = kwargs
+            sources[name] = description
+
+            arr = np.ascontiguousarray(np.genfromtxt(path, **kwargs), dtype='<f8')
+            arrays[name] = {'offset': offset, 'shape': list(arr.shape)}
+            chunks.append(arr)
+            offset += arr.size
+
+        header = {'version': BUNDLE_VERSION, 'sources': sources, 'arrays': arrays, 'data_offset': 0}
+        #the header's length depends on data_offset, so allow for it having as many digits as it could need
+        header_len = len(json.dumps(header).encode('utf-8')) + 20
+        data_offset = -(-(16 + header_len) // BUNDLE_ALIGN) * BUNDLE_ALIGN
+        header['data_offset'] = data_offset
+        header_bytes = json.dumps(header).encode('utf-8').ljust(data_offset - 16)
+
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        fd, tmpname = tempfile.mkstemp(suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(struct.pack('<8sQ', BUNDLE_MAGIC, len(header_bytes)))
+                f.write(header_bytes)
+                for arr in chunks:
+                    f.write(arr.tobytes())
+            os.replace(tmpname, self.filename)
+        except (IOError, OSError):
+            try:
+                os.remove(tmpname)
+            except OSError:
+                pass
+            raise
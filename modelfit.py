@@ -0,0 +1,287 @@
+"""Fits z* and a vacancy concentration model to the experimental profiles by nonlinear least squares, using the
+sensitivities from CalcSimWrapper.calc_simulation_sensitivity so that every step of the fit costs one simulation per
+current rather than three. global_fit runs the currents of each step side by side, and several fits from different
+starts at once
+"""
+from concurrent.futures import ThreadPoolExecutor
+import logging
+
+import numpy as np
+
+from calcsim import CalcSimWrapper, SimulationUnstableError
+from expercomparison import compare_batch, shift_batch
+import surrogate
+
+
+def linear_cvf(m, I):
+    """
+    The Cv/Cve model dmsearch_min.py has always used: 1 + m * I, with I signed by direction, so a reverse current
+    lowers it
+    """
+
+    return 1 + m * I
+
+
+def abs_cvf(m, I):
+    """
+    The Cv/Cve model of regionmaptask.py and checkerboard.py: 1 + m * |I|, the same whichever way the current flows
+    """
+
+    return 1 + m * abs(I)
+
+
+#Cv/Cve models by name, each a function of (m, signed I)
+CVF_MODELS = {
+    'linear': linear_cvf,
+    'abs': abs_cvf
+}
+
+
+class CurrentObjective():
+    """
+    The misfit between the simulation and one experimental profile, as a function of (z*, m).
+
+    residuals() gives the aligned simulated profile minus the experimental one, whose sum of squares is the LSQ
+    ComparisonEngine.calibrate(fractional=True) gives, along with its Jacobian with respect to (z*, m). The alignment
+    shift is found afresh at every evaluation; the fractional shift keeps the cost continuous as it moves. Nothing is
+    stored between evaluations, so one objective can be evaluated from several threads at once.
+    """
+
+    def __init__(self, cs, D_vector, R_vector, init_cond, ndt, dt, dx, T, I, direction, experiment,
+                 cvf_model=linear_cvf):
+        """
+        :param cs: CalcSimWrapper to run the simulations with; must be able to run calc_simulation_sensitivity
+        :param T: temperature in K
+        :param I: current density in A/cm^2
+        :param direction: 'forward' or 'reverse'; a reverse current is negative in r and in cvf_model
+        :param experiment: vector of ndx experimental values
+        :param cvf_model: function of (m, signed I) giving Cv/Cve, or the name of one in CVF_MODELS
+        The remaining parameters are as for CalcSimWrapper.calc_simulation
+        """
+
+        assert isinstance(cs, CalcSimWrapper)
+        if direction not in ('forward', 'reverse'):
+            raise ValueError('Unknown direction ' + str(direction))
+
+        self.cs = cs
+        self.D_vector = D_vector
+        self.R_vector = R_vector
+        self.init_cond = init_cond
+        self.ndt = ndt
+        self.dt = dt
+        self.dx = dx
+        self.T = T
+        self.I = -abs(I) if direction == 'reverse' else abs(I)
+        self.direction = direction
+        self.experiment = experiment
+        self.cvf_model = CVF_MODELS[cvf_model] if isinstance(cvf_model, str) else cvf_model
+
+    def residuals(self, params):
+        """
+        :param params: (z*, m)
+        :return: (vector of ndx residuals, (ndx, 2) Jacobian with respect to z* and m). Raises
+            SimulationUnstableError if the simulation is unstable at params
+        """
+
+        z, m = params
+        #r is linear in z*, so dr/dz* is r at z* = 1
+        r = self.cs.emigration_factor(z, self.I * 100 * 100, self.T)
+        drdz = self.cs.emigration_factor(1, self.I * 100 * 100, self.T)
+        cvf = self.cvf_model(m, self.I)
+        #the model can be anything, so its derivative is taken numerically; that costs no simulations
+        h = 1e-6 * max(abs(m), 1e-6)
+        dcvfdm = (self.cvf_model(m + h, self.I) - self.cvf_model(m - h, self.I)) / (2 * h)
+
+        simd, dCdr, dCdcvf = self.cs.calc_simulation_sensitivity(self.D_vector, self.R_vector, self.init_cond,
+                                                                 self.ndt, self.dt, self.dx, r, cvf)
+        shifts, lsqs, shifted = compare_batch(self.cs, simd, self.experiment, shifted=True, fractional=True)
+        shift = shifts[0]
+        residual = shifted[0] - self.experiment
+        #as ComparisonEngine.shift_sensitivity: the padding doesn't depend on the parameters
+        sensitivities = np.vstack((dCdr * drdz, dCdcvf * dcvfdm))
+        jacobian = (shift_batch(sensitivities, [shift, shift]) - shift_batch(np.zeros_like(sensitivities),
+                                                                              [shift, shift])).T
+
+        #the shift is fitted again at every evaluation, so whatever part of a change in the profile a change of
+        #shift could take up doesn't count; taking it out of the Jacobian (variable projection) stops the fit
+        #chasing moves of the interface that the alignment would undo anyway
+        translation = shift_batch(simd, [shift + 0.5])[0] - shift_batch(simd, [shift - 0.5])[0]
+        norm = np.dot(translation, translation)
+        if norm > 0:
+            jacobian -= np.outer(translation, np.dot(translation, jacobian) / norm)
+        return residual, jacobian
+
+
+class JointObjective():
+    """
+    Several CurrentObjectives fitted together: their residuals and Jacobians are stacked, so the cost is the sum of
+    their LSQs
+    """
+
+    def __init__(self, objectives, executor=None):
+        """
+        :param objectives: list of CurrentObjectives
+        :param executor: optional concurrent.futures executor to evaluate the objectives on side by side; the
+            simulations release the GIL, so a ThreadPoolExecutor is enough
+        """
+
+        self.objectives = list(objectives)
+        self.executor = executor
+
+    def residuals(self, params):
+        if self.executor is None:
+            results = [objective.residuals(params) for objective in self.objectives]
+        else:
+            futures = [self.executor.submit(objective.residuals, params) for objective in self.objectives]
+            results = [future.result() for future in futures]
+        return np.concatenate([res for res, jac in results]), np.vstack([jac for res, jac in results])
+
+
+def make_objectives(cs, dstore, T, currents, directions=('forward', 'reverse'), cvf_model=linear_cvf,
+                    ndt=int(2 * 60 * 60 / 0.05), dt=0.05, table_points=1001):
+    """
+    Makes a CurrentObjective for every experimental profile at the given currents, on the 100 point grid over 25
+    micron that ParamSearchEngine and dmsearch_min.py use
+
+    :param cs: CalcSimWrapper to run the simulations with
+    :param dstore: InputDatastore to take the material properties and experimental profiles from
+    :param T: temperature in K
+    :param currents: current densities to fit, in A/cm^2; any without an experimental profile are left out
+    :param directions: directions to fit
+    :param cvf_model: as for CurrentObjective
+    :param table_points: number of points in the D and R tables
+    """
+
+    x = np.linspace(0, 25, num=100)
+    dx = 25e-6 / 100
+    init_cond = np.ones(100)
+    init_cond[50:] = 0
+    diffusivity = dstore.interpolated_diffusivity(table_points, T)
+    resistivity = dstore.interpolated_resistivity(table_points, T)
+
+    objectives = []
+    for direction in directions:
+        edict = dstore.edict_for_direction(direction)
+        exper_dict = dstore.interpolated_experiment_dict(x, edict)
+        for I in currents:
+            if I not in exper_dict:
+                continue
+            objectives.append(CurrentObjective(cs, diffusivity, resistivity, init_cond, ndt, dt, dx, T, I,
+                                               direction, exper_dict[I], cvf_model))
+    return objectives
+
+
+def levenberg_marquardt(fun, x0, bounds=None, max_iter=50, xtol=1e-6, ftol=1e-10, damping=1e-3):
+    """
+    Minimises the sum of squares of fun's residuals by Levenberg-Marquardt, with the damping scaled by the diagonal
+    of J^T J so that parameters of very different sizes (like z* and m) are treated alike. Steps are clipped to
+    bounds, and a step to somewhere the simulation is unstable is treated like one that made the fit worse.
+
+    :param fun: function of the parameter vector giving (residual vector, Jacobian)
+    :param x0: starting parameters; the simulation must be stable here
+    :param bounds: optional list of (low, high) for each parameter
+    :param max_iter: most steps to take
+    :param xtol: stop once no parameter moves by more than this fraction of itself
+    :param ftol: stop once a step reduces the cost by less than this fraction
+    :param damping: initial damping factor
+    :return: dict of x (the best parameters), cost (their sum of squares), evaluations (the number of calls to
+        fun), iterations and message
+    """
+
+    x = np.array(x0, dtype=np.float64)
+    if bounds is not None:
+        lower = np.array([b[0] for b in bounds], dtype=np.float64)
+        upper = np.array([b[1] for b in bounds], dtype=np.float64)
+        x = np.clip(x, lower, upper)
+
+    res, jac = fun(x)
+    cost = np.sum(res ** 2)
+    evaluations = 1
+    iterations = 0
+    message = 'Reached max_iter'
+
+    while iterations < max_iter:
+        A = np.dot(jac.T, jac)
+        g = np.dot(jac.T, res)
+        scale = np.maximum(np.diag(A), 1e-300)
+
+        while True:
+            step = np.linalg.solve(A + damping * np.diag(scale), -g)
+            x_new = x + step
+            if bounds is not None:
+                x_new = np.clip(x_new, lower, upper)
+            try:
+                res_new, jac_new = fun(x_new)
+                cost_new = np.sum(res_new ** 2)
+            except SimulationUnstableError:
+                cost_new = np.inf
+            evaluations += 1
+
+            if cost_new < cost:
+                damping = max(damping / 10, 1e-12)
+                break
+            damping *= 10
+            if damping > 1e10:
+                return {'x': x, 'cost': cost, 'evaluations': evaluations, 'iterations': iterations,
+                        'message': 'No step reduces the cost'}
+
+        moved = np.abs(x_new - x)
+        improvement = cost - cost_new
+        x, res, jac, cost = x_new, res_new, jac_new, cost_new
+        iterations += 1
+        logging.debug(str.format('Levenberg-Marquardt step {}: x = {}, cost = {}', iterations, x, cost))
+
+        if np.all(moved <= xtol * np.abs(x)):
+            message = 'Parameters converged'
+            break
+        if improvement <= ftol * cost:
+            message = 'Cost converged'
+            break
+
+    return {'x': x, 'cost': cost, 'evaluations': evaluations, 'iterations': iterations, 'message': message}
+
+
+def global_fit(objectives, bounds, starts=8, max_workers=8, seed=None, **lm_options):
+    """
+    Fits the objectives jointly from several starting points at once, to stand a better chance of finding the global
+    minimum than a single start. Every start runs levenberg_marquardt in its own thread, and all of their objective
+    evaluations share one pool of max_workers threads, so with as many workers as objectives a step takes about as
+    long as one simulation. If the objectives' CalcSimWrapper has a cache, every start shares it, so starts that
+    wander onto the same points (or a rerun of the whole fit) don't simulate them again.
+
+    :param objectives: list of CurrentObjectives
+    :param bounds: list of (low, high) for z* and m
+    :param starts: number of starts, spread over bounds by Latin hypercube sampling, or a list of starting points
+    :param max_workers: size of the shared pool
+    :param seed: seed for the Latin hypercube
+    :param lm_options: passed on to levenberg_marquardt
+    :return: list of levenberg_marquardt results, one per start with its start point added as 'start', best first.
+        A start where the simulation is unstable gets an infinite cost
+    """
+
+    lower = np.array([b[0] for b in bounds], dtype=np.float64)
+    upper = np.array([b[1] for b in bounds], dtype=np.float64)
+    if np.isscalar(starts):
+        rng = np.random.RandomState(seed)
+        starts = lower + surrogate.latin_hypercube(starts, len(bounds), rng) * (upper - lower)
+    starts = [np.array(start, dtype=np.float64) for start in starts]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        joint = JointObjective(objectives, executor)
+
+        def fit(start):
+            try:
+                result = levenberg_marquardt(joint.residuals, start, bounds=bounds, **lm_options)
+            except SimulationUnstableError:
+                result = {'x': start, 'cost': np.inf, 'evaluations': 1, 'iterations': 0,
+                          'message': 'Unstable at the start'}
+            result['start'] = start
+            logging.info(str.format('Fit from {}: {} ({}, cost {})', start, result['x'], result['message'],
+                                    result['cost']))
+            return result
+
+        #the starts mostly wait on the shared pool, so they get threads of their own rather than taking up workers
+        with ThreadPoolExecutor(max_workers=len(starts)) as start_executor:
+            results = list(start_executor.map(fit, starts))
+
+    return sorted(results, key=lambda result: result['cost'])
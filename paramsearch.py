@@ -1,5 +1,6 @@
 """Module for performing parameter search over z* and Cv/Cve
 """
+import functools
 import logging
 
 import numpy as np
@@ -7,15 +8,40 @@ import itertools
 from concurrent import futures
 
 from concurrent.futures import ThreadPoolExecutor
-from threading import RLock
+from threading import Event
 
-from calcsim import CalcSimWrapper, SimulationUnstableError
+from calcsim import CalcSimWrapper, SimulationUnstableError, SimulationRun, SimulationCancelledError, KERNEL_VERSION
 from datastore import InputDatastore
-from expercomparison import ComparisonEngine
+from expercomparison import compare_batch, lsq_prune_estimate
+from searchjournal import SearchJournal
+import surrogate
+
+
+#what a search map (and the journal) holds for a point that was pruned rather than run to the end. Unstable points are
+#NaN in a map; a pruned point is not a finished LSQ either, and infinity keeps it from ever being picked as the best fit
+#by np.nanargmin, survives a round trip through a CSV file and is drawn grey in the plots
+PRUNED = np.inf
+
+
+def combine_maps(forward_map, reverse_map):
+    """
+    The combined map for one current: the forward map multiplied by the reverse one. Points unstable in either
+    direction are NaN in the combined map, and the rest of the points pruned in either direction are PRUNED
+    (multiplying infinity by an LSQ of exactly 0 would otherwise give NaN). Find the best fit with np.nanargmin
+    """
+
+    with np.errstate(invalid='ignore'):
+        combined_map = forward_map * reverse_map
+    combined_map[(forward_map == PRUNED) | (reverse_map == PRUNED)] = PRUNED
+    combined_map[np.isnan(forward_map) | np.isnan(reverse_map)] = np.nan
+    return combined_map
 
 
 class ParamSearchEngine():
 
+    #the options that change the results of a search besides its inputs; see settings()
+    SETTINGS = ('fractional_shift', 'prune_threshold', 'chunk_steps')
+
     def __init__(self, calcsim_wrapper, input_datastore):
         """
         Constructor for injecting dependancies into ParamSearchEngine
@@ -29,16 +55,329 @@ class ParamSearchEngine():
         self.calcsim_wrapper = calcsim_wrapper
         self.input_datastore = input_datastore
 
-    def search(self, z_list, dmult_list, I, emigration_T, progress_cb, direction):
+        #set by cancel(); every simulation in flight checks it between chunks
+        self.cancel_event = Event()
+        self.chunk_steps = 10000
+        #how far through each batch in flight is, in units of work items
+        self.partial_progress = {}
+
+        #refine the alignment of each simulation with experiment to a fraction of a cell (see refine_shifts), which
+        #lets coarser grids give fits as good as fine ones
+        self.fractional_shift = False
+
+        #a SearchJournal to record every result in as it comes back, and to reuse results from on a restart
+        self.journal = None
+
+        #if set, stop simulations part way through once lsq_prune_estimate puts them above prune_threshold, and give
+        #them the value PRUNED. The estimate is a heuristic, so this is lossy: a point that would have finished
+        #under the threshold can still be pruned. Whether a point is pruned depends only on the point itself, never on
+        #the rest of the search
+        self.prune_threshold = None
+
+        #direction -> interpolated experimental profiles by current
+        self.exper_cache = {}
+
+    def settings(self):
+        """
+        The options in SETTINGS as a dict, for another engine (e.g. a SearchWorker's) to be given with update_settings
+        so that it scores points the same way as this one
+        """
+
+        return dict((name, getattr(self, name)) for name in self.SETTINGS)
+
+    def update_settings(self, settings):
+        """
+        Sets options from a dict made by settings()
+
+        :param settings: dict of option name (one of SETTINGS) -> value
+        """
+
+        for name, value in settings.items():
+            if name not in self.SETTINGS:
+                raise ValueError('Unknown search setting ' + str(name))
+            setattr(self, name, value)
+
+    def cancel(self):
+        """
+        Stops a search running in another thread, or the next one to start if none is running. Simulations in flight
+        stop at the end of their current chunk, work that hasn't started yet is dropped, and search() raises
+        SimulationCancelledError
+        """
+        self.cancel_event.set()
+
+    def search(self, z_list, dmult_list, I, emigration_T, progress_cb, direction, batch_size=128):
         """
         This method will compute calcsim_wrapper.calc_simulation() for every value of z* and Cv in
         z_range and dmult_range and for every current in input_datastore.
         The error of the simulation against experimental data is compared for each current for which there is data
-        The cell of the array representing z, Cv is set to the sum of all of the least squared errors
+        The cell of the array representing z, Cv is set to the sum of all of the least squared errors, NaN if the
+        simulation was unstable or PRUNED if it was pruned
+
+        Work is handed to the native code batch_size (z, Cv) pairs at a time via calc_simulation_batch
+
+        The search can be stopped with cancel() or Ctrl-C, in which case SimulationCancelledError (or
+        KeyboardInterrupt) is raised once the workers have wound down
 
         """
 
-        #set up the work
+        IAbs, ISigned = self._setup_search(I, emigration_T, direction)
+
+        #every (z, Cv) pair, as indicies into z_list/dmult_list
+        cells = list(itertools.product(range(len(z_list)), range(len(dmult_list))))
+        work_queue = [(z_list[z_index], dmult_list[d_index]) for z_index, d_index in cells]
+        simres_list = self._evaluate(work_queue, IAbs, ISigned, progress_cb, batch_size)
+
+        #create storage
+        ret_storage = np.full((len(z_list), len(dmult_list)), np.nan)
+        for (z_index, d_index), simres in zip(cells, simres_list):
+            ret_storage[z_index, d_index] = simres
+        return ret_storage
+
+    def search_adaptive(self, z_list, dmult_list, I, emigration_T, progress_cb, direction, coarse_step=8,
+                        rel_tol=0.5, threshold=None, batch_size=128):
+        """
+        Produces the same map as search(), but only simulates where it matters. The map starts as a coarse lattice
+        of every coarse_step'th z* and Cv, and each lattice cell is split in half along both axes, over and over,
+        while it is interesting:
+        - one of its corners is within rel_tol (relative) of the smallest error found so far, or
+        - its corners straddle threshold (the error cut-off used to find the Cv bounds in dmerranalysis.py), if given
+        - some but not all of its corners were unstable
+        Everything else is filled in by bilinear interpolation between the corners of the cell it sits in. Cells
+        that were entirely unstable are left as NaN, as search() does for unstable simulations.
+
+        See search() for the remaining parameters; progress_cb is given the number of simulations run so far
+        """
+
+        IAbs, ISigned = self._setup_search(I, emigration_T, direction)
+        nz = len(z_list)
+        nd = len(dmult_list)
+
+        def lattice(n):
+            return sorted(set(list(range(0, n, coarse_step)) + [n - 1]))
+
+        #cells are (z_lo, z_hi, d_lo, d_hi) inclusive index ranges whose corners have been simulated
+        z_ticks = lattice(nz)
+        d_ticks = lattice(nd)
+        cells = [(z_lo, z_hi, d_lo, d_hi)
+                 for z_lo, z_hi in zip(z_ticks, z_ticks[1:] or z_ticks)
+                 for d_lo, d_hi in zip(d_ticks, d_ticks[1:] or d_ticks)]
+        known = {}
+        leaves = []
+        sims_run = [0]
+
+        def run_points(points):
+            todo = sorted(set(pt for pt in points if pt not in known))
+            if not todo:
+                return
+
+            def report(count):
+                progress_cb(sims_run[0] + count)
+            work_queue = [(z_list[z_index], dmult_list[d_index]) for z_index, d_index in todo]
+            for pt, simres in zip(todo, self._evaluate(work_queue, IAbs, ISigned, report, batch_size)):
+                known[pt] = simres
+            sims_run[0] += len(todo)
+
+        def corners(cell):
+            z_lo, z_hi, d_lo, d_hi = cell
+            return [(z_lo, d_lo), (z_lo, d_hi), (z_hi, d_lo), (z_hi, d_hi)]
+
+        run_points([pt for cell in cells for pt in corners(cell)])
+        while cells:
+            stable = [v for v in known.values() if np.isfinite(v)]
+            best = min(stable) if stable else np.nan
+
+            to_split = []
+            for cell in cells:
+                z_lo, z_hi, d_lo, d_hi = cell
+                values = np.array([known[pt] for pt in corners(cell)])
+                if z_hi - z_lo <= 1 and d_hi - d_lo <= 1:
+                    leaves.append(cell)
+                    continue
+                finite = values[~np.isnan(values)]
+                near_best = len(finite) > 0 and np.min(finite) <= best + rel_tol * abs(best)
+                straddles = threshold is not None and len(finite) > 0 and \
+                    np.min(finite) <= threshold <= np.max(finite)
+                #resolve the edge of any unstable region, so stable cells aren't lost to it
+                mixed = 0 < len(finite) < len(values)
+                if near_best or straddles or mixed:
+                    to_split.append(cell)
+                else:
+                    leaves.append(cell)
+
+            #split each interesting cell into (up to) four, and simulate the new corners all together
+            cells = []
+            for z_lo, z_hi, d_lo, d_hi in to_split:
+                z_split = [z_lo, (z_lo + z_hi) // 2, z_hi] if z_hi - z_lo > 1 else [z_lo, z_hi]
+                d_split = [d_lo, (d_lo + d_hi) // 2, d_hi] if d_hi - d_lo > 1 else [d_lo, d_hi]
+                cells.extend((za, zb, da, db)
+                             for za, zb in zip(z_split, z_split[1:])
+                             for da, db in zip(d_split, d_split[1:]))
+            run_points([pt for cell in cells for pt in corners(cell)])
+
+        #fill each leaf cell from its corners
+        ret_storage = np.full((nz, nd), np.nan)
+        for cell in leaves:
+            z_lo, z_hi, d_lo, d_hi = cell
+            v00, v01, v10, v11 = [known[pt] for pt in corners(cell)]
+            if np.isnan([v00, v01, v10, v11]).any():
+                continue
+            if PRUNED in (v00, v01, v10, v11):
+                #nothing to interpolate from; a cell next to a hopeless fit counts as one
+                ret_storage[z_lo:z_hi + 1, d_lo:d_hi + 1] = PRUNED
+                continue
+            tz = (np.arange(z_lo, z_hi + 1) - z_lo) / float(max(z_hi - z_lo, 1))
+            td = (np.arange(d_lo, d_hi + 1) - d_lo) / float(max(d_hi - d_lo, 1))
+            tz = tz[:, np.newaxis]
+            ret_storage[z_lo:z_hi + 1, d_lo:d_hi + 1] = (v00 * (1 - tz) * (1 - td) + v01 * (1 - tz) * td +
+                                                         v10 * tz * (1 - td) + v11 * tz * td)
+
+        #the simulated points themselves are exact
+        for (z_index, d_index), simres in known.items():
+            ret_storage[z_index, d_index] = simres
+
+        logging.info(str.format('Adaptive search ran {} of {} simulations', len(known), nz * nd))
+        return ret_storage
+
+    def search_surrogate(self, z_bounds, dmult_bounds, I, emigration_T, progress_cb, direction, n_init=12,
+                         n_rounds=8, batch_size=8, seed=None):
+        """
+        Looks for the (z*, Cv) with the smallest error in as few simulations as possible, rather than mapping the
+        whole range as search() does. n_init points are spread over the range first; then each round a Gaussian
+        process is fit to log(error) at every point so far, and the batch_size points with the best expected
+        improvement (see surrogate.propose_batch) are simulated in parallel on the worker pool
+
+        :param z_bounds: (lowest, highest) effective valence to search
+        :param dmult_bounds: (lowest, highest) Cv/Cve to search
+        :param n_init: number of points in the initial latin hypercube
+        :param n_rounds: number of rounds of batch_size points after that
+        :param seed: seed for the random numbers used to place points, for a repeatable search
+        See search() for the remaining parameters; progress_cb is given the number of simulations run so far
+        :return: (best z*, best Cv, its error, (n, 3) array of every (z*, Cv, error) simulated, NaN error where
+            unstable and PRUNED where pruned)
+        """
+
+        IAbs, ISigned = self._setup_search(I, emigration_T, direction)
+        rng = np.random.RandomState(seed)
+        lower = np.array([z_bounds[0], dmult_bounds[0]], dtype=np.float64)
+        span = np.array([z_bounds[1], dmult_bounds[1]], dtype=np.float64) - lower
+
+        unit_points = np.zeros((0, 2))
+        lsqs = np.zeros(0)
+
+        def run_points(new_points):
+            done = len(lsqs)
+            work_queue = [tuple(lower + span * pt) for pt in new_points]
+
+            def report(count):
+                progress_cb(done + count)
+            #one simulation per work item, so the whole batch runs side by side on the pool
+            return self._evaluate(work_queue, IAbs, ISigned, report, 1)
+
+        for round_num in range(n_rounds + 1):
+            if round_num == 0:
+                new_points = surrogate.latin_hypercube(n_init, 2, rng)
+            else:
+                #the error spans orders of magnitude, so model its log; unstable and pruned points count as the
+                #worst seen
+                stable = np.isfinite(lsqs)
+                if not np.any(stable):
+                    raise SimulationUnstableError('Every simulation in the surrogate search was unstable or pruned')
+                log_lsqs = np.log(np.maximum(lsqs, 1e-300))
+                log_lsqs[~stable] = np.max(log_lsqs[stable])
+                new_points = surrogate.propose_batch(unit_points, log_lsqs, batch_size, rng)
+
+            unit_points = np.vstack((unit_points, new_points))
+            lsqs = np.append(lsqs, run_points(new_points))
+            logging.info(str.format('Surrogate search round {}: best error so far {}', round_num, np.nanmin(lsqs)))
+
+        samples = np.column_stack((lower + span * unit_points, lsqs))
+        if not np.any(np.isfinite(lsqs)):
+            raise SimulationUnstableError('Every simulation in the surrogate search was unstable or pruned')
+        best = np.nanargmin(lsqs)
+        return samples[best, 0], samples[best, 1], samples[best, 2], samples
+
+    def search_all(self, z_list, dmult_list, emigration_T, progress_cb, map_cb=None, combined_cb=None,
+                   batch_size=128, max_workers=8):
+        """
+        Runs search() for every current in both directions as one pipeline. The material properties and
+        experimental data are set up once, and every batch of every map goes to a single worker pool, a current at a
+        time with its forward and reverse maps side by side, so both halves of the first current's combined map are
+        done early and the pool never drains between maps.
+
+        :param progress_cb: given the number of simulations finished so far, over every map
+        :param map_cb: called as map_cb(direction, I, search map) as soon as each map is complete
+        :param combined_cb: called as combined_cb(I, combined map) once both directions at current I are complete;
+            the combined map is the forward map multiplied by the reverse one (see combine_maps)
+        See search() for the remaining parameters
+        :return: dict of 'forward', 'reverse' and 'combined' to dicts of current -> search map
+        """
+
+        self._setup_inputs(emigration_T)
+        directions = ('forward', 'reverse')
+        results = dict((direction, {}) for direction in directions)
+        results['combined'] = {}
+
+        #every (z, Cv) pair, as indicies into z_list/dmult_list
+        cells = list(itertools.product(range(len(z_list)), range(len(dmult_list))))
+        work_queue = [(z_list[z_index], dmult_list[d_index]) for z_index, d_index in cells]
+
+        def store(job, indicies, simres_list):
+            for index, simres in zip(indicies, simres_list):
+                job['map'][cells[index]] = simres
+            job['remaining'] -= len(indicies)
+            if job['remaining'] > 0:
+                return
+
+            direction, IAbs = job['direction'], job['IAbs']
+            results[direction][IAbs] = job['map']
+            if map_cb is not None:
+                map_cb(direction, IAbs, job['map'])
+            if all(IAbs in results[other] for other in directions):
+                results['combined'][IAbs] = combine_maps(results['forward'][IAbs], results['reverse'][IAbs])
+                if combined_cb is not None:
+                    combined_cb(IAbs, results['combined'][IAbs])
+
+        #one job per map, ordered by current so each current's two halves finish at about the same time
+        currents = sorted(set(abs(I) for direction in directions
+                              for I in self.input_datastore.edict_for_direction(direction).keys()))
+        jobs = []
+        for IAbs in currents:
+            for direction in directions:
+                exper_dict = self._experiment_dict(direction)
+                if IAbs not in exper_dict:
+                    continue
+                ISigned = -IAbs if direction == 'reverse' else IAbs
+                job = {'direction': direction, 'IAbs': IAbs, 'ISigned': ISigned, 'exper': exper_dict[IAbs],
+                       'map': np.full((len(z_list), len(dmult_list)), np.nan), 'remaining': len(cells)}
+                if self.journal is not None:
+                    job['input_hash'] = self._input_hash(job['exper'])
+                job['store'] = functools.partial(store, job)
+                jobs.append(job)
+
+        self._run_jobs(jobs, work_queue, progress_cb, batch_size, max_workers)
+        return results
+
+    def evaluate_points(self, points, I, emigration_T, direction, progress_cb=None, batch_size=128):
+        """
+        Scores any list of (z*, Cv) points, as search() scores the points of its grid
+
+        :param points: list of (z*, Cv) pairs
+        :param progress_cb: if given, called with the number of points finished so far
+        See search() for the remaining parameters
+        :return: vector of fit measures, in the same order as points; NaN where the simulation was unstable and PRUNED
+            where it was pruned
+        """
+
+        IAbs, ISigned = self._setup_search(I, emigration_T, direction)
+        return self._evaluate([tuple(pt) for pt in points], IAbs, ISigned, progress_cb or (lambda count: None),
+                              batch_size)
+
+    def _setup_search(self, I, emigration_T, direction):
+        """
+        Loads the experimental data and material properties for a search at current I
+
+        :return: (IAbs, ISigned)
+        """
 
         IAbs = abs(I)
 
@@ -47,9 +386,26 @@ class ParamSearchEngine():
         else:
             ISigned = abs(I)
 
+        self._setup_inputs(emigration_T)
+        self.exper_data = self._experiment_dict(direction)
+
+        #what a journalled result depends on, besides (direction, I, z, Cv)
+        self.direction = direction
+        if self.journal is not None:
+            self.input_hash = self._input_hash(self.exper_data[IAbs])
+
+        return IAbs, ISigned
+
+    def _setup_inputs(self, emigration_T):
+        """
+        Sets up everything a search needs that doesn't depend on the current or its direction. This is kept between
+        searches at the same temperature
+        """
+
+        if getattr(self, 'emigration_T', None) == emigration_T:
+            return
+
         self.x = np.linspace(0, 25, num=100)
-        edict = self.input_datastore.edict_for_direction(direction)
-        self.exper_data = self.input_datastore.interpolated_experiment_dict(self.x, edict)
         self.diffusivity = self.input_datastore.interpolated_diffusivity(10001, emigration_T, precise=True)
         self.resistivity = self.input_datastore.interpolated_resistivity(10001, emigration_T)
 
@@ -61,44 +417,149 @@ class ParamSearchEngine():
         self.ndt = int(2 * 60 * 60 / 0.05)
         self.dx = 25e-6 / 100
 
-        #now create a queue
-        work_queue = itertools.product(z_list, dmult_list)
+    def _experiment_dict(self, direction):
+        """
+        The experimental profiles for direction, by current, interpolated onto self.x; each direction is only
+        interpolated once
+        """
+
+        if direction not in self.exper_cache:
+            edict = self.input_datastore.edict_for_direction(direction)
+            self.exper_cache[direction] = self.input_datastore.interpolated_experiment_dict(self.x, edict)
+        return self.exper_cache[direction]
+
+    def _input_hash(self, exper):
+        """
+        Hash of what a finished, journalled result depends on, besides (direction, I, z, Cv). Pruning doesn't change
+        a finished result, so it is left to _prune_key
+
+        :param exper: the experimental profile being fitted
+        """
+
+        #do_work_batch always runs the explicit scheme
+        return SearchJournal.input_hash(self.calcsim_wrapper.backend.name, str(KERNEL_VERSION), 'explicit',
+                                        self.diffusivity, self.resistivity, exper, self.init_cond, self.x,
+                                        self.emigration_T, self.dt, self.ndt, self.dx, self.fractional_shift)
+
+    def _prune_key(self):
+        """
+        What decides whether a point is pruned, for journalling pruned results with; None if not pruning
+        """
+
+        if self.prune_threshold is None:
+            return None
+        return str.format('threshold={!r}, chunk_steps={}', float(self.prune_threshold), self.chunk_steps)
+
+    def _evaluate(self, work_queue, IAbs, ISigned, progress_cb, batch_size):
+        """
+        Simulates and scores each (z, Cv) pair in work_queue on the worker pool, batch_size at a time
+
+        :return: vector of fit measures, in the same order as work_queue; NaN where the simulation was unstable
+        """
 
         #create storage
-        ret_storage = np.zeros((len(z_list), len(dmult_list)))
+        ret_storage = np.zeros(len(work_queue))
+
+        def store(indicies, simres_list):
+            ret_storage[indicies] = simres_list
+
+        job = {'direction': self.direction, 'IAbs': IAbs, 'ISigned': ISigned, 'exper': self.exper_data[IAbs],
+               'store': store}
+        if self.journal is not None:
+            job['input_hash'] = self.input_hash
+        self._run_jobs([job], work_queue, progress_cb, batch_size)
+        return ret_storage
+
+    def _run_jobs(self, jobs, work_queue, progress_cb, batch_size, max_workers=8):
+        """
+        Simulates and scores every (z, Cv) pair in work_queue for each job on one worker pool, batch_size pairs at a
+        time. Pairs already in the journal are taken from it rather than simulated, and every new result is recorded
+        in it. Raises SimulationCancelledError (or KeyboardInterrupt) once the workers have wound down if the search
+        is stopped. If a batch raises anything else, the rest of the work is stopped the same way before the
+        exception is passed on
+
+        :param jobs: list of dicts, one per map, each with the 'direction', 'IAbs', 'ISigned' and 'exper'
+            (experimental profile) of the map, its 'input_hash' if there is a journal, and a 'store' callback. store
+            is called as store(indicies, simres_list) with each set of results, indicies being into work_queue
+        :param progress_cb: given the number of pairs finished so far, over every job
+        """
 
+        self.partial_progress = {}
+        prune_key = self._prune_key()
         unstable_count = 0
+        pruned_count = 0
+        pcount = 0
 
-        with ThreadPoolExecutor(max_workers=8) as executor:
-            future_dict = dict(
-                ((executor.submit(self.do_work, qit[0], qit[1], IAbs, ISigned), qit)
-                 for qit in work_queue)
-            )
-            pcount = 0
-            for res_future in futures.as_completed(future_dict):
-                qit = future_dict[res_future]
-
-                z_index = np.nonzero(z_list == qit[0])[0][0]
-                d_index = np.nonzero(dmult_list == qit[1])[0][0]
-                try:
-                    simres = res_future.result()
-                    logging.debug(str.format(
-                        'Writing ({}, {}) (val = {}) into position ({}, {})',
-                        qit[0], qit[1], simres, z_index, d_index
-                    ))
-                    ret_storage[z_index, d_index] = simres
-                except SimulationUnstableError:
-                    logging.warning(str.format(
-                        'Simulation unstable for ({}, {}) for position ({}, {})',
-                        qit[0], qit[1], z_index, d_index
-                    ))
-                    unstable_count += 1
-
-                pcount += 1
-                progress_cb(pcount)
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        future_dict = {}
+        try:
+            for job in jobs:
+                #anything already in the journal doesn't need simulating again
+                todo = list(range(len(work_queue)))
+                if self.journal is not None:
+                    recorded = self.journal.lookup(job['input_hash'], job['direction'], job['IAbs'], work_queue,
+                                                   prune_key)
+                    todo = [index for index, qit in enumerate(work_queue) if qit not in recorded]
+                    done_indicies = [index for index, qit in enumerate(work_queue) if qit in recorded]
+                    if done_indicies:
+                        logging.info(str.format('Reusing {} results from the search journal', len(done_indicies)))
+                        job['store'](done_indicies, [recorded[work_queue[index]] for index in done_indicies])
+                    pcount += len(done_indicies)
+
+                for i in range(0, len(todo), batch_size):
+                    batch = todo[i:i + batch_size]
+                    future = executor.submit(self.do_work_batch, [work_queue[index] for index in batch],
+                                             job['IAbs'], job['ISigned'], job['exper'])
+                    future_dict[future] = (job, batch)
+
+            last_reported = 0
+            pending = set(future_dict)
+            while pending:
+                done, pending = futures.wait(pending, timeout=0.5, return_when=futures.FIRST_COMPLETED)
+                if self.cancel_event.is_set():
+                    raise SimulationCancelledError('Parameter search cancelled')
+
+                for res_future in done:
+                    job, batch = future_dict[res_future]
+                    simres_list = res_future.result()
+
+                    for index, simres in zip(batch, simres_list):
+                        qit = work_queue[index]
+                        if np.isnan(simres):
+                            logging.warning(str.format('Simulation unstable for ({}, {})', qit[0], qit[1]))
+                            unstable_count += 1
+                        elif simres == PRUNED:
+                            logging.debug(str.format('Pruned ({}, {})', qit[0], qit[1]))
+                            pruned_count += 1
+                        else:
+                            logging.debug(str.format('Result for ({}, {}): {}', qit[0], qit[1], simres))
+
+                    if self.journal is not None:
+                        results = [(work_queue[index], simres) for index, simres in zip(batch, simres_list)]
+                        self.journal.record(job['input_hash'], job['direction'], job['IAbs'], results,
+                                            prune_key)
+                    job['store'](batch, simres_list)
+                    pcount += len(batch)
+
+                #count the finished fraction of batches still running, so progress moves between batches
+                progress = int(pcount + sum(list(self.partial_progress.values())))
+                if progress != last_reported:
+                    last_reported = progress
+                    progress_cb(progress)
+        except BaseException:
+            #whatever went wrong, make the workers wind down rather than run every batch left
+            self.cancel()
+            for future in future_dict:
+                future.cancel()
+            raise
+        finally:
+            executor.shutdown(wait=True)
+            #the search is over; a cancel() from here on stops the next one
+            self.cancel_event.clear()
 
         logging.info('Simulation unstable count: ' + str(unstable_count))
-        return ret_storage
+        if self.prune_threshold is not None:
+            logging.info('Simulation pruned count: ' + str(pruned_count))
 
     def do_work(self, z, dmult, IAbs, ISigned):
         """
@@ -114,6 +575,53 @@ class ParamSearchEngine():
         simresults = self.calcsim_wrapper.calc_simulation(self.diffusivity, self.resistivity,
                                                           self.init_cond, self.ndt, self.dt, self.dx,
                                                           r, dmult)
-        ce = ComparisonEngine(self.calcsim_wrapper)
-        lsq, shift = ce.calibrate(simresults, self.exper_data[IAbs])
-        return lsq
\ No newline at end of file
+        shifts, lsqs = compare_batch(self.calcsim_wrapper, simresults, self.exper_data[IAbs],
+                                     fractional=self.fractional_shift)
+        return lsqs[0]
+
+    def do_work_batch(self, batch, IAbs, ISigned, exper):
+        """
+        Does a whole batch of work from the search() method in one native call
+
+        :param batch: list of (z, dmult) pairs
+        :param exper: the experimental profile to score the simulations against
+        :return: A list of fit measures, one per pair; NaN where the simulation was unstable and PRUNED where it was
+            pruned
+        """
+
+        logging.debug(str.format('Executing batch of {} workloads', len(batch)))
+        z_values = np.array([qit[0] for qit in batch])
+        dmult_values = np.array([qit[1] for qit in batch])
+        r_values = self.calcsim_wrapper.emigration_factor(z_values, ISigned * 100 * 100, self.emigration_T)
+        run = SimulationRun(self.calcsim_wrapper, self.diffusivity, self.resistivity, self.init_cond,
+                            self.ndt, self.dt, self.dx, r_values, dmult_values,
+                            chunk_steps=self.chunk_steps, cancel_event=self.cancel_event)
+
+        def record_progress(steps_done):
+            self.partial_progress[id(batch)] = len(batch) * steps_done / self.ndt
+
+        estimates = np.zeros(len(batch))
+        try:
+            if self.prune_threshold is not None:
+                for steps_done, profiles in run:
+                    record_progress(steps_done)
+                    if run.finished:
+                        continue
+                    estimates[run.active] = lsq_prune_estimate(self.calcsim_wrapper, profiles[run.active], exper)
+                    pruned = run.active & (estimates > self.prune_threshold)
+                    if np.any(pruned):
+                        logging.debug(str.format('Pruning {} simulations after {} steps', np.sum(pruned), steps_done))
+                        run.stop(pruned)
+                if not run.finished:
+                    raise SimulationCancelledError('Parameter search cancelled')
+                simresults = run.profile
+            else:
+                simresults = run.run(record_progress)
+        finally:
+            self.partial_progress.pop(id(batch), None)
+        shifts, lsqs = compare_batch(self.calcsim_wrapper, simresults, exper,
+                                     fractional=self.fractional_shift)
+
+        if self.prune_threshold is not None:
+            lsqs = np.where(run.active, lsqs, PRUNED)
+        return list(lsqs)
@@ -0,0 +1,143 @@
+"""A size-limited cache of material property tables (interpolated D and R vectors), shared between threads and,
+optionally, between worker processes
+"""
+from collections import OrderedDict
+import logging
+import os
+import tempfile
+import threading
+
+import numpy as np
+
+from simcache import SimulationCache
+
+
+def default_shared_dir():
+    """
+    Somewhere in memory-backed storage for tables shared between processes: /dev/shm where there is one, otherwise the
+    temporary directory
+    """
+
+    base = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(base, 'diffsim-tables')
+
+
+class PropertyTableCache():
+    """
+    Property tables by key, kept in memory up to max_bytes and dropped least recently used first. Every table handed
+    out is read-only, so callers can share it rather than copying it.
+
+    If shared_dir is given, tables are also written there (see SimulationCache) and memory mapped back, so every
+    process using the same directory shares one copy of each table's pages; a table another process has already
+    made is mapped rather than recomputed. Put shared_dir on a memory-backed filesystem (default_shared_dir()).
+
+    Safe to use from any number of threads: a table is computed once however many threads ask for it at the same
+    time, and threads asking for different tables don't wait for each other.
+    """
+
+    def __init__(self, max_bytes=256 << 20, shared_dir=None):
+        """
+        :param max_bytes: most bytes of tables to keep in memory in this process
+        :param shared_dir: optional directory to share tables with other processes through
+        """
+
+        self.max_bytes = max_bytes
+        self.shared = SimulationCache(shared_dir, max_bytes) if shared_dir is not None else None
+
+        #everything below is guarded by lock; computing a table only holds its own key's lock
+        self.lock = threading.Lock()
+        self.tables = OrderedDict()
+        self.key_locks = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.shared_hits = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(*parts):
+        """
+        Makes a key for a table from everything it depends on, as SimulationCache.key does. Numbers are hashed as
+        float64, so T = 973 and T = 973.0 are the same table
+        """
+
+        return SimulationCache.key(*parts)
+
+    def get_or_compute(self, key, compute):
+        """
+        :param key: the table's key (see key())
+        :param compute: function making the table, if it isn't cached
+        :return: the table, as a read-only array
+        """
+
+        with self.lock:
+            table = self._lookup(key)
+            if table is not None:
+                return table
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            #another thread may have made it while this one waited
+            with self.lock:
+                table = self._lookup(key)
+                if table is not None:
+                    return table
+
+            table = self.shared.get(key, mmap=True) if self.shared is not None else None
+            if table is not None:
+                shared_hit = True
+            else:
+                shared_hit = False
+                table = np.array(compute(), dtype=np.float64)
+                if self.shared is not None:
+                    self.shared.put(key, table)
+                    #map the shared copy back, so this process uses the same pages as the others
+                    mapped = self.shared.get(key, mmap=True)
+                    if mapped is not None:
+                        table = mapped
+            table.flags.writeable = False
+
+            with self.lock:
+                if shared_hit:
+                    self.shared_hits += 1
+                else:
+                    self.misses += 1
+                self.tables[key] = table
+                self.nbytes += table.nbytes
+                self._evict()
+                self.key_locks.pop(key, None)
+        return table
+
+    def stats(self):
+        """
+        :return: dict of hits (tables already in this process), shared_hits (tables mapped from another process's),
+            misses (tables computed), evictions, and the number of tables and bytes held in this process
+        """
+
+        with self.lock:
+            return {'hits': self.hits, 'shared_hits': self.shared_hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'tables': len(self.tables), 'bytes': self.nbytes}
+
+    def clear(self):
+        """
+        Drops every table held in this process; tables already handed out stay valid
+        """
+
+        with self.lock:
+            self.tables.clear()
+            self.nbytes = 0
+
+    def _lookup(self, key):
+        table = self.tables.get(key)
+        if table is not None:
+            self.tables.move_to_end(key)
+            self.hits += 1
+        return table
+
+    def _evict(self):
+        #always keep the newest table, even if it alone is over the budget
+        while self.nbytes > self.max_bytes and len(self.tables) > 1:
+            key, table = self.tables.popitem(last=False)
+            self.nbytes -= table.nbytes
+            self.evictions += 1
+        logging.debug(str.format('Property table cache holds {} tables, {} bytes', len(self.tables), self.nbytes))
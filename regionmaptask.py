@@ -1,5 +1,5 @@
+from functools import partial
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from threading import RLock
 from matplotlib import cm
 import matplotlib
 from matplotlib.backends.backend_agg import FigureCanvasAgg
@@ -7,6 +7,7 @@ from matplotlib.figure import Figure
 import sys
 from calcsim import SimulationUnstableError
 from calcsimexecutor import CalcSimExecutor
+from modelfit import abs_cvf
 from datastore import InputDatastore
 import defaults
 from diffsimtask import DiffSimTask
@@ -17,10 +18,9 @@ import itertools
 import progressbar
 
 dstore = InputDatastore('../InputData', 'NiCu')
-dstorelock = RLock()
 
 z = 160
-cvfunc = lambda ID: 0.53e-3 * abs(ID) + 1
+cvfunc = partial(abs_cvf, 0.53e-3)
 direction = sys.argv[1]
 
 Idensities = np.arange(0, 5100, 100)
@@ -36,11 +36,10 @@ i = 0
 
 
 def do_work(T, I):
-    with dstorelock:
-        Davg = dstore.interpolated_diffusivity(1001, T).mean()
-        n_secs_sim = 1e-12 / Davg
-        dt = n_secs_sim / (defaults.simulation_tsteps * 1)
-        cse = CalcSimExecutor(dstore, T, dt=dt, ndt=(defaults.simulation_tsteps * 1))
+    Davg = dstore.interpolated_diffusivity(1001, T).mean()
+    n_secs_sim = 1e-12 / Davg
+    dt = n_secs_sim / (defaults.simulation_tsteps * 1)
+    cse = CalcSimExecutor(dstore, T, dt=dt, ndt=(defaults.simulation_tsteps * 1))
 
     try:
         current = cse.compute(z, cvfunc(I), I, direction)[:, 1]
@@ -0,0 +1,317 @@
+"""Spreads a parameter search over several machines: a SearchCoordinator splits the search into shards and hands them
+out over a socket to SearchWorkers, each of which runs its shards on its own ParamSearchEngine
+
+Run a worker on each node with
+    python searchcluster.py --connect HOST:PORT --authkey KEY --inputdata DIR \
+        [--journal FILE] [--simcache DIR]
+pointing at the same input data as the coordinator. A worker's journal and simulation cache are its own, so a worker
+restarted with the same ones skips whatever it had already done. Search options such as fractional shifts and pruning
+come from the coordinator with each shard (see SearchCoordinator.search), so are never given to a worker. Messages
+are pickled, so only use this on a trusted network; the authkey keeps out anything that doesn't know it.
+"""
+from argparse import ArgumentParser
+from collections import deque
+from multiprocessing.connection import Client, Listener
+import itertools
+import logging
+import threading
+import time
+
+import numpy as np
+
+from calcsim import CalcSimWrapper
+from datastore import InputDatastore
+from paramsearch import ParamSearchEngine
+from searchjournal import SearchJournal
+from simcache import SimulationCache
+
+
+class SearchCoordinator():
+    """
+    Hands out shards of (z*, Cv) points to any number of SearchWorkers and puts their results back together.
+
+    Workers ask for a shard, send a heartbeat every so often while they work on it, and send back its LSQ values.
+    A shard is put back at the front of the queue if its worker disconnects, or goes heartbeat_timeout seconds
+    without a heartbeat. Each point's result is stored by its position in the map, so the maps come out the same
+    whatever order the shards finish in and however many times one is retried.
+    """
+
+    def __init__(self, address=('localhost', 0), authkey=b'diffsim', heartbeat_timeout=30.0):
+        """
+        :param address: (host, port) to listen on; port 0 picks a free one, which is then in self.address
+        :param authkey: shared secret the workers must also be given
+        :param heartbeat_timeout: seconds without a heartbeat after which a worker's shard is given to another one
+        """
+
+        self.listener = Listener(address, authkey=authkey)
+        self.address = self.listener.address
+        self.heartbeat_timeout = heartbeat_timeout
+
+        #everything below is guarded by cond
+        self.cond = threading.Condition()
+        self.queue = deque()
+        self.shards = {}
+        #shard id -> [worker id, time of last heartbeat]
+        self.leases = {}
+        self.results = {}
+        self.closed = False
+        self.shard_ids = itertools.count()
+        self.worker_ids = itertools.count()
+
+        for target in (self._accept_loop, self._reap_loop):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def search(self, z_list, dmult_list, jobs, progress_cb=None, shard_size=64, settings=None):
+        """
+        Runs ParamSearchEngine.search() for each job on the workers, and waits for all of them to finish
+
+        :param jobs: list of (temperature, direction, I) to make a search map for
+        :param progress_cb: if given, called with the number of (z*, Cv) points finished so far, over every job
+        :param shard_size: number of (z*, Cv) points in a shard
+        :param settings: ParamSearchEngine.settings() of an engine set up as the search should be (fractional shifts,
+            pruning etc.); every shard carries them, so every worker scores its points the same way. Settings left
+            out are the ones each worker's engine started with
+        :return: dict of job -> search map. As in search(), unstable points are NaN and pruned ones PRUNED
+        """
+
+        cells = list(itertools.product(range(len(z_list)), range(len(dmult_list))))
+        points = [(float(z_list[z_index]), float(dmult_list[d_index])) for z_index, d_index in cells]
+
+        shard_ids = []
+        with self.cond:
+            for job in jobs:
+                for start in range(0, len(points), shard_size):
+                    shard_id = next(self.shard_ids)
+                    T, direction, I = job
+                    self.shards[shard_id] = {'type': 'shard', 'id': shard_id, 'T': T, 'direction': direction,
+                                             'I': I, 'points': points[start:start + shard_size],
+                                             'settings': dict(settings or {})}
+                    shard_ids.append((shard_id, job, start))
+                    self.queue.append(shard_id)
+            self.cond.notify_all()
+
+            total = len(shard_ids)
+            done = 0
+            while done < total:
+                self.cond.wait(1.0)
+                finished = sum(1 for shard_id, job, start in shard_ids if shard_id in self.results)
+                if finished != done:
+                    done = finished
+                    if progress_cb is not None:
+                        progress_cb(sum(len(self.shards[shard_id]['points'])
+                                        for shard_id, job, start in shard_ids if shard_id in self.results))
+
+            results = dict((job, np.full((len(z_list), len(dmult_list)), np.nan)) for job in jobs)
+            for shard_id, job, start in shard_ids:
+                for offset, lsq in enumerate(self.results.pop(shard_id)):
+                    results[job][cells[start + offset]] = lsq
+                del self.shards[shard_id]
+        return results
+
+    def close(self):
+        """
+        Tells the workers to stop (the next time they ask for work) and stops listening for new ones
+        """
+
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.listener.close()
+
+    def _accept_loop(self):
+        while True:
+            try:
+                conn = self.listener.accept()
+            except (OSError, EOFError) as e:
+                with self.cond:
+                    if self.closed:
+                        return
+                logging.warning('Rejected search worker: ' + str(e))
+                continue
+            thread = threading.Thread(target=self._serve, args=(conn, next(self.worker_ids)))
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, conn, worker_id):
+        logging.info(str.format('Search worker {} connected', worker_id))
+        try:
+            while True:
+                msg = conn.recv()
+                with self.cond:
+                    if msg['type'] == 'request':
+                        if self.queue:
+                            shard_id = self.queue.popleft()
+                            self.leases[shard_id] = [worker_id, time.time()]
+                            reply = self.shards[shard_id]
+                        elif self.closed:
+                            reply = {'type': 'stop'}
+                        else:
+                            reply = {'type': 'wait', 'delay': 0.5}
+                    elif msg['type'] == 'heartbeat':
+                        lease = self.leases.get(msg['id'])
+                        if lease is not None and lease[0] == worker_id:
+                            lease[1] = time.time()
+                        continue
+                    elif msg['type'] == 'result':
+                        #a shard that was given out twice keeps whichever result came back first
+                        if msg['id'] in self.shards and msg['id'] not in self.results:
+                            self.results[msg['id']] = msg['lsqs']
+                        self.leases.pop(msg['id'], None)
+                        self.cond.notify_all()
+                        continue
+                    else:
+                        raise ValueError('Unknown message from search worker: ' + str(msg['type']))
+                conn.send(reply)
+                if reply['type'] == 'stop':
+                    break
+        except (EOFError, OSError) as e:
+            logging.warning(str.format('Lost search worker {}: {}', worker_id, e))
+        finally:
+            conn.close()
+            self._requeue(lambda shard_id, lease: lease[0] == worker_id)
+
+    def _reap_loop(self):
+        while True:
+            time.sleep(self.heartbeat_timeout / 4.0)
+            with self.cond:
+                if self.closed:
+                    return
+            cutoff = time.time() - self.heartbeat_timeout
+            self._requeue(lambda shard_id, lease: lease[1] < cutoff)
+
+    def _requeue(self, lost):
+        with self.cond:
+            for shard_id, lease in list(self.leases.items()):
+                if lost(shard_id, lease):
+                    logging.warning(str.format('Requeueing shard {} from search worker {}', shard_id, lease[0]))
+                    del self.leases[shard_id]
+                    if shard_id in self.shards and shard_id not in self.results:
+                        self.queue.appendleft(shard_id)
+            self.cond.notify_all()
+
+
+class SearchWorker():
+    """
+    Takes shards from a SearchCoordinator and works them out with a local ParamSearchEngine until told to stop
+    """
+
+    def __init__(self, engine, address, authkey=b'diffsim', heartbeat_interval=5.0, batch_size=16):
+        """
+        :param engine: ParamSearchEngine to run the simulations with
+        :param address: (host, port) of the coordinator
+        :param authkey: the coordinator's authkey
+        :param heartbeat_interval: seconds between heartbeats; well under the coordinator's heartbeat_timeout
+        :param batch_size: (z*, Cv) points per native call, as for ParamSearchEngine.search()
+        """
+
+        assert isinstance(engine, ParamSearchEngine)
+
+        self.engine = engine
+        self.address = address
+        self.authkey = authkey
+        self.heartbeat_interval = heartbeat_interval
+        self.batch_size = batch_size
+        #what each shard's settings are applied on top of
+        self.default_settings = engine.settings()
+
+    def run(self):
+        """
+        Works until the coordinator says to stop or goes away
+
+        :return: number of shards worked out
+        """
+
+        conn = Client(self.address, authkey=self.authkey)
+        send_lock = threading.Lock()
+        shards_done = 0
+
+        def send(msg):
+            with send_lock:
+                conn.send(msg)
+
+        try:
+            while True:
+                send({'type': 'request'})
+                msg = conn.recv()
+                if msg['type'] == 'stop':
+                    break
+                if msg['type'] == 'wait':
+                    time.sleep(msg['delay'])
+                    continue
+
+                finished = threading.Event()
+
+                def heartbeat(shard_id=msg['id']):
+                    while not finished.wait(self.heartbeat_interval):
+                        send({'type': 'heartbeat', 'id': shard_id})
+                beat = threading.Thread(target=heartbeat)
+                beat.daemon = True
+                beat.start()
+                try:
+                    lsqs = self.work(msg)
+                finally:
+                    finished.set()
+                    beat.join()
+                send({'type': 'result', 'id': msg['id'], 'lsqs': lsqs})
+                shards_done += 1
+        except (EOFError, OSError) as e:
+            logging.warning('Lost the search coordinator: ' + str(e))
+        finally:
+            conn.close()
+        return shards_done
+
+    def work(self, shard):
+        """
+        Works out the LSQ at every point of a shard
+
+        :return: list of LSQ values, NaN where the simulation was unstable and PRUNED where it was pruned
+        """
+
+        logging.info(str.format('Working on shard {} ({} bias, I = {}, {} points)', shard['id'],
+                                shard['direction'], shard['I'], len(shard['points'])))
+        settings = dict(self.default_settings)
+        settings.update(shard['settings'])
+        self.engine.update_settings(settings)
+        lsqs = self.engine.evaluate_points(shard['points'], shard['I'], shard['T'], shard['direction'],
+                                           batch_size=self.batch_size)
+        return [float(lsq) for lsq in lsqs]
+
+
+def parse_address(address):
+    """
+    Turns HOST:PORT into a (host, port) tuple
+    """
+
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+if __name__ == '__main__':
+
+    aparser = ArgumentParser(description='Runs parameter search shards handed out by a SearchCoordinator')
+    aparser.add_argument('--connect', metavar='HOST:PORT', type=str, required=True,
+                         help='Address of the coordinator')
+    aparser.add_argument('--authkey', type=str, default='diffsim',
+                         help='Shared secret, as given to the coordinator')
+    aparser.add_argument('--inputdata', metavar='DIR', type=str, required=True,
+                         help='Directory containing input data')
+    aparser.add_argument('--dataprefix', metavar='PREFIX', type=str, default='NiCu',
+                         help='Prefix to data files')
+    aparser.add_argument('--journal', metavar='FILE', type=str, default=None,
+                         help='Record every simulation this worker runs in this SQLite file, and skip any already in '
+                              'it')
+    aparser.add_argument('--simcache', metavar='DIR', type=str, default=None,
+                         help='Keep simulation results in DIR and reuse them when the same simulation is run again')
+
+    args = aparser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    simcache = SimulationCache(args.simcache) if args.simcache is not None else None
+    worker_engine = ParamSearchEngine(CalcSimWrapper(cache=simcache), InputDatastore(args.inputdata, args.dataprefix))
+    if args.journal is not None:
+        worker_engine.journal = SearchJournal(args.journal)
+    worker = SearchWorker(worker_engine, parse_address(args.connect), args.authkey.encode('utf-8'))
+    count = worker.run()
+    print(str.format('Worked out {} shards', count))
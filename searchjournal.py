@@ -0,0 +1,105 @@
+"""An on-disk record of every (z*, Cv) a parameter search has scored, so that a search that is killed part way through
+can carry on where it left off
+"""
+import hashlib
+import sqlite3
+
+import numpy as np
+
+
+class SearchJournal():
+    """
+    Search results kept in an SQLite file, one row per simulation, keyed by (input hash, direction, current, z*, Cv).
+    The input hash covers everything else a result depends on (material properties, experimental data, timestep,
+    kernel version etc.; see input_hash), so results from a search with different inputs are never reused.
+
+    Unstable simulations are stored with an explicit flag and come back as NaN, so they can't be mistaken for a
+    perfect fit. Pruned simulations (see ParamSearchEngine.prune_threshold) are flagged too, and come back as infinity
+    (paramsearch.PRUNED) rather than as an LSQ they never finished. A finished result doesn't depend on whether the
+    search was pruning, but a pruned one does, so pruned rows also record the pruning settings (the prune key) and
+    are only reused by a search pruning the same way.
+
+    Rows are committed a batch at a time, and SQLite makes each commit atomic, so the journal survives the process
+    being killed at any point. Only use a journal from the thread that opened it.
+    """
+
+    def __init__(self, filename):
+        """
+        :param filename: path of the SQLite file; it is created if it doesn't exist
+        """
+
+        self.filename = filename
+        self.conn = sqlite3.connect(filename)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS results ('
+                          'input_hash TEXT, direction TEXT, current REAL, z REAL, cvf REAL, '
+                          'lsq REAL, unstable INTEGER, pruned INTEGER DEFAULT 0, prune_key TEXT, '
+                          'PRIMARY KEY (input_hash, direction, current, z, cvf))')
+        #journals written before pruned points were flagged, or before they recorded how they were pruned (those
+        #pruned rows have no prune key, so are never reused)
+        columns = [row[1] for row in self.conn.execute('PRAGMA table_info(results)')]
+        if 'pruned' not in columns:
+            self.conn.execute('ALTER TABLE results ADD COLUMN pruned INTEGER DEFAULT 0')
+        if 'prune_key' not in columns:
+            self.conn.execute('ALTER TABLE results ADD COLUMN prune_key TEXT')
+        self.conn.commit()
+
+    @staticmethod
+    def input_hash(*arrays):
+        """
+        Hashes the values a search's results depend on, besides the search coordinates themselves
+
+        :param arrays: arrays, scalars and strings, in a fixed order
+        """
+
+        digest = hashlib.sha1()
+        for arr in arrays:
+            if isinstance(arr, str):
+                digest.update(arr.encode('utf-8') + b'\0')
+            else:
+                digest.update(np.ascontiguousarray(arr, dtype=np.float64).tobytes())
+        return digest.hexdigest()
+
+    def lookup(self, input_hash, direction, current, work_queue, prune_key=None):
+        """
+        Finds the results already recorded for some (z*, Cv) pairs
+
+        :param work_queue: list of (z*, Cv) pairs
+        :param prune_key: the pruning settings of the search asking, or None if it isn't pruning. Pruned results are
+            only found for a search with the same prune key
+        :return: dict of (z*, Cv) -> LSQ (NaN if it was unstable, infinity if it was pruned), for the pairs that have
+            been recorded
+        """
+
+        found = {}
+        cursor = self.conn.execute('SELECT z, cvf, lsq, unstable, pruned, prune_key FROM results '
+                                   'WHERE input_hash = ? AND direction = ? AND current = ?',
+                                   (input_hash, direction, float(current)))
+        recorded = dict(((z, cvf), np.nan if unstable else np.inf if pruned else lsq)
+                        for z, cvf, lsq, unstable, pruned, row_prune_key in cursor
+                        if not pruned or (prune_key is not None and row_prune_key == prune_key))
+        for qit in work_queue:
+            key = (float(qit[0]), float(qit[1]))
+            if key in recorded:
+                found[qit] = recorded[key]
+        return found
+
+    def record(self, input_hash, direction, current, results, prune_key=None):
+        """
+        Records the results of some simulations and commits them to disk
+
+        :param results: list of ((z*, Cv), LSQ) pairs, with NaN LSQ for unstable simulations and infinity for
+            pruned ones
+        :param prune_key: the pruning settings of the search the results came from, if it was pruning
+        """
+
+        rows = [(input_hash, direction, float(current), float(qit[0]), float(qit[1]),
+                 None if np.isnan(lsq) or np.isinf(lsq) else float(lsq), int(np.isnan(lsq)), int(np.isinf(lsq)),
+                 prune_key if np.isinf(lsq) else None)
+                for qit, lsq in results]
+        self.conn.executemany('INSERT OR REPLACE INTO results (input_hash, direction, current, z, cvf, lsq, unstable, '
+                              'pruned, prune_key) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,337 @@
+"""Backends that CalcSimWrapper can run simulations on
+
+A backend provides the core kernels from calcsim.c and fastshift.c (calc_simulation, calc_simulation_batch,
+fast_pad_shift and fast_pad_shift_batch) with the same conventions as the C code: contiguous float64 arrays in,
+results written into caller-supplied output arrays, and a SIM_SUCCESS/SIM_UNSTABLE status code returned. Backends
+that sit on top of libcalcsim.so also expose it as .lib, which CalcSimWrapper uses for the native-only modes
+(implicit schemes, snapshots, adaptive steps etc.).
+"""
+import ctypes
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+SIM_SUCCESS = 0
+SIM_UNSTABLE = 1
+
+#name -> backend class, in the order they are tried when no backend is asked for
+BACKENDS = OrderedDict()
+
+#libcalcsim.so, once _load_libcalcsim has loaded it
+_libcalcsim = None
+_libcalcsim_lock = threading.Lock()
+
+
+class BackendUnavailableError(Exception):
+    pass
+
+
+def register_backend(name):
+    """
+    Class decorator that adds a backend to BACKENDS under name. Backends registered earlier are preferred when
+    load_backend() picks one automatically.
+    """
+    def register(cls):
+        cls.name = name
+        BACKENDS[name] = cls
+        return cls
+    return register
+
+
+def load_backend(name=None):
+    """
+    Creates a backend. If name is None, each registered backend is tried in turn and the first one that can be loaded
+    on this host is returned.
+
+    :param name: key of BACKENDS, or None to choose automatically
+    """
+
+    if name is not None:
+        if name not in BACKENDS:
+            raise ValueError('Unknown simulation backend ' + str(name))
+        return BACKENDS[name]()
+
+    for backend_name, cls in BACKENDS.items():
+        try:
+            backend = cls()
+        except BackendUnavailableError as e:
+            logging.info(str.format('Simulation backend {} unavailable: {}', backend_name, e))
+            continue
+        logging.debug(str.format('Using simulation backend {}', backend_name))
+        return backend
+    raise BackendUnavailableError('No simulation backend could be loaded')
+
+
+def _double_ptr(arr):
+    return arr.ctypes.data_as(ctypes.POINTER(ctypes.c_double))
+
+
+def _int_ptr(arr):
+    return arr.ctypes.data_as(ctypes.POINTER(ctypes.c_int32))
+
+
+def _lround(x):
+    """
+    Rounds halves away from zero, like lround() in calcsim.c (np.round rounds them to even). a - floor(a) is exact,
+    so this gets 0.49999999999999994 right too, which floor(a + 0.5) doesn't
+    """
+
+    a = np.abs(x)
+    whole = np.floor(a)
+    return np.copysign(whole + (a - whole >= 0.5), x)
+
+
+def _load_libcalcsim():
+    """
+    Loads libcalcsim.so and declares its argument types. This only happens once per process; every CTypesBackend
+    shares the one library object
+    """
+
+    global _libcalcsim
+    with _libcalcsim_lock:
+        if _libcalcsim is not None:
+            return _libcalcsim
+
+        try:
+            lib = ctypes.cdll.LoadLibrary('libcalcsim.so')
+        except OSError:
+            try:
+                lib = ctypes.cdll.LoadLibrary('./libcalcsim.so')
+            except OSError as e:
+                raise BackendUnavailableError(str(e))
+
+        lib.calc_simulation.argtypes = [
+            ctypes.POINTER(ctypes.c_double), ctypes.POINTER(ctypes.c_double),
+            ctypes.c_int32, ctypes.POINTER(ctypes.c_double),
+            ctypes.c_int32, ctypes.c_int32, ctypes.c_double, ctypes.c_double,
+            ctypes.c_double, ctypes.POINTER(ctypes.c_double)
+        ]
+        lib.calc_simulation_implicit.argtypes = [
+            ctypes.POINTER(ctypes.c_double), ctypes.POINTER(ctypes.c_double),
+            ctypes.c_int32, ctypes.POINTER(ctypes.c_double),
+            ctypes.c_int32, ctypes.c_int32, ctypes.c_double, ctypes.c_double,
+            ctypes.c_double, ctypes.c_double, ctypes.POINTER(ctypes.c_double)
+        ]
+        lib.calc_simulation_snapshots.argtypes = [
+            ctypes.POINTER(ctypes.c_double), ctypes.POINTER(ctypes.c_double),
+            ctypes.c_int32, ctypes.POINTER(ctypes.c_double), ctypes.c_int32,
+            ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double,
+            ctypes.POINTER(ctypes.c_int32), ctypes.c_int32, ctypes.POINTER(ctypes.c_double)
+        ]
+        lib.calc_simulation_converge.argtypes = [
+            ctypes.POINTER(ctypes.c_double), ctypes.POINTER(ctypes.c_double),
+            ctypes.c_int32, ctypes.POINTER(ctypes.c_double),
+            ctypes.c_int32, ctypes.c_int32, ctypes.c_double, ctypes.c_double,
+            ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_int32,
+            ctypes.POINTER(ctypes.c_double), ctypes.POINTER(ctypes.c_int32)
+        ]
+        lib.calc_simulation_adaptive.argtypes = [
+            ctypes.POINTER(ctypes.c_double), ctypes.POINTER(ctypes.c_double),
+            ctypes.c_int32, ctypes.POINTER(ctypes.c_double), ctypes.c_int32,
+            ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double, ctypes.c_double,
+            ctypes.c_double, ctypes.c_double, ctypes.c_int32,
+            ctypes.POINTER(ctypes.c_double), ctypes.POINTER(ctypes.c_int32)
+        ]
+        lib.calc_simulation_interp.argtypes = [
+            ctypes.POINTER(ctypes.c_double), ctypes.POINTER(ctypes.c_double),
+            ctypes.POINTER(ctypes.c_double), ctypes.POINTER(ctypes.c_double),
+            ctypes.c_int32, ctypes.POINTER(ctypes.c_double),
+            ctypes.c_int32, ctypes.c_int32, ctypes.c_double, ctypes.c_double,
+            ctypes.c_double, ctypes.c_double, ctypes.POINTER(ctypes.c_double)
+        ]
+        lib.calc_simulation_mesh.argtypes = [
+            ctypes.POINTER(ctypes.c_double), ctypes.POINTER(ctypes.c_double),
+            ctypes.c_int32, ctypes.POINTER(ctypes.c_double),
+            ctypes.c_int32, ctypes.c_int32, ctypes.POINTER(ctypes.c_double), ctypes.c_double,
+            ctypes.c_double, ctypes.POINTER(ctypes.c_double)
+        ]
+        lib.calc_simulation_parallel.argtypes = [
+            ctypes.POINTER(ctypes.c_double), ctypes.POINTER(ctypes.c_double),
+            ctypes.c_int32, ctypes.POINTER(ctypes.c_double),
+            ctypes.c_int32, ctypes.c_int32, ctypes.c_double, ctypes.c_double,
+            ctypes.c_double, ctypes.c_int32, ctypes.c_int32, ctypes.c_int32,
+            ctypes.POINTER(ctypes.c_double)
+        ]
+        lib.calc_simulation_prepared.argtypes = [
+            ctypes.POINTER(ctypes.c_double), ctypes.POINTER(ctypes.c_double),
+            ctypes.c_int32, ctypes.POINTER(ctypes.c_double),
+            ctypes.c_int32, ctypes.c_int32, ctypes.c_double, ctypes.c_double,
+            ctypes.c_double, ctypes.c_double, ctypes.POINTER(ctypes.c_double),
+            ctypes.POINTER(ctypes.c_double)
+        ]
+        lib.calc_simulation_sensitivity.argtypes = [
+            ctypes.POINTER(ctypes.c_double), ctypes.POINTER(ctypes.c_double),
+            ctypes.c_int32, ctypes.POINTER(ctypes.c_double),
+            ctypes.c_int32, ctypes.c_int32, ctypes.c_double, ctypes.c_double,
+            ctypes.c_double, ctypes.c_double, ctypes.POINTER(ctypes.c_double),
+            ctypes.POINTER(ctypes.c_double), ctypes.POINTER(ctypes.c_double)
+        ]
+        lib.calc_simulation_batch.argtypes = [
+            ctypes.POINTER(ctypes.c_double), ctypes.POINTER(ctypes.c_double),
+            ctypes.c_int32, ctypes.POINTER(ctypes.c_double), ctypes.c_int32,
+            ctypes.c_int32, ctypes.c_int32, ctypes.c_double, ctypes.c_double,
+            ctypes.POINTER(ctypes.c_double), ctypes.POINTER(ctypes.c_double), ctypes.c_int32,
+            ctypes.POINTER(ctypes.c_double), ctypes.POINTER(ctypes.c_int32)
+        ]
+        lib.fast_pad_shift.argtypes = [
+            ctypes.POINTER(ctypes.c_double), ctypes.POINTER(ctypes.c_double), ctypes.c_int32
+        ]
+        lib.fast_pad_shift_lsq.argtypes = [
+            ctypes.POINTER(ctypes.c_double), ctypes.POINTER(ctypes.c_double), ctypes.c_int32,
+            ctypes.POINTER(ctypes.c_double)
+        ]
+        lib.fast_pad_shift_batch.argtypes = [
+            ctypes.POINTER(ctypes.c_double), ctypes.POINTER(ctypes.c_double), ctypes.c_int32, ctypes.c_int32,
+            ctypes.POINTER(ctypes.c_int32), ctypes.POINTER(ctypes.c_double)
+        ]
+
+        _libcalcsim = lib
+        return lib
+
+
+@register_backend('ctypes')
+class CTypesBackend():
+    """
+    The compiled kernels in libcalcsim.so, called through ctypes
+    """
+
+    def __init__(self):
+        self.lib = _load_libcalcsim()
+
+    def calc_simulation(self, D_vector, R_vector, init_cond, ndt, dt, dx, r, out):
+        return self.lib.calc_simulation(_double_ptr(D_vector), _double_ptr(R_vector), len(D_vector),
+                                        _double_ptr(init_cond), ndt, len(init_cond), dt, dx, r,
+                                        _double_ptr(out))
+
+    def calc_simulation_batch(self, D_vector, R_vector, init_cond, ndt, dt, dx, r_values, cv_factors,
+                              out, status):
+        #init_cond is either one profile shared by the batch, or one row per simulation
+        ndx = np.shape(init_cond)[-1]
+        init_stride = ndx if np.ndim(init_cond) == 2 else 0
+        return self.lib.calc_simulation_batch(_double_ptr(D_vector), _double_ptr(R_vector), len(D_vector),
+                                              _double_ptr(init_cond), init_stride, ndt, ndx, dt, dx,
+                                              _double_ptr(r_values), _double_ptr(cv_factors), len(r_values),
+                                              _double_ptr(out), _int_ptr(status))
+
+    def fast_pad_shift(self, y1, y2):
+        return self.lib.fast_pad_shift(_double_ptr(y1), _double_ptr(y2), len(y1))
+
+    def fast_pad_shift_batch(self, y1, models, shifts, lsqs):
+        return self.lib.fast_pad_shift_batch(_double_ptr(y1), _double_ptr(models), len(models), len(y1),
+                                             _int_ptr(shifts), _double_ptr(lsqs))
+
+
+@register_backend('numpy')
+class NumpyBackend():
+    """
+    Pure NumPy versions of the kernels. calc_simulation_batch advances every profile in the batch with one set of
+    array operations per timestep, so it needs no compiled code at all and does well on large batches. It follows
+    the C code operation for operation, so results agree with the ctypes backend.
+    """
+
+    lib = None
+
+    def calc_simulation(self, D_vector, R_vector, init_cond, ndt, dt, dx, r, out):
+        #D_vector has already been scaled by the caller, just like for the C kernel
+        batch_out = np.zeros((1, np.shape(init_cond)[-1]))
+        status = np.zeros(1, dtype=np.int32)
+        self.calc_simulation_batch(D_vector, R_vector, init_cond, ndt, dt, dx,
+                                   np.array([r], dtype=np.float64), np.ones(1), batch_out, status)
+        out[:] = batch_out[0, :]
+        return int(status[0])
+
+    def calc_simulation_batch(self, D_vector, R_vector, init_cond, ndt, dt, dx, r_values, cv_factors,
+                              out, status):
+        nIV = len(D_vector)
+        nsims = len(r_values)
+        scale = nIV - 1
+
+        #dR/dc only depends on the table index; same central/one-sided difference as calcsim.c
+        index = np.arange(nIV)
+        d_left = np.where(index == 0, index, index - 1)
+        d_right = np.where(index == nIV - 1, index, index + 1)
+        span = d_right - d_left
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dR_vector = np.where(span == 0, 0, (R_vector[d_right] - R_vector[d_left]) / span * scale)
+
+        cvf = cv_factors[:, np.newaxis]
+        r = r_values[:, np.newaxis]
+        unstable = np.zeros(nsims, dtype=bool)
+
+        #init_cond is either one profile shared by the batch, or one row per simulation
+        prev = np.array(np.broadcast_to(init_cond, (nsims, np.shape(init_cond)[-1])), dtype=np.float64)
+        nxt = prev.copy()
+
+        with np.errstate(all='ignore'):
+            for n in range(ndt):
+                #anything rounding to outside the tables means that simulation has blown up
+                raw_index = _lround(prev * scale)
+                unstable |= np.any((raw_index < 0) | (raw_index >= nIV) | np.isnan(raw_index), axis=1)
+                Ck_index = np.clip(np.nan_to_num(raw_index[:, 1:-1]), 0, nIV - 1).astype(np.intp)
+
+                d_left_index = d_left[Ck_index]
+                d_right_index = d_right[Ck_index]
+
+                Dv = D_vector[Ck_index] * cvf
+                Rv = R_vector[Ck_index]
+                dDdc = (D_vector[d_right_index] * cvf - D_vector[d_left_index] * cvf) / \
+                    (d_right_index - d_left_index) * scale
+                dRdc = dR_vector[Ck_index]
+
+                C = prev[:, 1:-1]
+                dCdx = (prev[:, 2:] - prev[:, 1:-1]) / dx
+                d2Cdx2 = (prev[:, 2:] - 2 * prev[:, 1:-1] + prev[:, :-2]) / (dx * dx)
+
+                nxt[:, 1:-1] = dt * (Dv*d2Cdx2 + dDdc*dCdx*dCdx - dDdc*dCdx*C*Rv*r - Dv*Rv*dCdx*r
+                                     - Dv*dRdc*dCdx*C*r) + C
+
+                prev, nxt = nxt, prev
+
+        out[:, :] = prev
+        status[:] = np.where(unstable, SIM_UNSTABLE, SIM_SUCCESS)
+        return SIM_SUCCESS
+
+    def fast_pad_shift(self, y1, y2):
+        shifts = np.zeros(1, dtype=np.int32)
+        lsqs = np.zeros(1)
+        self.fast_pad_shift_batch(y1, y2[np.newaxis, :], shifts, lsqs)
+        return int(shifts[0])
+
+    def fast_pad_shift_batch(self, y1, models, shifts, lsqs):
+        #same scheme as fastshift.c: the error at every shift from prefix sums and an FFT cross-correlation
+        length = len(y1)
+        nmodels = len(models)
+        nfft = 1
+        while nfft < 2 * length:
+            nfft *= 2
+
+        #xcorr[:, length + dx] = sum_i y1[i] * y2[i + dx]
+        spectra = np.conj(np.fft.rfft(y1, nfft)) * np.fft.rfft(models, nfft, axis=1)
+        circular = np.fft.irfft(spectra, nfft, axis=1)
+        dx = np.arange(-length, length + 1)
+        xcorr = np.where(np.abs(dx) < length, circular[:, dx % nfft], 0)
+
+        p1 = np.concatenate(([0], np.cumsum(y1)))
+        p2sq = np.concatenate((np.zeros((nmodels, 1)), np.cumsum(models ** 2, axis=1)), axis=1)
+        y1sq = np.sum(y1 ** 2)
+
+        n_ones = np.maximum(-dx, 0)
+        jlo = np.maximum(dx, 0)
+        jhi = np.where(dx < 0, length + dx, length)
+        lsq_sums = n_ones + (p2sq[:, jhi] - p2sq[:, jlo]) + y1sq - 2 * (p1[n_ones] + xcorr)
+
+        #shifts within rounding of the best count as a tie, which goes to the first one as in the C loop
+        tol = 1e-12 * (y1sq + length)
+        best = np.argmax(lsq_sums <= np.min(lsq_sums, axis=1)[:, np.newaxis] + tol, axis=1)
+
+        #the exact error at the chosen shift; padded is y2 with ones on the left and zeros on the right
+        padded = np.concatenate((np.ones((nmodels, length)), models, np.zeros((nmodels, length))), axis=1)
+        chosen = padded[np.arange(nmodels)[:, np.newaxis], best[:, np.newaxis] + np.arange(length)]
+        lsqs[:] = np.sum((chosen - y1) ** 2, axis=1)
+
+        #same sign convention as the C code
+        shifts[:] = -(best - length)
+        return SIM_SUCCESS
@@ -0,0 +1,163 @@
+"""An on-disk cache of simulation results, so that re-plotting or re-analysing a search doesn't have to run the same
+simulations again
+"""
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+
+import numpy as np
+
+
+class SimulationCache():
+    """
+    Simulation results kept as .npy files in a directory, one per result, named by a hash of everything the result
+    depends on (see key). Any number of processes can share a directory: files are written to a temporary name and
+    renamed into place, so a reader never sees half of one.
+
+    The directory is kept under max_bytes by deleting the least recently used results; a file's modification time is
+    bumped every time it is read, so it doubles as its last use.
+    """
+
+    def __init__(self, directory, max_bytes=1 << 30):
+        """
+        :param directory: where to keep the results; it is created if it doesn't exist
+        :param max_bytes: size the directory is kept under
+        """
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+        #several processes may be starting on the same directory at once
+        os.makedirs(directory, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size = sum(size for name, size, mtime in self._entries())
+
+    @staticmethod
+    def key(*parts):
+        """
+        Hashes everything a result depends on into a cache key
+
+        :param parts: strings, and arrays and scalars, in a fixed order. Arrays are hashed along with their shape, so
+            the same numbers laid out differently give a different key
+        """
+
+        digest = hashlib.sha1()
+        for part in parts:
+            if isinstance(part, str):
+                digest.update(b's' + part.encode('utf-8') + b'\0')
+            else:
+                arr = np.ascontiguousarray(part, dtype=np.float64)
+                digest.update(b'a' + str(arr.shape).encode('ascii') + arr.tobytes())
+        return digest.hexdigest()
+
+    def get(self, key, mmap=False):
+        """
+        :param mmap: if True, the result is memory mapped read-only rather than read in, so processes that get the
+            same result share its pages
+        :return: the result stored under key, or None if there isn't one
+        """
+
+        filename = self._filename(key)
+        try:
+            result = np.load(filename, mmap_mode='r' if mmap else None)
+        except (IOError, OSError, ValueError):
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        #mark it as just used; if another process has evicted it meanwhile, what was read is still good
+        try:
+            os.utime(filename, None)
+        except OSError:
+            pass
+        return result
+
+    def put(self, key, result):
+        """
+        Stores a result under key, replacing any result already there, and evicts old results if that takes the
+        directory over max_bytes
+        """
+
+        fd, tmpname = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, np.asarray(result))
+
+        with self.lock:
+            #the file being replaced no longer counts
+            try:
+                self.size -= os.path.getsize(self._filename(key))
+            except OSError:
+                pass
+            os.replace(tmpname, self._filename(key))
+            self.size += os.path.getsize(self._filename(key))
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def get_or_compute(self, key, compute):
+        """
+        Returns the result stored under key, or calls compute() to make it and stores that
+        """
+
+        result = self.get(key)
+        if result is None:
+            result = compute()
+            self.put(key, result)
+        return result
+
+    def stats(self):
+        """
+        :return: dict of hits, misses, evictions, and the number of results and bytes in the directory
+        """
+
+        entries = self._entries()
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(entries), 'bytes': sum(size for name, size, mtime in entries)}
+
+    def clear(self):
+        """
+        Deletes every result in the directory
+        """
+
+        with self.lock:
+            for name, size, mtime in self._entries():
+                self._remove(name)
+            self.size = 0
+
+    def _filename(self, key):
+        return os.path.join(self.directory, key + '.npy')
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.npy'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((name, st.st_size, st.st_mtime))
+        return entries
+
+    def _remove(self, name):
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except OSError:
+            pass
+
+    def _evict(self):
+        #other processes may have been adding to the directory too, so work from what's actually there
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        self.size = sum(size for name, size, mtime in entries)
+        while entries and self.size > self.max_bytes:
+            name, size, mtime = entries.pop(0)
+            self._remove(name)
+            self.size -= size
+            self.evictions += 1
+        logging.debug(str.format('Simulation cache is down to {} bytes', self.size))
@@ -2,7 +2,7 @@
 simdata and experimental data
 """
 from argparse import ArgumentParser
-from calcsim import CalcSimWrapper, SimulationUnstableError
+from calcsim import SimulationUnstableError
 from calcsimexecutor import CalcSimExecutor
 from datastore import InputDatastore
 from diffsimtask import DiffSimTask
@@ -50,7 +50,7 @@ class SingleComparisonTask(DiffSimTask):
             raise
         experdata = self.dstore.interpolated_experiment(self.args.current, simdata[:, 0], self.args.direction)
 
-        ce = ComparisonEngine(CalcSimWrapper())
+        ce = ComparisonEngine(simexec.cs)
         ce.calibrate(simdata[:, 1], experdata)
         simdata[:, 1] = ce.shift_data(simdata[:, 1])
 
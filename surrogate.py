@@ -0,0 +1,121 @@
+"""Gaussian process surrogate and expected improvement, for steering a parameter search towards the minimum with as
+few simulations as possible
+"""
+import numpy as np
+from scipy.stats import norm
+
+
+class GaussianProcess():
+    """
+    Gaussian process regression with a Matern 5/2 kernel, on inputs scaled to the unit box. The length scale is
+    chosen from length_scales by maximum marginal likelihood each time fit() is called; the targets are
+    standardised, so the signal variance is fixed at 1
+    """
+
+    def __init__(self, length_scales=np.logspace(-1.5, 0.5, 9), noise=1e-6):
+        """
+        :param length_scales: candidate length scales, in units of the unit box
+        :param noise: variance added to the diagonal, relative to the (standardised) signal variance
+        """
+
+        self.length_scales = length_scales
+        self.noise = noise
+
+    @staticmethod
+    def _kernel(X1, X2, length_scale):
+        dist = np.sqrt(np.sum((X1[:, np.newaxis, :] - X2[np.newaxis, :, :]) ** 2, axis=2)) / length_scale
+        return (1 + np.sqrt(5) * dist + 5.0 / 3 * dist ** 2) * np.exp(-np.sqrt(5) * dist)
+
+    def fit(self, X, y):
+        """
+        :param X: (n, d) array of sample points
+        :param y: vector of n observed values
+        """
+
+        X = np.atleast_2d(X)
+        y = np.asarray(y, dtype=np.float64)
+        self.y_mean = np.mean(y)
+        self.y_std = np.std(y) if np.std(y) > 0 else 1.0
+        y_scaled = (y - self.y_mean) / self.y_std
+
+        best_lml = -np.inf
+        for length_scale in self.length_scales:
+            K = self._kernel(X, X, length_scale) + self.noise * np.eye(len(X))
+            try:
+                L = np.linalg.cholesky(K)
+            except np.linalg.LinAlgError:
+                continue
+            alpha = np.linalg.solve(L.T, np.linalg.solve(L, y_scaled))
+            lml = -0.5 * np.dot(y_scaled, alpha) - np.sum(np.log(np.diag(L)))
+            if lml > best_lml:
+                best_lml = lml
+                self.length_scale, self.L, self.alpha = length_scale, L, alpha
+
+        if best_lml == -np.inf:
+            raise np.linalg.LinAlgError('Surrogate covariance is not positive definite for any length scale')
+        self.X = X
+        return self
+
+    def predict(self, X):
+        """
+        :param X: (m, d) array of points to predict at
+        :return: (vector of m means, vector of m standard deviations)
+        """
+
+        Ks = self._kernel(np.atleast_2d(X), self.X, self.length_scale)
+        mean = np.dot(Ks, self.alpha)
+        v = np.linalg.solve(self.L, Ks.T)
+        var = np.maximum(1 - np.sum(v ** 2, axis=0), 0)
+        return mean * self.y_std + self.y_mean, np.sqrt(var) * self.y_std
+
+
+def expected_improvement(mean, std, best, xi=0.01):
+    """
+    Expected amount by which a point with predicted mean and std would improve on (i.e. fall below) best
+
+    :param xi: margin that has to be beaten, which pushes the search to explore a little more
+    """
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        improvement = best - mean - xi
+        z = improvement / std
+        ei = improvement * norm.cdf(z) + std * norm.pdf(z)
+    return np.where(std > 0, ei, 0)
+
+
+def latin_hypercube(n, dims, rng):
+    """
+    n points in the unit box, one in each of n slices along every axis
+    """
+
+    return (np.array([rng.permutation(n) for _ in range(dims)]).T + rng.uniform(size=(n, dims))) / n
+
+
+def propose_batch(X, y, n, rng, n_candidates=4000):
+    """
+    Chooses n new points in the unit box to evaluate together, by expected improvement over a Gaussian process fit
+    to the points so far. After each choice the process is refit as if the point had come back at its predicted mean
+    (the 'kriging believer' heuristic), which spreads the batch out rather than piling it onto one peak
+
+    :param X: (m, d) array of points evaluated so far, in the unit box
+    :param y: vector of m values at those points
+    :param n: number of points to propose
+    :param rng: numpy RandomState/Generator for the candidate points
+    :return: (n, d) array of points
+    """
+
+    X = np.atleast_2d(np.array(X, dtype=np.float64))
+    y = np.array(y, dtype=np.float64)
+    candidates = rng.uniform(size=(n_candidates, X.shape[1]))
+    gp = GaussianProcess()
+
+    chosen = []
+    for _ in range(n):
+        gp.fit(X, y)
+        mean, std = gp.predict(candidates)
+        best = np.argmax(expected_improvement(mean, std, np.min(y), xi=0.01 * gp.y_std))
+        chosen.append(candidates[best])
+        X = np.vstack((X, candidates[best]))
+        y = np.append(y, mean[best])
+        candidates = np.delete(candidates, best, axis=0)
+    return np.array(chosen)
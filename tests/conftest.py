@@ -0,0 +1,110 @@
+"""Shared fixtures: a small synthetic NiCu input data set laid out as InputDatastore expects, and the tables and grid
+the searches use
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+from scipy.special import erfc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from calcsim import CalcSimWrapper
+from datastore import InputDatastore
+from propertycache import PropertyTableCache
+from simbackends import BackendUnavailableError
+
+
+CURRENTS = (0, 400, 800, 1000)
+
+
+def write_inputs(data_dir, prefix='NiCu'):
+    """
+    Writes a made-up data set in the same layout as the real one: measured D at 973K, Arrhenius constants over part
+    of the concentration range (so the fitted D is held flat at both ends), three resistivity curves and forward and
+    reverse profiles at each of CURRENTS
+    """
+
+    c = np.linspace(0, 1, 50)
+    np.savetxt(os.path.join(data_dir, prefix + '_Diffusivity_973K.csv'), np.column_stack((c, 1e-14 * (1 + 2 * c))),
+               header='c D', comments='')
+
+    cmid = np.linspace(0.1, 0.9, 5)
+    np.savetxt(os.path.join(data_dir, prefix + '_Diffusivity_Arrhenius_Constants.csv'),
+               np.column_stack((cmid, 1 + cmid, 250 - 62.5 * cmid)), delimiter=',')
+
+    for T in (900, 1000, 1100):
+        np.savetxt(os.path.join(data_dir, str.format('{}_Resistivity_{}K.csv', prefix, T)),
+                   np.column_stack((1 - c, 2e-7 * T / 1000.0 * (1 - 0.5 * c))), delimiter=',', header='c,R',
+                   comments='')
+
+    x = np.linspace(0, 25, 60)
+    for direction, sign in (('forward', 1), ('reverse', -1)):
+        columns = [[0] + list(x)]
+        for I in CURRENTS:
+            #wider interfaces at higher currents, shifted with the current
+            width = 1.5 + I / 1000.0
+            columns.append([sign * I] + list(0.5 * erfc((x - 12.5 - sign * I / 500.0) / width)))
+        np.savetxt(os.path.join(data_dir, str.format('{}_Experimental_{}_973K.csv', prefix, direction)),
+                   np.column_stack(columns), delimiter=',')
+
+
+@pytest.fixture(scope='session')
+def input_dir(tmp_path_factory):
+    data_dir = str(tmp_path_factory.mktemp('inputdata'))
+    write_inputs(data_dir)
+    return data_dir
+
+
+@pytest.fixture(scope='session')
+def datastore(input_dir):
+    return InputDatastore(input_dir, 'NiCu', table_cache=PropertyTableCache())
+
+
+@pytest.fixture(scope='session')
+def tables(datastore):
+    """
+    (D, R) at 973K as the searches build them: D from the Arrhenius fit, so flat at both ends, and 1001 entries
+    """
+
+    return datastore.interpolated_diffusivity(1001, 973), datastore.interpolated_resistivity(1001, 973)
+
+
+@pytest.fixture(scope='session')
+def grid():
+    """
+    (initial condition, dx) for the usual 100 point grid over 25 micron
+    """
+
+    init_cond = np.ones(100)
+    init_cond[50:] = 0
+    return init_cond, 25e-6 / 100
+
+
+@pytest.fixture(scope='session')
+def cs():
+    try:
+        return CalcSimWrapper('ctypes')
+    except BackendUnavailableError as e:
+        pytest.skip('libcalcsim.so is not available: ' + str(e))
+
+
+@pytest.fixture(scope='session')
+def explicit_reference(cs, tables, grid):
+    """
+    reference(z, cv_factor, tmax) -> (r, profile): the explicit profile at a tenth of the usual dt = 0.05 s after tmax
+    seconds at 800 A/cm^2, for the other schemes to be checked against. Each one is only worked out once
+    """
+
+    D, R = tables
+    init_cond, dx = grid
+    profiles = {}
+
+    def reference(z, cv_factor, tmax):
+        if (z, cv_factor, tmax) not in profiles:
+            r = cs.emigration_factor(z, 800 * 100 * 100, 973)
+            profiles[z, cv_factor, tmax] = r, cs.calc_simulation(D, R, init_cond, int(tmax / 0.005), 0.005, dx, r,
+                                                                 cv_factor)
+        return profiles[z, cv_factor, tmax]
+    return reference
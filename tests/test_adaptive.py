@@ -0,0 +1,51 @@
+"""Adaptive timesteps against a fine explicit run, on datastore tables whose D is held flat at both ends
+"""
+import numpy as np
+import pytest
+
+
+TMAX = 600.0
+#(z*, cv factor); current 800 A/cm^2
+CASES = [(0, 1), (800, 2), (-800, 1)]
+
+
+@pytest.mark.parametrize('z, cvf', CASES)
+@pytest.mark.parametrize('tol', [1e-4, 1e-5, 1e-6])
+def test_adaptive_matches_explicit(cs, tables, grid, explicit_reference, z, cvf, tol):
+    D, R = tables
+    init_cond, dx = grid
+    r, reference = explicit_reference(z, cvf, TMAX)
+
+    dt_min = cs.optimum_dt(dx, D, cvf) / 100
+    profile, steps = cs.calc_simulation_adaptive(D, R, init_cond, TMAX, dx, r, cvf, tol=tol, dt_min=dt_min)
+    assert np.sqrt(np.sum((profile - reference) ** 2)) < 0.01
+    #no more than the fixed-step run at dt_min would take
+    assert steps <= cs.num_sim_steps(dt_min, TMAX) + 1
+
+    #closer than the usual fixed-step run
+    fixed = cs.calc_simulation(D, R, init_cond, int(TMAX / 0.05), 0.05, dx, r, cvf)
+    assert np.sum((profile - reference) ** 2) < np.sum((fixed - reference) ** 2)
+
+
+@pytest.mark.parametrize('z, cvf', CASES)
+def test_adaptive_beats_fixed_steps_on_datastore_tables(cs, tables, grid, explicit_reference, z, cvf):
+    #with the default dt_min: the tables are flat at both ends, so the steps are held there for most of the run
+    D, R = tables
+    init_cond, dx = grid
+    r, reference = explicit_reference(z, cvf, TMAX)
+
+    profile, steps = cs.calc_simulation_adaptive(D, R, init_cond, TMAX, dx, r, cvf, tol=1e-5)
+    fixed_steps = int(TMAX / 0.05)
+    fixed = cs.calc_simulation(D, R, init_cond, fixed_steps, 0.05, dx, r, cvf)
+    assert steps < fixed_steps
+    assert np.sum((profile - reference) ** 2) < np.sum((fixed - reference) ** 2)
+
+
+def test_adaptive_takes_large_steps_on_smooth_tables(cs, grid):
+    init_cond, dx = grid
+    D = np.full(1001, 1e-15)
+    R = np.full(1001, 2e-7)
+    profile, steps = cs.calc_simulation_adaptive(D, R, init_cond, 7200.0, dx, 0.0, 1, tol=1e-5)
+    reference = cs.calc_simulation(D, R, init_cond, int(7200 / 0.05), 0.05, dx, 0.0, 1)
+    assert np.sqrt(np.sum((profile - reference) ** 2)) < 1e-3
+    assert steps < 2000
@@ -0,0 +1,66 @@
+"""The pure NumPy backend against the compiled one
+"""
+import itertools
+
+import numpy as np
+import pytest
+
+from calcsim import CalcSimWrapper, SimulationUnstableError
+from simbackends import BackendUnavailableError
+
+
+PAIRS = list(itertools.product((-800, 0, 800), (0.5, 1, 2, 3)))
+
+
+@pytest.fixture(scope='module')
+def numpy_cs():
+    return CalcSimWrapper('numpy')
+
+
+@pytest.mark.parametrize('z, cvf', [(0, 1), (800, 2), (-800, 0.5)])
+def test_single_runs_agree(cs, numpy_cs, tables, grid, z, cvf):
+    D, R = tables
+    init_cond, dx = grid
+    r = cs.emigration_factor(z, 800 * 100 * 100, 973)
+    np.testing.assert_allclose(numpy_cs.calc_simulation(D, R, init_cond, 2000, 0.05, dx, r, cvf),
+                               cs.calc_simulation(D, R, init_cond, 2000, 0.05, dx, r, cvf), rtol=0, atol=1e-12)
+
+
+def test_unstable_runs_agree(cs, numpy_cs, tables, grid):
+    D, R = tables
+    init_cond, dx = grid
+    for wrapper in (cs, numpy_cs):
+        with pytest.raises(SimulationUnstableError):
+            wrapper.calc_simulation(D, R, init_cond, 2000, 0.05, dx, 0.0, 10)
+
+
+def test_batches_agree(cs, numpy_cs, tables, grid):
+    D, R = tables
+    init_cond, dx = grid
+    r_values = np.array([cs.emigration_factor(z, 800 * 100 * 100, 973) for z, cvf in PAIRS])
+    cv_factors = np.array([cvf for z, cvf in PAIRS], dtype=np.float64)
+    expected = cs.calc_simulation_batch(D, R, init_cond, 2000, 0.05, dx, r_values, cv_factors)
+    got = numpy_cs.calc_simulation_batch(D, R, init_cond, 2000, 0.05, dx, r_values, cv_factors)
+    np.testing.assert_array_equal(np.isnan(got[:, 0]), np.isnan(expected[:, 0]))
+    np.testing.assert_allclose(got, expected, rtol=0, atol=1e-12)
+
+
+@pytest.mark.parametrize('length', [50, 100, 300])
+def test_shifts_agree(cs, numpy_cs, length):
+    rng = np.random.RandomState(length)
+    x = np.arange(length)
+    experiment = 1 / (1 + np.exp((x - length / 2.0) / 5))
+    models = np.array([1 / (1 + np.exp((x - length / 2.0 - offset) / 4)) + rng.normal(0, 1e-3, length)
+                       for offset in range(-20, 21, 4)])
+
+    shifts, lsqs = cs.fast_pad_shift_batch(experiment, models)
+    numpy_shifts, numpy_lsqs = numpy_cs.fast_pad_shift_batch(experiment, models)
+    np.testing.assert_array_equal(numpy_shifts, shifts)
+    np.testing.assert_allclose(numpy_lsqs, lsqs, rtol=1e-10)
+    assert cs.fast_pad_shift(experiment, models[3]) == numpy_cs.fast_pad_shift(experiment, models[3]) == shifts[3]
+
+
+def test_native_only_modes_say_which_backend(numpy_cs, tables):
+    D, R = tables
+    with pytest.raises(BackendUnavailableError, match='numpy'):
+        numpy_cs.prepare(D, R, 100)
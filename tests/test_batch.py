@@ -0,0 +1,58 @@
+"""calc_simulation_batch against one calc_simulation per (z*, Cv/Cve) pair
+"""
+import itertools
+
+import numpy as np
+import pytest
+
+from calcsim import SimulationUnstableError
+
+
+#cv factors of 3 and up are unstable at dt = 0.05 s on these tables
+PAIRS = list(itertools.product((-800, 0, 800), (0.5, 1, 2, 3, 10)))
+
+
+def single_runs(cs, D, R, init_conds, ndt, dt, dx, r_values, cv_factors):
+    profiles = []
+    for init_cond, r, cvf in zip(init_conds, r_values, cv_factors):
+        try:
+            profiles.append(cs.calc_simulation(D, R, init_cond, ndt, dt, dx, r, cvf))
+        except SimulationUnstableError:
+            profiles.append(np.full(len(init_cond), np.nan))
+    return np.array(profiles)
+
+
+@pytest.fixture(scope='module')
+def batch_args(cs, tables, grid):
+    D, R = tables
+    init_cond, dx = grid
+    r_values = np.array([cs.emigration_factor(z, 800 * 100 * 100, 973) for z, cvf in PAIRS])
+    cv_factors = np.array([cvf for z, cvf in PAIRS], dtype=np.float64)
+    return D, R, init_cond, dx, r_values, cv_factors
+
+
+def test_batch_matches_single_runs(cs, batch_args):
+    D, R, init_cond, dx, r_values, cv_factors = batch_args
+    batch = cs.calc_simulation_batch(D, R, init_cond, 2000, 0.05, dx, r_values, cv_factors)
+    single = single_runs(cs, D, R, [init_cond] * len(PAIRS), 2000, 0.05, dx, r_values, cv_factors)
+
+    np.testing.assert_array_equal(np.isnan(batch[:, 0]), np.isnan(single[:, 0]))
+    assert np.any(np.isnan(batch[:, 0])) and not np.all(np.isnan(batch[:, 0]))
+    np.testing.assert_array_equal(batch, single)
+
+
+def test_batch_with_a_profile_per_simulation(cs, batch_args):
+    D, R, init_cond, dx, r_values, cv_factors = batch_args
+    #the step at a different place in each
+    init_conds = np.array([np.arange(len(init_cond)) < 40 + index for index in range(len(PAIRS))], dtype=np.float64)
+    batch = cs.calc_simulation_batch(D, R, init_conds, 500, 0.05, dx, r_values, cv_factors)
+    single = single_runs(cs, D, R, init_conds, 500, 0.05, dx, r_values, cv_factors)
+    np.testing.assert_array_equal(batch, single)
+
+
+def test_batch_rejects_mismatched_arguments(cs, batch_args):
+    D, R, init_cond, dx, r_values, cv_factors = batch_args
+    with pytest.raises(ValueError):
+        cs.calc_simulation_batch(D, R, init_cond, 10, 0.05, dx, r_values, cv_factors[:-1])
+    with pytest.raises(ValueError):
+        cs.calc_simulation_batch(D, R, np.tile(init_cond, (2, 1)), 10, 0.05, dx, r_values, cv_factors)
@@ -0,0 +1,104 @@
+"""Batch alignment of models to an experiment, against trying every shift
+"""
+import numpy as np
+import pytest
+
+from expercomparison import ComparisonEngine, compare_batch, refine_shifts, shift_batch
+
+
+@pytest.fixture(scope='module')
+def models(cs, tables, grid):
+    """
+    (models, experiment): a few simulated profiles, and an experiment made from another one, moved over and noisy
+    """
+
+    D, R = tables
+    init_cond, dx = grid
+    models = [cs.calc_simulation(D, R, init_cond, 6000, 0.05, dx, cs.emigration_factor(z, 800 * 100 * 100, 973), cvf)
+              for z in (-800, 0, 800) for cvf in (1, 2)]
+    experiment = shift_batch(models[3], [7])[0] + np.random.RandomState(4).normal(0, 0.01, len(init_cond))
+    return np.array(models), experiment
+
+
+def brute_force(model, experiment):
+    ndx = len(model)
+    lsqs = [np.sum((shift_batch(model, [s])[0] - experiment) ** 2) for s in range(-ndx, ndx + 1)]
+    return np.argmin(lsqs) - ndx, np.min(lsqs)
+
+
+def test_compare_batch_matches_brute_force(cs, models):
+    models, experiment = models
+    shifts, lsqs = compare_batch(cs, models, experiment)
+    for model, shift, lsq in zip(models, shifts, lsqs):
+        best_shift, best_lsq = brute_force(model, experiment)
+        assert shift == best_shift
+        assert lsq == pytest.approx(best_lsq, rel=1e-9)
+    assert shifts[3] == 7
+
+
+def test_compare_batch_matches_comparison_engine(cs, models):
+    models, experiment = models
+    shifts, lsqs, shifted = compare_batch(cs, models, experiment, shifted=True)
+    engine = ComparisonEngine(cs)
+    for index, model in enumerate(models):
+        lsq, shift = engine.calibrate(model, experiment)
+        assert (lsq, shift) == (pytest.approx(lsqs[index], rel=1e-9), shifts[index])
+        np.testing.assert_array_equal(engine.shift_data(model), shifted[index])
+
+
+def test_compare_batch_marks_unstable_rows(cs, models):
+    models, experiment = models
+    unstable = models.copy()
+    unstable[1, 40] = np.nan
+    shifts, lsqs = compare_batch(cs, unstable, experiment)
+    assert np.isnan(lsqs[1]) and shifts[1] == 0
+
+    good_shifts, good_lsqs = compare_batch(cs, models, experiment)
+    keep = np.arange(len(models)) != 1
+    np.testing.assert_array_equal(shifts[keep], good_shifts[keep])
+    np.testing.assert_array_equal(lsqs[keep], good_lsqs[keep])
+
+
+def test_shift_batch_pads_with_ones_and_zeros():
+    shifted = shift_batch(np.full((2, 5), 0.5), [2, -2])
+    np.testing.assert_array_equal(shifted, [[1, 1, 0.5, 0.5, 0.5], [0.5, 0.5, 0.5, 0, 0]])
+
+
+def test_whole_shifts_move_the_data(models):
+    models, _ = models
+    expected = np.concatenate((np.ones((len(models), 3)), models[:, :-3]), axis=1)
+    np.testing.assert_array_equal(shift_batch(models, np.full(len(models), 3.0)), expected)
+
+
+def test_fractional_shift_recovers_sub_cell_offset(cs, models):
+    models, _ = models
+    experiment = shift_batch(models[3], [7.3])[0]
+    shifts, lsqs = compare_batch(cs, models[3], experiment, fractional=True)
+    #the parabola is only an approximation to the LSQ between cells
+    assert shifts[0] == pytest.approx(7.3, abs=0.1)
+
+    whole_shifts, whole_lsqs = compare_batch(cs, models[3], experiment)
+    assert whole_shifts[0] == 7
+    assert lsqs[0] < whole_lsqs[0] / 10
+
+
+def test_fractional_shift_never_fits_worse(cs, models):
+    models, experiment = models
+    whole_shifts, whole_lsqs = compare_batch(cs, models, experiment)
+    shifts, lsqs = compare_batch(cs, models, experiment, fractional=True)
+    assert np.all(lsqs <= whole_lsqs)
+    assert np.all(np.abs(shifts - whole_shifts) <= 0.5)
+    #and the LSQ returned is that of the profile shifted by the shift returned
+    np.testing.assert_allclose(lsqs, np.sum((shift_batch(models, shifts) - experiment) ** 2, axis=1), rtol=1e-12)
+
+    engine = ComparisonEngine(cs)
+    for index, model in enumerate(models):
+        lsq, shift = engine.calibrate(model, experiment, fractional=True)
+        assert (lsq, shift) == (pytest.approx(lsqs[index], rel=1e-9), pytest.approx(shifts[index], abs=1e-12))
+
+
+def test_refine_shifts_leaves_end_of_range_alone():
+    model = np.linspace(1, 0, 5)
+    experiment = np.ones(5)
+    shifts, lsqs = refine_shifts(model, experiment, [5], [0.0])
+    assert shifts[0] == 5 and lsqs[0] == 0
@@ -0,0 +1,29 @@
+"""Stopping early at a steady state, against running every step
+"""
+import numpy as np
+import pytest
+
+
+@pytest.mark.parametrize('scheme', ['explicit', 'implicit'])
+def test_early_exit_matches_full_run(cs, grid, scheme):
+    #D is high enough for the profile to settle to a straight line well within the run
+    init_cond, dx = grid
+    D = np.full(1001, 1e-13)
+    R = np.full(1001, 2e-7)
+    ndt, dt = 400000, 0.1
+
+    profile, steps = cs.calc_simulation_converge(D, R, init_cond, ndt, dt, dx, 0.0, 1, tol=1e-9, scheme=scheme)
+    full = cs.calc_simulation(D, R, init_cond, ndt, dt, dx, 0.0, 1, scheme=scheme)
+    assert steps < ndt / 2
+    np.testing.assert_allclose(profile, full, rtol=0, atol=1e-6)
+
+
+def test_unconverged_run_takes_every_step(cs, tables, grid):
+    D, R = tables
+    init_cond, dx = grid
+    r = cs.emigration_factor(800, 800 * 100 * 100, 973)
+    ndt, dt = 12000, 0.05
+
+    profile, steps = cs.calc_simulation_converge(D, R, init_cond, ndt, dt, dx, r, 1, tol=1e-12)
+    assert steps == ndt
+    np.testing.assert_allclose(profile, cs.calc_simulation(D, R, init_cond, ndt, dt, dx, r, 1), rtol=0, atol=1e-12)
@@ -0,0 +1,62 @@
+"""fast_pad_shift on both sides of the direct/FFT cutoff in fastshift.c, against trying every shift
+"""
+import numpy as np
+import pytest
+
+
+#DIRECT_XCORR_MAX_LEN is 180
+LENGTHS = [25, 100, 180, 181, 300, 512]
+
+
+def brute_force_shift(y1, y2):
+    """
+    The shift of y2 (padded with ones on the left and zeros on the right) with the least squares error against y1,
+    trying every one, with fast_pad_shift's sign convention
+    """
+
+    length = len(y1)
+    padded = np.concatenate((np.ones(length), y2, np.zeros(length)))
+    lsqs = np.array([np.sum((padded[length + dx:2 * length + dx] - y1) ** 2) for dx in range(-length, length + 1)])
+    best = np.argmin(lsqs)
+    return -(best - length), lsqs[best]
+
+
+def profiles(length, offsets, seed):
+    rng = np.random.RandomState(seed)
+    x = np.arange(length)
+    experiment = 1 / (1 + np.exp((x - length / 2.0) / (length / 20.0)))
+    models = np.array([1 / (1 + np.exp((x - length / 2.0 - offset) / (length / 25.0))) + rng.normal(0, 1e-3, length)
+                       for offset in offsets])
+    return experiment, models
+
+
+@pytest.mark.parametrize('length', LENGTHS)
+def test_batch_matches_brute_force(cs, length):
+    experiment, models = profiles(length, np.linspace(-length / 3.0, length / 3.0, 9), length)
+    shifts, lsqs = cs.fast_pad_shift_batch(experiment, models)
+    for model, shift, lsq in zip(models, shifts, lsqs):
+        expected_shift, expected_lsq = brute_force_shift(experiment, model)
+        assert shift == expected_shift
+        assert lsq == pytest.approx(expected_lsq, rel=1e-10, abs=1e-12)
+
+
+@pytest.mark.parametrize('length', LENGTHS)
+def test_recovers_a_known_shift(cs, length):
+    x = np.arange(length)
+    #sharp enough to be flat at both ends, so the padding matches it
+    experiment = 1 / (1 + np.exp((x - length / 2.0) / (length / 50.0)))
+    for offset in (-length // 5, 0, length // 4):
+        #the experiment moved right by offset cells, padded as fast_pad_shift pads
+        model = np.concatenate((np.ones(max(offset, 0)), experiment, np.zeros(max(-offset, 0))))
+        model = model[max(-offset, 0):max(-offset, 0) + length]
+        shift, lsq = cs.fast_pad_shift_lsq(experiment, model)
+        assert lsq == pytest.approx(0, abs=1e-9)
+        assert cs.fast_pad_shift(experiment, model) == shift
+        assert brute_force_shift(experiment, model)[0] == shift
+
+
+def test_single_matches_batch(cs):
+    experiment, models = profiles(100, [-10, 0, 10], 0)
+    shifts, lsqs = cs.fast_pad_shift_batch(experiment, models)
+    for model, shift, lsq in zip(models, shifts, lsqs):
+        assert cs.fast_pad_shift_lsq(experiment, model) == (shift, lsq)
@@ -0,0 +1,54 @@
+"""The implicit schemes against a fine explicit run, on datastore tables
+"""
+import numpy as np
+import pytest
+
+from calcsim import SimulationUnstableError
+
+
+TMAX = 600.0
+#(z*, cv factor); current 800 A/cm^2
+CASES = [(0, 1), (800, 2), (-800, 1)]
+
+
+@pytest.fixture(params=CASES)
+def case(request, explicit_reference):
+    """
+    (r, cv factor, explicit reference profile)
+    """
+
+    z, cvf = request.param
+    r, reference = explicit_reference(z, cvf, TMAX)
+    return r, cvf, reference
+
+
+def run(cs, tables, grid, case, dt, scheme):
+    D, R = tables
+    init_cond, dx = grid
+    r, cvf, reference = case
+    profile = cs.calc_simulation(D, R, init_cond, int(TMAX / dt), dt, dx, r, cvf, scheme=scheme)
+    return profile, np.sqrt(np.sum((profile - reference) ** 2))
+
+
+@pytest.mark.parametrize('dt, tol', [(0.05, 0.02), (0.5, 0.1)])
+def test_implicit_matches_explicit(cs, tables, grid, case, dt, tol):
+    profile, l2 = run(cs, tables, grid, case, dt, 'implicit')
+    assert l2 < tol
+
+
+@pytest.mark.parametrize('dt', [5.0, 50.0])
+def test_implicit_stays_in_range_at_large_dt(cs, tables, grid, case, dt):
+    profile, l2 = run(cs, tables, grid, case, dt, 'implicit')
+    assert np.all(np.isfinite(profile))
+    assert np.all((profile >= -1e-3) & (profile <= 1 + 1e-3))
+
+
+def test_crank_nicolson_matches_explicit(cs, tables, grid, case):
+    profile, l2 = run(cs, tables, grid, case, 0.05, 'crank-nicolson')
+    assert l2 < 0.02
+
+
+@pytest.mark.parametrize('dt', [0.5, 5.0])
+def test_crank_nicolson_raises_past_its_limit(cs, tables, grid, case, dt):
+    with pytest.raises(SimulationUnstableError):
+        run(cs, tables, grid, case, dt, 'crank-nicolson')
@@ -0,0 +1,108 @@
+"""InputBundle against parsing the CSV files directly
+"""
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+from conftest import write_inputs
+from datastore import InputDatastore
+from inputbundle import InputBundle
+from propertycache import PropertyTableCache
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    data_dir = str(tmp_path / 'inputdata')
+    os.makedirs(data_dir)
+    write_inputs(data_dir)
+    return data_dir
+
+
+def sources(data_dir):
+    return {
+        'diffusivity': (os.path.join(data_dir, 'NiCu_Diffusivity_973K.csv'), {'skip_header': 1}),
+        'experimental': (os.path.join(data_dir, 'NiCu_Experimental_forward_973K.csv'), {'delimiter': ','}),
+        'resistivity': (os.path.join(data_dir, 'NiCu_Resistivity_900K.csv'), {'skip_header': 1, 'delimiter': ','}),
+    }
+
+
+def bundle_name(data_dir):
+    return os.path.join(data_dir, 'NiCu_Inputs.bundle')
+
+
+def assert_matches_csv(bundle, data_dir):
+    for name, (path, kwargs) in sources(data_dir).items():
+        arr = bundle.get(name)
+        np.testing.assert_array_equal(arr, np.genfromtxt(path, **kwargs))
+        assert not arr.flags.writeable
+
+
+def test_round_trip(data_dir):
+    bundle = InputBundle(bundle_name(data_dir), sources(data_dir))
+    assert_matches_csv(bundle, data_dir)
+    assert bundle.data is not None
+    assert os.path.exists(bundle_name(data_dir))
+
+
+def test_later_bundles_read_without_parsing(data_dir, monkeypatch):
+    InputBundle(bundle_name(data_dir), sources(data_dir)).get('diffusivity')
+
+    def no_parsing(*args, **kwargs):
+        raise AssertionError('CSV file parsed again')
+    monkeypatch.setattr(np, 'genfromtxt', no_parsing)
+    bundle = InputBundle(bundle_name(data_dir), sources(data_dir))
+    arrays = dict((name, np.array(bundle.get(name))) for name in sources(data_dir))
+    monkeypatch.undo()
+    for name, (path, kwargs) in sources(data_dir).items():
+        np.testing.assert_array_equal(arrays[name], np.genfromtxt(path, **kwargs))
+
+
+def test_changed_sources_are_compiled_again(data_dir):
+    InputBundle(bundle_name(data_dir), sources(data_dir)).get('diffusivity')
+
+    path = sources(data_dir)['resistivity'][0]
+    data = np.genfromtxt(path, skip_header=1, delimiter=',')
+    np.savetxt(path, data * 2, delimiter=',', header='c,R', comments='')
+    bundle = InputBundle(bundle_name(data_dir), sources(data_dir))
+    np.testing.assert_array_equal(bundle.get('resistivity'), data * 2)
+
+
+def test_touched_sources_are_not_compiled_again(data_dir, monkeypatch):
+    InputBundle(bundle_name(data_dir), sources(data_dir)).get('diffusivity')
+    for path, kwargs in sources(data_dir).values():
+        os.utime(path, None)
+        shutil.copyfile(path, path + '.copy')
+        os.replace(path + '.copy', path)
+
+    def no_compiling(self):
+        raise AssertionError('Bundle compiled again')
+    monkeypatch.setattr(InputBundle, '_compile', no_compiling)
+    assert_matches_csv(InputBundle(bundle_name(data_dir), sources(data_dir)), data_dir)
+
+
+def test_unwritable_bundle_falls_back_on_the_csv_files(data_dir, tmp_path):
+    missing_dir = str(tmp_path / 'does' / 'not' / 'exist')
+    bundle = InputBundle(os.path.join(missing_dir, 'NiCu_Inputs.bundle'), sources(data_dir))
+    assert_matches_csv(bundle, data_dir)
+    assert bundle.data is None
+
+
+def test_datastore_reads_the_same_through_a_bundle(data_dir, tmp_path):
+    bundled = InputDatastore(data_dir, 'NiCu', table_cache=PropertyTableCache())
+    #nowhere to write a bundle, so this one parses the CSV files
+    unbundled = InputDatastore(data_dir, 'NiCu', table_cache=PropertyTableCache(),
+                               bundle_dir=str(tmp_path / 'missing'))
+
+    for direction in ('forward', 'reverse'):
+        expected = unbundled.edict_for_direction(direction)
+        got = bundled.edict_for_direction(direction)
+        assert sorted(got) == sorted(expected)
+        for I in expected:
+            np.testing.assert_array_equal(got[I], expected[I])
+    np.testing.assert_array_equal(bundled.interpolated_diffusivity(1001, 973, precise=True),
+                                  unbundled.interpolated_diffusivity(1001, 973, precise=True))
+    np.testing.assert_array_equal(bundled.interpolated_diffusivity(1001, 973),
+                                  unbundled.interpolated_diffusivity(1001, 973))
+    assert bundled.bundle.data is not None and unbundled.bundle.data is None
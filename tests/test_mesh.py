@@ -0,0 +1,55 @@
+"""Non-uniform meshes, against the uniform grid they reduce to
+"""
+import numpy as np
+
+from calcsim import SimulationMesh
+
+
+NDT, DT = 12000, 0.05
+
+
+def test_uniform_mesh_matches_calc_simulation(cs, tables, grid):
+    D, R = tables
+    init_cond, _ = grid
+    r = cs.emigration_factor(800, 800 * 100 * 100, 973)
+
+    #close to the usual dx, but a power of 2 so the node spacings come out exact; otherwise the table lookups make
+    #rounding differences in the second derivative grow
+    dx = 2.0 ** -22
+    x = np.arange(len(init_cond)) * dx
+    profile = cs.calc_simulation_mesh(D, R, init_cond, NDT, DT, x, r, 1)
+    np.testing.assert_allclose(profile, cs.calc_simulation(D, R, init_cond, NDT, DT, dx, r, 1), rtol=0, atol=1e-12)
+
+
+def test_mesh_with_no_refinement_is_uniform(grid):
+    init_cond, dx = grid
+    length = (len(init_cond) - 1) * dx
+    mesh = SimulationMesh.around_interface(length, len(init_cond), length / 2, length / 8, 1)
+    np.testing.assert_allclose(mesh.x, np.arange(len(init_cond)) * dx, rtol=0, atol=1e-6 * dx)
+    assert mesh.min_dx > dx * (1 - 1e-6)
+
+
+def test_refined_mesh_bounds_its_cells(grid):
+    init_cond, dx = grid
+    length = (len(init_cond) - 1) * dx
+    mesh = SimulationMesh.around_interface(length, len(init_cond), length / 2, length / 8, 4)
+    assert mesh.x[0] == 0 and mesh.x[-1] == length
+    assert np.all(np.diff(mesh.x) > 0)
+    assert mesh.min_dx >= length / ((len(init_cond) - 1) * 4) * (1 - 1e-6)
+    #finest at the interface
+    assert np.argmin(np.diff(mesh.x)) in range(len(init_cond) // 2 - 5, len(init_cond) // 2 + 5)
+
+
+def test_remesh_without_remeshing_matches_mesh(cs, tables, grid):
+    D, R = tables
+    init_cond, dx = grid
+    length = (len(init_cond) - 1) * dx
+    mesh = SimulationMesh.around_interface(length, len(init_cond), length / 2, length / 8, 2)
+    mesh_init = mesh.resample(np.arange(len(init_cond)) * dx, init_cond)
+    #the usual dt, scaled to the smallest cell
+    dt = DT * (mesh.min_dx / dx) ** 2
+    ndt = cs.num_sim_steps(dt, 600)
+
+    x, profile = cs.calc_simulation_remesh(D, R, mesh_init, ndt, dt, mesh, 0.0, 1, remesh_every=ndt)
+    np.testing.assert_array_equal(x, mesh.x)
+    np.testing.assert_array_equal(profile, cs.calc_simulation_mesh(D, R, mesh_init, ndt, dt, mesh.x, 0.0, 1))
@@ -0,0 +1,63 @@
+"""The least squares fit of z* and m, against experiments simulated at known parameters
+"""
+import numpy as np
+import pytest
+
+from expercomparison import shift_batch
+from modelfit import CurrentObjective, abs_cvf, global_fit, linear_cvf
+
+
+NDT, DT = 12000, 0.05
+TRUTH = (160, 3e-4)
+BOUNDS = [(-500, 500), (0, 1e-3)]
+
+
+@pytest.fixture(scope='module')
+def smooth_tables():
+    #the fit follows the sensitivities, which only match the simulation where the nearest-entry lookups follow a
+    #smooth curve; on the datastore tables it stops short of the truth
+    c = np.linspace(0, 1, 1001)
+    return 1e-14 * (1 + 2 * c), 2e-7 * (1 - 0.5 * c)
+
+
+def make_objectives(cs, tables, grid, cvf_model):
+    """
+    Objectives at 400 and 800 A/cm^2 both ways, each against the simulation at TRUTH moved over by 2 cells
+    """
+
+    D, R = tables
+    init_cond, dx = grid
+    objectives = []
+    for I in (400, 800):
+        for direction, sign in (('forward', 1), ('reverse', -1)):
+            r = cs.emigration_factor(TRUTH[0], sign * I * 100 * 100, 973)
+            profile = cs.calc_simulation(D, R, init_cond, NDT, DT, dx, r, cvf_model(TRUTH[1], sign * I))
+            objectives.append(CurrentObjective(cs, D, R, init_cond, NDT, DT, dx, 973, I, direction,
+                                               shift_batch(profile, [2])[0], cvf_model=cvf_model))
+    return objectives
+
+
+@pytest.mark.parametrize('cvf_model', [linear_cvf, abs_cvf])
+def test_global_fit_recovers_known_parameters(cs, smooth_tables, grid, cvf_model):
+    results = global_fit(make_objectives(cs, smooth_tables, grid, cvf_model), BOUNDS, starts=4, seed=0)
+
+    assert len(results) == 4
+    costs = [result['cost'] for result in results]
+    assert costs == sorted(costs)
+    np.testing.assert_allclose(results[0]['x'], TRUTH, rtol=1e-3)
+    assert results[0]['cost'] < 1e-12
+    for result in results:
+        assert BOUNDS[0][0] <= result['start'][0] <= BOUNDS[0][1]
+        assert BOUNDS[1][0] <= result['start'][1] <= BOUNDS[1][1]
+
+
+def test_global_fit_gives_unstable_starts_infinite_cost(cs, smooth_tables, grid):
+    #m = -2e-3 makes Cv/Cve negative at 800 A/cm^2
+    starts = [(100, 2e-4), (0, -2e-3)]
+    results = global_fit(make_objectives(cs, smooth_tables, grid, linear_cvf), [(-500, 500), (-3e-3, 1e-3)],
+                         starts=starts)
+
+    np.testing.assert_allclose(results[0]['x'], TRUTH, rtol=1e-3)
+    np.testing.assert_array_equal(results[0]['start'], starts[0])
+    assert results[1]['cost'] == np.inf and results[1]['message'] == 'Unstable at the start'
+    np.testing.assert_array_equal(results[1]['x'], starts[1])
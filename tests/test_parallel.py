@@ -0,0 +1,29 @@
+"""The tiled, temporally blocked kernel against plain calc_simulation
+"""
+import numpy as np
+import pytest
+
+
+#a step count that isn't a whole number of blocks, so the last block is a short one
+NDT, DT = 1003, 0.05
+
+
+@pytest.mark.parametrize('ndx, tile_width, block_steps, threads', [
+    (4000, 512, 16, 0),
+    (4000, 700, 16, 3),
+    (4000, 4096, 16, 1),
+    (1000, 128, 64, 2),
+    (100, 4096, 16, 0),
+])
+def test_parallel_matches_calc_simulation(cs, tables, grid, ndx, tile_width, block_steps, threads):
+    D, R = tables
+    _, dx = grid
+    init_cond = np.ones(ndx)
+    init_cond[ndx // 2:] = 0
+    #a few interfaces, so that some of them sit on the edges of tiles
+    init_cond[ndx // 8:ndx // 4] = 0
+    r = cs.emigration_factor(800, 800 * 100 * 100, 973)
+
+    profile = cs.calc_simulation_parallel(D, R, init_cond, NDT, DT, dx, r, 1, threads=threads,
+                                          block_steps=block_steps, tile_width=tile_width)
+    np.testing.assert_array_equal(profile, cs.calc_simulation(D, R, init_cond, NDT, DT, dx, r, 1))
@@ -0,0 +1,60 @@
+"""PreparedSimulation and CalcSimExecutor's use of it, against plain calc_simulation
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+from calcsimexecutor import CalcSimExecutor
+
+
+PARAMS = [(z, cvf, I, direction) for z in (-400, 400) for cvf in (0.5, 1) for I in (400, 1000)
+          for direction in ('forward', 'reverse')]
+
+
+@pytest.mark.parametrize('z, cvf', [(0, 1), (800, 2), (-800, 0.5)])
+def test_prepared_matches_calc_simulation(cs, tables, grid, z, cvf):
+    D, R = tables
+    init_cond, dx = grid
+    r = cs.emigration_factor(z, 800 * 100 * 100, 973)
+    prepared = cs.prepare(D, R, len(init_cond))
+    plain = cs.calc_simulation(D, R, init_cond, 12000, 0.05, dx, r, cvf)
+
+    #twice, to check nothing is left over from the first run
+    for _ in range(2):
+        np.testing.assert_allclose(prepared.run(init_cond, 12000, 0.05, dx, r, cvf), plain, rtol=0, atol=1e-12)
+
+    out = np.zeros(len(init_cond))
+    assert prepared.run(init_cond, 12000, 0.05, dx, r, cvf, out=out) is out
+    np.testing.assert_allclose(out, plain, rtol=0, atol=1e-12)
+
+
+def test_prepared_rejects_bad_buffers(cs, tables, grid):
+    D, R = tables
+    init_cond, dx = grid
+    prepared = cs.prepare(D, R, len(init_cond))
+    with pytest.raises(ValueError):
+        prepared.run(init_cond[:-1].copy(), 10, 0.05, dx, 0.0, 1)
+    with pytest.raises(ValueError):
+        prepared.run(init_cond.astype(np.float32), 10, 0.05, dx, 0.0, 1)
+    with pytest.raises(ValueError):
+        prepared.run(init_cond, 10, 0.05, dx, 0.0, 1, out=np.zeros(len(init_cond) + 1))
+
+
+def test_executor_prepared_matches_plain(datastore):
+    executor = CalcSimExecutor(datastore, 973, ndt=2000)
+    prepared = [executor.compute(*params) for params in PARAMS]
+    executor.use_prepared = False
+    for index, params in enumerate(PARAMS):
+        np.testing.assert_allclose(executor.compute(*params), prepared[index], rtol=0, atol=1e-12)
+
+
+def test_executor_is_thread_safe(cs, datastore):
+    executor = CalcSimExecutor(datastore, 973, ndt=2000)
+    assert executor.use_prepared
+    serial = [executor.compute(*params) for params in PARAMS]
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        threaded = list(pool.map(lambda params: executor.compute(*params), PARAMS * 4))
+    for index, result in enumerate(threaded):
+        np.testing.assert_array_equal(result, serial[index % len(PARAMS)])
@@ -0,0 +1,127 @@
+"""PropertyTableCache, against its byte budget and from many threads at once
+"""
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from propertycache import PropertyTableCache
+
+
+#100 float64s
+TABLE_BYTES = 800
+
+
+def counting(calls, value):
+    """
+    A compute function making a 100 entry table of value, which records each call in calls
+    """
+
+    def compute():
+        calls.append(value)
+        return np.full(100, value)
+    return compute
+
+
+def test_keeps_tables_within_budget():
+    cache = PropertyTableCache(max_bytes=3 * TABLE_BYTES)
+    calls = []
+    for value in range(5):
+        cache.get_or_compute(value, counting(calls, value))
+        assert cache.stats()['bytes'] <= 3 * TABLE_BYTES
+
+    stats = cache.stats()
+    assert (stats['tables'], stats['bytes'], stats['evictions'], stats['misses']) == (3, 3 * TABLE_BYTES, 2, 5)
+    #the oldest went first
+    np.testing.assert_array_equal(cache.get_or_compute(4, counting(calls, -1)), np.full(100, 4))
+    assert calls == list(range(5))
+    cache.get_or_compute(0, counting(calls, 0))
+    assert calls == list(range(5)) + [0]
+
+
+def test_evicts_least_recently_used():
+    cache = PropertyTableCache(max_bytes=2 * TABLE_BYTES)
+    calls = []
+    cache.get_or_compute('a', counting(calls, 1))
+    cache.get_or_compute('b', counting(calls, 2))
+    #using a makes b the one to go
+    cache.get_or_compute('a', counting(calls, 1))
+    cache.get_or_compute('c', counting(calls, 3))
+    cache.get_or_compute('a', counting(calls, 1))
+    assert calls == [1, 2, 3]
+    cache.get_or_compute('b', counting(calls, 2))
+    assert calls == [1, 2, 3, 2]
+    assert cache.stats()['hits'] == 2
+
+
+def test_keeps_a_table_bigger_than_budget():
+    cache = PropertyTableCache(max_bytes=TABLE_BYTES // 2)
+    cache.get_or_compute('a', counting([], 1))
+    cache.get_or_compute('b', counting([], 2))
+    stats = cache.stats()
+    assert (stats['tables'], stats['bytes'], stats['evictions']) == (1, TABLE_BYTES, 1)
+
+
+def test_tables_are_read_only():
+    cache = PropertyTableCache()
+    table = cache.get_or_compute('a', counting([], 1))
+    with pytest.raises(ValueError):
+        table[0] = 2
+    assert cache.get_or_compute('a', counting([], 1)) is table
+
+
+def test_computes_each_table_once_across_threads():
+    cache = PropertyTableCache()
+    calls = []
+
+    def slow():
+        time.sleep(0.2)
+        return counting(calls, 1)()
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        tables = list(executor.map(lambda _: cache.get_or_compute('a', slow), range(8)))
+
+    assert calls == [1]
+    assert all(table is tables[0] for table in tables)
+    stats = cache.stats()
+    assert (stats['misses'], stats['hits']) == (1, 7)
+    assert cache.key_locks == {}
+
+
+def test_different_keys_compute_side_by_side():
+    cache = PropertyTableCache()
+    b_done = threading.Event()
+
+    def wait_for_b():
+        #if b had to wait for a's lock, this would time out rather than see b finish
+        assert b_done.wait(5)
+        return np.ones(100)
+
+    def make_b():
+        b_done.set()
+        return np.zeros(100)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        a = executor.submit(cache.get_or_compute, 'a', wait_for_b)
+        #give a time to take its lock
+        time.sleep(0.1)
+        b = executor.submit(cache.get_or_compute, 'b', make_b)
+        np.testing.assert_array_equal(b.result(), np.zeros(100))
+        np.testing.assert_array_equal(a.result(), np.ones(100))
+
+
+def test_processes_share_tables_through_shared_dir(tmp_path):
+    directory = str(tmp_path / 'tables')
+    first = PropertyTableCache(shared_dir=directory)
+    second = PropertyTableCache(shared_dir=directory)
+    calls = []
+    key = PropertyTableCache.key('resistivity', 1001, 973)
+
+    first.get_or_compute(key, counting(calls, 1))
+    table = second.get_or_compute(PropertyTableCache.key('resistivity', 1001, 973.0), counting(calls, 2))
+    np.testing.assert_array_equal(table, np.full(100, 1))
+    assert calls == [1]
+    assert (second.stats()['shared_hits'], second.stats()['misses']) == (1, 0)
+    assert not table.flags.writeable
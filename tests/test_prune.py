@@ -0,0 +1,61 @@
+"""Pruning search simulations, and how pruned points are kept apart from finished ones
+"""
+import numpy as np
+import pytest
+
+from paramsearch import ParamSearchEngine, PRUNED, combine_maps
+
+
+BATCH = [(z, cvf) for z in (-400, 0, 400) for cvf in (0.5, 1, 1.5, 2)]
+
+
+@pytest.fixture
+def engine(cs, datastore):
+    engine = ParamSearchEngine(cs, datastore)
+    IAbs, ISigned = engine._setup_search(400, 973, 'forward')
+    #200 s rather than 2 hours, in chunks of 20 s
+    engine.ndt = 4000
+    engine.chunk_steps = 400
+    return engine, IAbs, ISigned
+
+
+def test_pruned_points_are_marked(engine):
+    engine, IAbs, ISigned = engine
+    exper = engine.exper_data[IAbs]
+    finished = np.array(engine.do_work_batch(BATCH, IAbs, ISigned, exper))
+
+    engine.prune_threshold = 1.0
+    pruned = np.array(engine.do_work_batch(BATCH, IAbs, ISigned, exper))
+
+    was_pruned = pruned == PRUNED
+    assert 0 < np.sum(was_pruned) < len(BATCH)
+    #every point that was run to the end has its real LSQ, and only hopeless ones were pruned
+    np.testing.assert_array_equal(pruned[~was_pruned], finished[~was_pruned])
+    assert np.all(finished[was_pruned] > 1.0)
+
+
+def test_pruned_search_finds_the_same_best_fit(engine):
+    engine = engine[0]
+    z_list = np.arange(-800, 801, 200.0)
+    dmult_list = np.arange(0.5, 3.01, 0.25)
+    unpruned = engine.search(z_list, dmult_list, 800, 973, lambda count: None, 'forward')
+
+    engine.prune_threshold = 0.3
+    pruned = engine.search(z_list, dmult_list, 800, 973, lambda count: None, 'forward', batch_size=7)
+    assert np.sum(pruned == PRUNED) > len(pruned.flat) // 2
+    assert np.nanargmin(pruned) == np.nanargmin(unpruned)
+    finished = pruned != PRUNED
+    np.testing.assert_array_equal(pruned[finished], unpruned[finished])
+
+    #whether a point is pruned doesn't depend on what else is in its batch, or what order the batches finish in
+    for batch_size in (1, 128):
+        again = engine.search(z_list, dmult_list, 800, 973, lambda count: None, 'forward', batch_size=batch_size)
+        np.testing.assert_array_equal(again, pruned)
+
+
+def test_combined_maps_keep_pruned_and_unstable_points():
+    forward = np.array([[1.0, PRUNED, 0.0], [np.nan, 2.0, np.nan]])
+    reverse = np.array([[2.0, 1.0, PRUNED], [PRUNED, 3.0, 0.0]])
+    combined = combine_maps(forward, reverse)
+    np.testing.assert_array_equal(combined, [[2.0, PRUNED, PRUNED], [np.nan, 6.0, np.nan]])
+    assert np.unravel_index(np.nanargmin(combined), combined.shape) == (0, 0)
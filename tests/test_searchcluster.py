@@ -0,0 +1,95 @@
+"""A SearchCoordinator handing a search out to SearchWorker processes on localhost, against ParamSearchEngine.search()
+"""
+import multiprocessing
+import os
+import signal
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from calcsim import CalcSimWrapper
+from datastore import InputDatastore
+from paramsearch import ParamSearchEngine
+from propertycache import PropertyTableCache
+from searchcluster import SearchCoordinator, SearchWorker
+
+
+Z_LIST = np.arange(-400, 401, 400.0)
+DMULT_LIST = np.array([0.5, 1.5])
+JOBS = [(973, 'forward', 800), (973, 'reverse', 800)]
+#settings other than the defaults, so it shows if a worker doesn't use them
+SETTINGS = {'fractional_shift': True, 'chunk_steps': 500}
+
+
+def short_engine(input_dir):
+    """
+    An engine that runs 200 s rather than 2 hours
+    """
+
+    engine = ParamSearchEngine(CalcSimWrapper('ctypes'), InputDatastore(input_dir, 'NiCu',
+                                                                        table_cache=PropertyTableCache()))
+    engine._setup_inputs(973)
+    engine.ndt = 4000
+    return engine
+
+
+def run_worker(address, input_dir):
+    SearchWorker(short_engine(input_dir), address, heartbeat_interval=0.2, batch_size=2).run()
+
+
+def start_worker(address, input_dir):
+    process = multiprocessing.get_context('spawn').Process(target=run_worker, args=(address, input_dir))
+    process.start()
+    return process
+
+
+@pytest.fixture
+def expected(cs, input_dir):
+    engine = short_engine(input_dir)
+    engine.update_settings(SETTINGS)
+    return dict((job, engine.search(Z_LIST, DMULT_LIST, job[2], job[0], lambda count: None, job[1]))
+                for job in JOBS)
+
+
+def wait_for(condition, timeout=60):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, 'Timed out'
+        time.sleep(0.01)
+
+
+@pytest.mark.parametrize('lost_by', ['killed', 'hung'])
+def test_workers_assemble_the_same_maps(expected, input_dir, lost_by):
+    coordinator = SearchCoordinator(('localhost', 0), heartbeat_timeout=2.0)
+    results = {}
+    search = threading.Thread(target=lambda: results.update(
+        coordinator.search(Z_LIST, DMULT_LIST, JOBS, shard_size=2, settings=SETTINGS)))
+    search.start()
+
+    #one worker is lost part way through its first shard: killed outright, which the coordinator sees as a
+    #disconnect, or stopped dead with its connection still open, so only the heartbeat timeout gives it away
+    victim = start_worker(coordinator.address, input_dir)
+    wait_for(lambda: len(coordinator.leases) > 0)
+    os.kill(victim.pid, signal.SIGKILL if lost_by == 'killed' else signal.SIGSTOP)
+    lost_shard = list(coordinator.leases)[0]
+
+    workers = [start_worker(coordinator.address, input_dir) for index in range(2)]
+    try:
+        search.join(120)
+        assert not search.is_alive()
+        coordinator.close()
+        for worker in workers:
+            worker.join(30)
+            assert worker.exitcode == 0
+    finally:
+        for process in workers + [victim]:
+            if process.is_alive():
+                process.kill()
+                process.join()
+
+    assert lost_shard not in coordinator.leases
+    assert sorted(results) == sorted(JOBS)
+    for job in JOBS:
+        np.testing.assert_array_equal(results[job], expected[job])
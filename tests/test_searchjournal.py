@@ -0,0 +1,173 @@
+"""SearchJournal, and searches picking up from one where they left off
+"""
+import sqlite3
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from calcsim import CalcSimWrapper
+from paramsearch import ParamSearchEngine, PRUNED
+from searchjournal import SearchJournal
+
+
+Z_LIST = np.arange(0, 40, 4.0)
+DMULT_LIST = np.arange(1, 3, 0.5)
+
+
+class StubEngine(ParamSearchEngine):
+    """
+    Scores each (z*, Cv) pair with a made-up function instead of simulating it, and counts what it was asked to do.
+    Raises KeyboardInterrupt on batch number interrupt_at, as if the search was killed there
+    """
+
+    def __init__(self, datastore, journal, interrupt_at=None, prune_above=None):
+        ParamSearchEngine.__init__(self, CalcSimWrapper('numpy'), datastore)
+        self.journal = journal
+        self.interrupt_at = interrupt_at
+        self.prune_threshold = prune_above
+        self.batches = 0
+        self.simulated = []
+        self.stub_lock = threading.Lock()
+
+    def do_work_batch(self, batch, IAbs, ISigned, exper):
+        with self.stub_lock:
+            self.batches += 1
+            batch_num = self.batches
+        if batch_num == self.interrupt_at:
+            #let the batches before it come back first
+            time.sleep(0.5)
+            raise KeyboardInterrupt()
+        with self.stub_lock:
+            self.simulated.extend(batch)
+        lsqs = [np.nan if z > 30 else (z - 12) ** 2 + cvf + ISigned / 1000.0 for z, cvf in batch]
+        if self.prune_threshold is not None:
+            lsqs = [PRUNED if lsq > self.prune_threshold else lsq for lsq in lsqs]
+        return lsqs
+
+
+def search(engine, I=400, direction='forward'):
+    return engine.search(Z_LIST, DMULT_LIST, I, 973, lambda count: None, direction, batch_size=4)
+
+
+@pytest.fixture
+def journal_path(tmp_path):
+    return str(tmp_path / 'journal.db')
+
+
+def test_record_and_lookup(journal_path):
+    journal = SearchJournal(journal_path)
+    journal.record('hash', 'forward', 400, [((1.0, 2.0), 0.5), ((3.0, 4.0), np.nan)])
+    journal.close()
+
+    journal = SearchJournal(journal_path)
+    found = journal.lookup('hash', 'forward', 400, [(1.0, 2.0), (3.0, 4.0), (5.0, 6.0)])
+    assert found[(1.0, 2.0)] == 0.5
+    assert np.isnan(found[(3.0, 4.0)])
+    assert (5.0, 6.0) not in found
+
+    #results for other inputs, directions or currents are never reused
+    assert journal.lookup('other', 'forward', 400, [(1.0, 2.0)]) == {}
+    assert journal.lookup('hash', 'reverse', 400, [(1.0, 2.0)]) == {}
+    assert journal.lookup('hash', 'forward', 800, [(1.0, 2.0)]) == {}
+
+
+def test_resume_after_a_finished_search(datastore, journal_path):
+    first = StubEngine(datastore, SearchJournal(journal_path))
+    expected = search(first)
+    assert len(first.simulated) == len(Z_LIST) * len(DMULT_LIST)
+    #unstable cells are marked as such rather than left looking like a perfect fit
+    assert np.all(np.isnan(expected[Z_LIST > 30])) and not np.any(np.isnan(expected[Z_LIST <= 30]))
+
+    second = StubEngine(datastore, SearchJournal(journal_path))
+    np.testing.assert_array_equal(search(second), expected)
+    assert second.simulated == []
+
+    #the other direction hasn't been done yet
+    search(second, direction='reverse')
+    assert len(second.simulated) == len(Z_LIST) * len(DMULT_LIST)
+
+
+def test_resume_after_an_interrupted_search(datastore, journal_path):
+    expected = search(StubEngine(datastore, None))
+
+    killed = StubEngine(datastore, SearchJournal(journal_path), interrupt_at=4)
+    with pytest.raises(KeyboardInterrupt):
+        search(killed)
+    work_queue = [(z, dmult) for z in Z_LIST for dmult in DMULT_LIST]
+    recorded = killed.journal.lookup(killed.input_hash, 'forward', 400, work_queue)
+    assert 0 < len(recorded) < len(work_queue)
+
+    resumed = StubEngine(datastore, SearchJournal(journal_path))
+    np.testing.assert_array_equal(search(resumed), expected)
+    #only what the killed search didn't record is simulated again
+    assert sorted(resumed.simulated) == sorted(qit for qit in work_queue if qit not in recorded)
+
+
+def test_search_all_resumes_from_search(datastore, journal_path):
+    first = StubEngine(datastore, SearchJournal(journal_path))
+    forward = search(first, I=400, direction='forward')
+
+    second = StubEngine(datastore, SearchJournal(journal_path))
+    results = second.search_all(Z_LIST, DMULT_LIST, 973, lambda count: None, batch_size=4)
+    np.testing.assert_array_equal(results['forward'][400], forward)
+    nmaps = len(datastore.edict_for_direction('forward')) + len(datastore.edict_for_direction('reverse'))
+    assert len(second.simulated) == (nmaps - 1) * len(Z_LIST) * len(DMULT_LIST)
+
+
+def test_pruned_points_are_flagged(journal_path):
+    journal = SearchJournal(journal_path)
+    journal.record('hash', 'forward', 400, [((1.0, 2.0), PRUNED), ((3.0, 4.0), 0.25)], prune_key='pruning')
+    found = journal.lookup('hash', 'forward', 400, [(1.0, 2.0), (3.0, 4.0)], prune_key='pruning')
+    assert found == {(1.0, 2.0): PRUNED, (3.0, 4.0): 0.25}
+
+    #a search that prunes differently, or not at all, only gets the finished result
+    assert journal.lookup('hash', 'forward', 400, [(1.0, 2.0), (3.0, 4.0)], prune_key='other') == {(3.0, 4.0): 0.25}
+    assert journal.lookup('hash', 'forward', 400, [(1.0, 2.0), (3.0, 4.0)]) == {(3.0, 4.0): 0.25}
+
+
+def test_journals_from_before_pruning_still_open(journal_path):
+    conn = sqlite3.connect(journal_path)
+    conn.execute('CREATE TABLE results (input_hash TEXT, direction TEXT, current REAL, z REAL, cvf REAL, '
+                 'lsq REAL, unstable INTEGER, PRIMARY KEY (input_hash, direction, current, z, cvf))')
+    conn.execute("INSERT INTO results VALUES ('hash', 'forward', 400, 1, 2, 0.5, 0)")
+    conn.commit()
+    conn.close()
+
+    journal = SearchJournal(journal_path)
+    journal.record('hash', 'forward', 400, [((3.0, 4.0), PRUNED)], prune_key='pruning')
+    found = journal.lookup('hash', 'forward', 400, [(1.0, 2.0), (3.0, 4.0)], prune_key='pruning')
+    assert found == {(1.0, 2.0): 0.5, (3.0, 4.0): PRUNED}
+
+
+def test_resumed_search_keeps_pruned_points(datastore, journal_path):
+    first = StubEngine(datastore, SearchJournal(journal_path), prune_above=100)
+    expected = search(first)
+    assert np.any(expected == PRUNED)
+
+    second = StubEngine(datastore, SearchJournal(journal_path), prune_above=100)
+    np.testing.assert_array_equal(search(second), expected)
+    assert second.simulated == []
+
+    #without pruning, only the pruned points are simulated again
+    unpruned = StubEngine(datastore, SearchJournal(journal_path))
+    full = search(unpruned)
+    assert len(unpruned.simulated) == np.sum(expected == PRUNED)
+    assert not np.any(full == PRUNED)
+    finished = expected != PRUNED
+    np.testing.assert_array_equal(full[finished], expected[finished])
+
+
+def test_results_from_other_kernels_are_not_reused(datastore, journal_path, monkeypatch):
+    search(StubEngine(datastore, SearchJournal(journal_path)))
+
+    fractional = StubEngine(datastore, SearchJournal(journal_path))
+    fractional.fractional_shift = True
+    search(fractional)
+    assert len(fractional.simulated) == len(Z_LIST) * len(DMULT_LIST)
+
+    monkeypatch.setattr('paramsearch.KERNEL_VERSION', -1)
+    other_kernel = StubEngine(datastore, SearchJournal(journal_path))
+    search(other_kernel)
+    assert len(other_kernel.simulated) == len(Z_LIST) * len(DMULT_LIST)
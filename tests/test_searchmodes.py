@@ -0,0 +1,93 @@
+"""The other ways of searching, against the brute-force map search() makes of a small grid
+"""
+import logging
+
+import numpy as np
+import pytest
+
+from paramsearch import ParamSearchEngine, combine_maps
+
+
+Z_LIST = np.arange(-1300, 601, 100.0)
+DMULT_LIST = np.arange(0.05, 1.01, 0.05)
+I = 800
+
+
+def no_progress(count):
+    pass
+
+
+@pytest.fixture(scope='module')
+def engine(cs, datastore):
+    engine = ParamSearchEngine(cs, datastore)
+    engine._setup_search(I, 973, 'forward')
+    #10 minutes rather than 2 hours, which still puts the best fit inside the grid; the most negative z* are unstable
+    engine.ndt = 12000
+    return engine
+
+
+@pytest.fixture(scope='module')
+def brute_force(engine):
+    logging.disable(logging.WARNING)
+    try:
+        search_map = engine.search(Z_LIST, DMULT_LIST, I, 973, no_progress, 'forward')
+    finally:
+        logging.disable(logging.NOTSET)
+    best = np.unravel_index(np.nanargmin(search_map), search_map.shape)
+    assert 0 < best[0] < len(Z_LIST) - 1 and 0 < best[1] < len(DMULT_LIST) - 1
+    assert np.any(np.isnan(search_map))
+    return search_map, best
+
+
+def test_adaptive_search_finds_brute_force_best_fit(engine, brute_force):
+    search_map, best = brute_force
+    sims_run = []
+    adaptive_map = engine.search_adaptive(Z_LIST, DMULT_LIST, I, 973, sims_run.append, 'forward', coarse_step=2)
+
+    assert np.unravel_index(np.nanargmin(adaptive_map), adaptive_map.shape) == best
+    assert adaptive_map[best] == search_map[best]
+    assert sims_run[-1] < search_map.size / 2
+    #the unstable region is mapped out exactly
+    np.testing.assert_array_equal(np.isnan(adaptive_map), np.isnan(search_map))
+
+
+@pytest.mark.parametrize('seed', [0, 1])
+def test_surrogate_search_finds_brute_force_best_fit(engine, brute_force, seed):
+    search_map, best = brute_force
+    bounds = (Z_LIST[0], Z_LIST[-1]), (DMULT_LIST[0], DMULT_LIST[-1])
+    best_z, best_dmult, best_lsq, samples = engine.search_surrogate(bounds[0], bounds[1], I, 973, no_progress,
+                                                                    'forward', seed=seed)
+
+    #far fewer simulations than the grid, and at least as good a fit as its best point, close by it. The error
+    #changes slowly with z* near the best fit, so the z* found can be a couple of cells out
+    assert len(samples) < search_map.size / 4
+    assert best_lsq <= search_map[best]
+    assert abs(best_dmult - DMULT_LIST[best[1]]) <= DMULT_LIST[1] - DMULT_LIST[0]
+    assert abs(best_z - Z_LIST[best[0]]) <= 2 * (Z_LIST[1] - Z_LIST[0])
+
+    assert best_lsq == np.nanmin(samples[:, 2])
+    np.testing.assert_array_equal(engine.evaluate_points([(best_z, best_dmult)], I, 973, 'forward'), [best_lsq])
+
+
+def test_search_all_matches_separate_searches(engine):
+    z_list = np.arange(-800, 801, 400.0)
+    dmult_list = np.arange(0.25, 1.01, 0.25)
+    maps_done = []
+    combined_done = []
+    progress = []
+    results = engine.search_all(z_list, dmult_list, 973, progress.append,
+                                map_cb=lambda direction, IAbs, search_map: maps_done.append((direction, IAbs)),
+                                combined_cb=lambda IAbs, combined: combined_done.append(IAbs), batch_size=7)
+
+    currents = sorted(results['combined'])
+    assert currents == [0, 400, 800, 1000]
+    assert sorted(maps_done) == sorted((direction, IAbs) for direction in ('forward', 'reverse') for IAbs in currents)
+    assert sorted(combined_done) == currents
+    assert progress[-1] == 2 * len(currents) * z_list.size * dmult_list.size
+
+    for IAbs in currents:
+        for direction in ('forward', 'reverse'):
+            separate = engine.search(z_list, dmult_list, IAbs, 973, no_progress, direction)
+            np.testing.assert_array_equal(results[direction][IAbs], separate)
+        np.testing.assert_array_equal(results['combined'][IAbs],
+                                      combine_maps(results['forward'][IAbs], results['reverse'][IAbs]))
@@ -0,0 +1,49 @@
+"""Sensitivities of a simulation to r and cv_factor, against finite differences of calc_simulation
+"""
+import numpy as np
+import pytest
+
+
+NDT, DT = 12000, 0.05
+CASES = [(0, 1), (800, 2), (-800, 1), (300, 1.5)]
+
+
+@pytest.fixture(scope='module')
+def smooth_tables():
+    #finite differences of calc_simulation only make sense where the nearest-entry lookups follow a smooth curve
+    c = np.linspace(0, 1, 1001)
+    return 1e-14 * (1 + 2 * c), 2e-7 * (1 - 0.5 * c)
+
+
+def relative_error(value, reference):
+    return np.linalg.norm(value - reference) / np.linalg.norm(reference)
+
+
+@pytest.mark.parametrize('z, cvf', CASES)
+def test_sensitivity_matches_finite_differences(cs, smooth_tables, grid, z, cvf):
+    D, R = smooth_tables
+    init_cond, dx = grid
+    r = cs.emigration_factor(z, 800 * 100 * 100, 973)
+
+    def simulate(r, cvf):
+        return cs.calc_simulation(D, R, init_cond, NDT, DT, dx, r, cvf)
+
+    profile, dCdr, dCdcvf = cs.calc_simulation_sensitivity(D, R, init_cond, NDT, DT, dx, r, cvf)
+    np.testing.assert_allclose(profile, simulate(r, cvf), rtol=0, atol=1e-9)
+
+    h = 1e-3 * cvf
+    assert relative_error(dCdcvf, (simulate(r, cvf + h) - simulate(r, cvf - h)) / (2 * h)) < 0.01
+    #r is 0 in one case, so step it by a fraction of r at z* = 800 instead
+    h = 0.05 * cs.emigration_factor(800, 800 * 100 * 100, 973)
+    assert relative_error(dCdr, (simulate(r + h, cvf) - simulate(r - h, cvf)) / (2 * h)) < 0.01
+
+
+@pytest.mark.parametrize('z, cvf', CASES)
+def test_sensitivity_stays_finite_on_datastore_tables(cs, tables, grid, z, cvf):
+    #the tables are piecewise linear and flat at both ends, which used to make the sensitivities blow up
+    D, R = tables
+    init_cond, dx = grid
+    r = cs.emigration_factor(z, 800 * 100 * 100, 973)
+    profile, dCdr, dCdcvf = cs.calc_simulation_sensitivity(D, R, init_cond, int(7200 / DT), DT, dx, r, cvf)
+    assert np.all(np.isfinite(dCdr)) and np.all(np.isfinite(dCdcvf))
+    assert np.max(np.abs(dCdcvf)) < 10
@@ -0,0 +1,113 @@
+"""SimulationCache, and the simulations that use it
+"""
+import os
+import time
+
+import numpy as np
+import pytest
+
+from calcsim import CalcSimWrapper, SimulationRun
+from simcache import SimulationCache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return SimulationCache(str(tmp_path / 'simcache'))
+
+
+def test_hits_and_misses(cache):
+    key = SimulationCache.key('calc_simulation', np.arange(3.0), 0.05)
+    assert cache.get(key) is None
+    cache.put(key, np.arange(5.0))
+    np.testing.assert_array_equal(cache.get(key), np.arange(5.0))
+    np.testing.assert_array_equal(cache.get(key, mmap=True), np.arange(5.0))
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['entries']) == (2, 1, 1)
+
+
+def test_hits_survive_the_file_going_away(cache, monkeypatch):
+    cache.put('key', np.arange(5.0))
+
+    def evicted(*args, **kwargs):
+        raise OSError('No such file or directory')
+    monkeypatch.setattr('os.utime', evicted)
+    np.testing.assert_array_equal(cache.get('key'), np.arange(5.0))
+    assert (cache.stats()['hits'], cache.stats()['misses']) == (1, 0)
+
+
+def test_caches_can_share_a_directory(tmp_path):
+    directory = str(tmp_path / 'simcache')
+    first = SimulationCache(directory)
+    second = SimulationCache(directory)
+    first.put('key', np.arange(3.0))
+    np.testing.assert_array_equal(second.get('key'), np.arange(3.0))
+
+
+def test_keys_cover_every_input():
+    keys = set([SimulationCache.key('calc_simulation', np.arange(3.0), 0.05),
+                SimulationCache.key('calc_simulation', np.arange(3.0), 0.5),
+                SimulationCache.key('calc_simulation', np.arange(4.0), 0.05),
+                SimulationCache.key('calc_simulation', np.arange(4.0).reshape(2, 2), 0.05),
+                SimulationCache.key('calc_simulation_sensitivity', np.arange(3.0), 0.05)])
+    assert len(keys) == 5
+
+
+def test_replacing_a_result_keeps_its_size(cache):
+    cache.put('key', np.zeros(1000))
+    cache.put('key', np.zeros(1000))
+    assert cache.size == cache.stats()['bytes']
+    cache.put('key', np.zeros(10))
+    assert cache.size == cache.stats()['bytes']
+
+
+def test_least_recently_used_results_are_evicted(tmp_path):
+    sizing = SimulationCache(str(tmp_path / 'sizing'))
+    sizing.put('key', np.zeros(100))
+    entry_bytes = sizing.size
+
+    cache = SimulationCache(str(tmp_path / 'simcache'), max_bytes=3 * entry_bytes)
+    for index in range(3):
+        cache.put(str(index), np.full(100, index, dtype=np.float64))
+        #modification times are the LRU order; keep them apart
+        os.utime(cache._filename(str(index)), (time.time() - 100 + index, time.time() - 100 + index))
+    assert cache.get('0') is not None
+    cache.put('3', np.zeros(100))
+
+    assert cache.get('1') is None
+    assert all(cache.get(key) is not None for key in ('0', '2', '3'))
+    assert cache.stats()['evictions'] == 1
+    assert cache.size <= 3 * entry_bytes
+
+
+def test_calc_simulation_is_cached(cs, tables, grid, tmp_path):
+    D, R = tables
+    init_cond, dx = grid
+    cached_cs = CalcSimWrapper(cs.backend.name, cache=SimulationCache(str(tmp_path / 'simcache')))
+    r = cs.emigration_factor(400, 800 * 100 * 100, 973)
+
+    first = cached_cs.calc_simulation(D, R, init_cond, 1000, 0.05, dx, r, 1)
+    again = cached_cs.calc_simulation(D, R, init_cond, 1000, 0.05, dx, r, 1)
+    other = cached_cs.calc_simulation(D, R, init_cond, 1000, 0.05, dx, r, 2)
+    np.testing.assert_array_equal(again, first)
+    np.testing.assert_array_equal(first, cs.calc_simulation(D, R, init_cond, 1000, 0.05, dx, r, 1))
+    assert not np.array_equal(other, first)
+    stats = cached_cs.cache.stats()
+    assert (stats['hits'], stats['misses'], stats['entries']) == (1, 2, 2)
+
+
+def test_runs_only_cache_their_final_profile(cs, tables, grid, tmp_path):
+    D, R = tables
+    init_cond, dx = grid
+    cached_cs = CalcSimWrapper(cs.backend.name, cache=SimulationCache(str(tmp_path / 'simcache')))
+    r = cs.emigration_factor(400, 800 * 100 * 100, 973)
+
+    profile = SimulationRun(cached_cs, D, R, init_cond, 1000, 0.05, dx, r, 1, chunk_steps=100).run()
+    assert cached_cs.cache.stats()['entries'] == 1
+
+    #the run and calc_simulation share the entry
+    np.testing.assert_array_equal(cached_cs.calc_simulation(D, R, init_cond, 1000, 0.05, dx, r, 1), profile)
+    assert cached_cs.cache.stats()['hits'] == 1
+
+    rerun = SimulationRun(cached_cs, D, R, init_cond, 1000, 0.05, dx, r, 1, chunk_steps=100)
+    assert rerun.finished
+    np.testing.assert_array_equal(rerun.run(), profile)
@@ -0,0 +1,134 @@
+"""SimulationRun against calc_simulation, and stopping searches part way through
+"""
+import threading
+
+import numpy as np
+import pytest
+
+from calcsim import SimulationCancelledError, SimulationRun
+from paramsearch import ParamSearchEngine
+
+
+Z_LIST = np.arange(-400, 401, 200.0)
+DMULT_LIST = np.arange(0.5, 2.01, 0.5)
+
+
+def test_chunks_add_up_to_one_run(cs, tables, grid):
+    D, R = tables
+    init_cond, dx = grid
+    r = cs.emigration_factor(400, 800 * 100 * 100, 973)
+    run = SimulationRun(cs, D, R, init_cond, 1050, 0.05, dx, r, 1.5, chunk_steps=100)
+    steps = [steps_done for steps_done, profile in run]
+    assert steps == list(range(100, 1001, 100)) + [1050]
+    np.testing.assert_allclose(run.profile, cs.calc_simulation(D, R, init_cond, 1050, 0.05, dx, r, 1.5),
+                               rtol=0, atol=1e-12)
+
+
+def test_batch_chunks_add_up_to_one_batch(cs, tables, grid):
+    D, R = tables
+    init_cond, dx = grid
+    r_values = cs.emigration_factor(np.array([-400.0, 0, 400]), 800 * 100 * 100, 973)
+    cv_factors = np.array([0.5, 1.0, 2.0])
+    profile = SimulationRun(cs, D, R, init_cond, 1000, 0.05, dx, r_values, cv_factors, chunk_steps=300).run()
+    np.testing.assert_allclose(profile, cs.calc_simulation_batch(D, R, init_cond, 1000, 0.05, dx, r_values,
+                                                                 cv_factors), rtol=0, atol=1e-12)
+
+
+def test_stopped_batches_finish_straight_away(cs, tables, grid, monkeypatch):
+    D, R = tables
+    init_cond, dx = grid
+    r_values = cs.emigration_factor(np.array([-400.0, 400]), 800 * 100 * 100, 973)
+    run = SimulationRun(cs, D, R, init_cond, 1000, 0.05, dx, r_values, np.array([1.0, 2.0]), chunk_steps=100)
+    run.advance()
+    stopped = run.profile.copy()
+    run.stop([0, 1])
+
+    def no_simulating(*args, **kwargs):
+        raise AssertionError('Stopped members simulated')
+    monkeypatch.setattr(cs, 'calc_simulation_batch', no_simulating)
+    assert [steps_done for steps_done, profile in run] == [1000]
+    assert run.finished
+    np.testing.assert_array_equal(run.profile, stopped)
+
+
+def test_cancelled_runs_raise(cs, tables, grid):
+    D, R = tables
+    init_cond, dx = grid
+    run = SimulationRun(cs, D, R, init_cond, 1000, 0.05, dx, cs.emigration_factor(400, 800 * 100 * 100, 973), 1.0,
+                        chunk_steps=100)
+
+    def cancel_halfway(steps_done):
+        if steps_done == 500:
+            run.cancel()
+    with pytest.raises(SimulationCancelledError):
+        run.run(cancel_halfway)
+    assert run.steps_done == 500
+
+
+class CountingEngine(ParamSearchEngine):
+    """
+    Counts the batches it simulates to the end, and raises fail_with from the first one to start if it is given
+    """
+
+    def __init__(self, cs, datastore, fail_with=None):
+        ParamSearchEngine.__init__(self, cs, datastore)
+        self.fail_with = fail_with
+        self.started = 0
+        self.finished = 0
+        self.count_lock = threading.Lock()
+
+    def do_work_batch(self, batch, IAbs, ISigned, exper):
+        with self.count_lock:
+            self.started += 1
+            first = self.started == 1
+        if first and self.fail_with is not None:
+            raise self.fail_with
+        lsqs = ParamSearchEngine.do_work_batch(self, batch, IAbs, ISigned, exper)
+        with self.count_lock:
+            self.finished += 1
+        return lsqs
+
+
+@pytest.fixture
+def engine(cs, datastore):
+    engine = CountingEngine(cs, datastore)
+    engine._setup_inputs(973)
+    #long enough that a cancel lands part way through, in chunks of 5 s
+    engine.ndt = 20000
+    engine.chunk_steps = 100
+    return engine
+
+
+def search(engine, progress_cb=lambda count: None):
+    return engine.search(Z_LIST, DMULT_LIST, 800, 973, progress_cb, 'forward', batch_size=1)
+
+
+def test_cancel_stops_a_search(engine):
+    def cancel_soon(count):
+        engine.cancel()
+    with pytest.raises(SimulationCancelledError):
+        search(engine, cancel_soon)
+    #the batches in flight stopped part way through, and the rest never simulated anything
+    assert engine.finished < len(Z_LIST) * len(DMULT_LIST)
+    assert not engine.cancel_event.is_set()
+
+    #and the next search runs as normal
+    engine.ndt = 200
+    assert not np.any(np.isnan(search(engine)))
+
+
+def test_cancel_before_a_search_stops_it(engine):
+    engine.cancel()
+    with pytest.raises(SimulationCancelledError):
+        search(engine)
+    assert engine.finished == 0
+    assert not engine.cancel_event.is_set()
+
+
+def test_failing_batches_stop_the_search(engine):
+    engine.fail_with = ValueError('Broken batch')
+    with pytest.raises(ValueError):
+        search(engine)
+    #at most the batches already in flight on the pool's 8 workers could have got to the end
+    assert engine.finished < 8
+    assert not engine.cancel_event.is_set()
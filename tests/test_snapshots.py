@@ -0,0 +1,30 @@
+"""Profiles captured at several output times from one run, against separate runs to each of those times
+"""
+import numpy as np
+import pytest
+
+
+DT = 0.05
+NDT = int(600 / DT)
+
+
+@pytest.mark.parametrize('scheme', ['explicit', 'implicit'])
+def test_snapshots_match_separate_runs(cs, tables, grid, scheme):
+    D, R = tables
+    init_cond, dx = grid
+    r = cs.emigration_factor(800, 800 * 100 * 100, 973)
+
+    #out of order, and with a repeat, to check the rows come back as asked for
+    out_times = [300.0, 60.0, 600.0, 60.0]
+    snapshots = cs.calc_simulation(D, R, init_cond, NDT, DT, dx, r, 1, scheme=scheme, out_times=out_times)
+    assert snapshots.shape == (len(out_times), len(init_cond))
+    for t, snapshot in zip(out_times, snapshots):
+        separate = cs.calc_simulation(D, R, init_cond, cs.num_sim_steps(DT, t), DT, dx, r, 1, scheme=scheme)
+        np.testing.assert_allclose(snapshot, separate, rtol=0, atol=1e-12)
+
+
+def test_snapshots_reject_times_past_the_run(cs, tables, grid):
+    D, R = tables
+    init_cond, dx = grid
+    with pytest.raises(ValueError):
+        cs.calc_simulation(D, R, init_cond, NDT, DT, dx, 0.0, 1, out_times=[NDT * DT + 1])